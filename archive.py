@@ -0,0 +1,251 @@
+import gzip, json, os, sys
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from eventlet import tpool
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy_classes import Message, MessageSegment, SegmentMedia
+
+"""
+Cold storage for old chat messages.
+
+Messages older than MESSAGE_ARCHIVE_DAYS are moved out of the messages table into
+gzipped, per chat segment files of up to SEGMENT_SIZE messages under
+MESSAGE_ARCHIVE_DIR/<chat id>/. The message_segments table is the manifest (chat,
+file, first and last message), so the hot table only holds recent messages and
+load_messages (see message_history.py) continues into the segments once a chat's
+hot messages run out. Everything older than the cutoff is archived, so a chat's
+segments are always older than its hot messages.
+
+Archived messages no longer count as unread (see unread_counters.py).
+
+    python archive.py archive [--days N]   move old messages into segments
+    python archive.py compact              merge small segments, VACUUM the database
+"""
+
+ARCHIVE_DIR = os.environ.get("MESSAGE_ARCHIVE_DIR", "./archive")
+ARCHIVE_DAYS = float(os.environ.get("MESSAGE_ARCHIVE_DAYS", 90))
+SEGMENT_SIZE = 1000
+COMPRESS_LEVEL = 6
+# decompressed segments kept in memory, scrolling reads the same segment page after page
+SEGMENT_CACHE_SIZE = int(os.environ.get("SEGMENT_CACHE_SIZE", 64))
+
+FIELDS = ("id", "message", "created_at", "read_at", "chat_id", "username", "userNickname", "image")
+ArchivedMessage = namedtuple("ArchivedMessage", FIELDS)
+
+
+class SegmentCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.segments = OrderedDict()
+
+    def get(self, path):
+        rows = self.segments.get(path)
+        if rows is None:
+            rows = tpool.execute(read_segment, path)
+            if self.capacity > 0:
+                self.segments[path] = rows
+                while len(self.segments) > self.capacity:
+                    self.segments.popitem(last=False)
+        else:
+            self.segments.move_to_end(path)
+        return rows
+
+    def invalidate(self, path):
+        self.segments.pop(path, None)
+
+
+segment_cache = SegmentCache(SEGMENT_CACHE_SIZE)
+
+
+def encode_row(m):
+    row = {field: getattr(m, field) for field in FIELDS}
+    for field in ("created_at", "read_at"):
+        if row[field] is not None:
+            row[field] = row[field].isoformat()
+    return row
+
+
+def decode_row(row):
+    for field in ("created_at", "read_at"):
+        if row[field] is not None:
+            row[field] = datetime.fromisoformat(row[field])
+    return ArchivedMessage(**row)
+
+
+"""
+Writes a segment (messages in chronological order) and returns its path relative to ARCHIVE_DIR.
+"""
+
+
+def write_segment(chat_id, rows):
+    first = rows[0]
+    name = "%s-%s-%d.json.gz" % (
+        first["created_at"].replace(":", "").replace("-", ""),
+        first["id"],
+        len(rows),
+    )
+    relative = os.path.join(chat_id, name)
+    path = os.path.join(ARCHIVE_DIR, relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    data = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    with open(tmp, "wb") as segment:
+        segment.write(gzip.compress(data, COMPRESS_LEVEL))
+    os.replace(tmp, path)
+    return relative
+
+
+def read_segment(relative):
+    with open(os.path.join(ARCHIVE_DIR, relative), "rb") as segment:
+        data = gzip.decompress(segment.read())
+    return [decode_row(row) for row in json.loads(data)]
+
+
+"""
+Returns up to `limit` archived messages of the chat older than `before` ((created_at, id),
+None for the newest), newest first.
+"""
+
+
+def archived_messages(s, chat_id, before=None, limit=50):
+    query = s.query(MessageSegment.path).filter(MessageSegment.chat_id == chat_id)
+    if before:
+        created_at, message_id = before
+        query = query.filter(
+            or_(
+                MessageSegment.first_created_at < created_at,
+                and_(
+                    MessageSegment.first_created_at == created_at,
+                    MessageSegment.first_id < message_id,
+                ),
+            )
+        )
+    query = query.order_by(MessageSegment.last_created_at.desc(), MessageSegment.last_id.desc())
+
+    result = []
+    for segment in query:
+        for m in reversed(segment_cache.get(segment.path)):
+            if before and (m.created_at, m.id) >= before:
+                continue
+            result.append(m)
+            if len(result) == limit:
+                return result
+    return result
+
+
+def add_segment(s, chat_id, rows):
+    relative = tpool.execute(write_segment, chat_id, [encode_row(m) for m in rows])
+    segment = MessageSegment(
+        chat_id=chat_id,
+        path=relative,
+        first_created_at=rows[0].created_at,
+        first_id=rows[0].id,
+        last_created_at=rows[-1].created_at,
+        last_id=rows[-1].id,
+        count=len(rows),
+    )
+    s.add(segment)
+    s.flush()
+    for url in {m.image for m in rows if m.image}:
+        s.add(SegmentMedia(segment_id=segment.id, url=url))
+    return segment
+
+
+"""
+Moves the messages of a chat older than cutoff into segments, one transaction per segment.
+Returns the number of messages archived.
+"""
+
+
+def archive_chat(s, chat_id, cutoff):
+    archived = 0
+    while True:
+        rows = (
+            s.query(*Message.__table__.columns)
+            .filter(Message.chat_id == chat_id, Message.created_at < cutoff)
+            .order_by(Message.created_at, Message.id)
+            .limit(SEGMENT_SIZE)
+            .all()
+        )
+        if not rows:
+            return archived
+        add_segment(s, chat_id, rows)
+        s.query(Message).filter(Message.id.in_([m.id for m in rows])).delete(
+            synchronize_session=False
+        )
+        s.commit()
+        archived += len(rows)
+
+
+def archive(s, days=ARCHIVE_DAYS, now=None):
+    cutoff = (now or datetime.utcnow()) - timedelta(days=days)
+    chats = [
+        i.chat_id
+        for i in s.query(Message.chat_id).filter(Message.created_at < cutoff).distinct()
+    ]
+    return sum(archive_chat(s, chat_id, cutoff) for chat_id in chats)
+
+
+"""
+Merges the partial segments left by archive runs, for chats with two or more of them.
+Segments must not overlap in time, so a chat is rewritten from its first partial segment
+on, the full segments before it are kept. Afterwards only the newest segment of a chat
+can be partial, compacting again changes nothing. Returns the number of chats rewritten.
+"""
+
+
+def compact(s):
+    partial = case((MessageSegment.count < SEGMENT_SIZE, 1), else_=0)
+    chats = [
+        i.chat_id
+        for i in s.query(MessageSegment.chat_id)
+        .group_by(MessageSegment.chat_id)
+        .having(func.sum(partial) > 1)
+    ]
+    for chat_id in chats:
+        segments = (
+            s.query(MessageSegment)
+            .filter(MessageSegment.chat_id == chat_id)
+            .order_by(MessageSegment.first_created_at, MessageSegment.first_id)
+            .all()
+        )
+        first_partial = next(n for n, i in enumerate(segments) if i.count < SEGMENT_SIZE)
+        old = segments[first_partial:]
+        rows = [m for segment in old for m in segment_cache.get(segment.path)]
+        old_paths = [segment.path for segment in old]
+        s.query(SegmentMedia).filter(SegmentMedia.segment_id.in_([i.id for i in old])).delete(
+            synchronize_session=False
+        )
+        for segment in old:
+            s.delete(segment)
+        new_paths = [
+            add_segment(s, chat_id, rows[start : start + SEGMENT_SIZE]).path
+            for start in range(0, len(rows), SEGMENT_SIZE)
+        ]
+        s.commit()
+        for path in old_paths:
+            segment_cache.invalidate(path)
+            if path not in new_paths:
+                os.remove(os.path.join(ARCHIVE_DIR, path))
+    return len(chats)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] not in (["archive"], ["compact"]) or (args[:1] == ["compact"] and args[1:]):
+        print("usage: python archive.py archive [--days N] | python archive.py compact")
+        sys.exit(1)
+    from sqlalchemy_base import Session, engine
+
+    s = Session()
+    try:
+        if args[0] == "archive":
+            days = float(args[2]) if args[1:2] == ["--days"] else ARCHIVE_DAYS
+            print("archived %d messages" % archive(s, days))
+        else:
+            print("compacted %d chats" % compact(s))
+            s.close()
+            with engine.connect() as connection:
+                connection.exec_driver_sql("VACUUM")
+    finally:
+        s.close()
@@ -0,0 +1,136 @@
+import eventlet
+
+eventlet.monkey_patch()
+
+import common
+import os, sys, time
+
+import server_helpers
+
+# measures chat creation, not its rate limit
+os.environ["RATE_LIMITS"] = "0"
+# every module that talks to Redis imports its client from server_helpers
+server_helpers.logon_session = common.redis_standin(db=0)
+server_helpers.socket_session = common.redis_standin(db=1)
+server_helpers.unread_store = common.redis_standin(db=2)
+
+import server
+from presence import register_sid
+from sqlalchemy_classes import Chat, User
+from sqlalchemy_base import Session, engine
+
+"""
+ADD_CHAT for groups of 10 to 1,000 members and for a direct chat asked for again.
+
+Before: the handler as it was, one query per username, a relationship append per
+member, and per recipient a query of the chat and of all its members. After:
+handle_new_group_chat with chat_create.py, one IN query per 500 usernames, one bulk
+insert of the memberships and a primary key lookup for direct chats that exist.
+Half of the members are online, both send them the same ADD_CHAT.
+
+    python benchmarks/bench_add_chat.py [largest group]
+"""
+
+SIZES = [10, 100, 1000]
+DIRECT_REPEAT = 200
+
+
+def legacy_add_chat(sender_name, users):
+    s = Session()
+    sender = s.query(User).filter(User.username == sender_name).first()
+    recipients = [s.query(User).filter(User.username == user).first() for user in users]
+    if len(users) == 1:
+        chat_name = recipients[0].userNickname
+    else:
+        chat_name = "、".join([i.userNickname for i in recipients])
+    chat = Chat(chat_name, sender.id)
+    chat_id = chat.id
+    sender.chats.append(chat)
+    for recipient in recipients:
+        recipient.chats.append(chat)
+    s.commit()
+    online = server.online_sids([recipient.id for recipient in recipients])
+    for recipient in recipients:
+        recipient_sid = online.get(recipient.id)
+        member_except_now = (
+            s.query(Chat).filter(Chat.id == chat_id).first().users.filter(User.id != recipient.id).all()
+        )
+        if recipient_sid:
+            server.emitter.emit(
+                "ADD_CHAT",
+                {
+                    "id": chat.id,
+                    "chat_name": chat_name,
+                    "recipient": [single.username for single in member_except_now],
+                    "recipientId": [single.id for single in member_except_now],
+                    "avatar": "",
+                    "last_message": "",
+                    "last_message_timestamp": "",
+                },
+                room=recipient_sid,
+            )
+    s.close()
+
+
+def timed(f, *args):
+    with common.count_queries(engine) as counter:
+        start = time.perf_counter()
+        f(*args)
+        elapsed = time.perf_counter() - start
+    return elapsed * 1000, counter["statements"]
+
+
+def handler_add_chat(client, users):
+    client.emit("ADD_CHAT", users)
+    client.get_received()
+
+
+def main():
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else SIZES[-1]
+    sizes = [size for size in SIZES if size < largest] + [largest]
+    common.migrate()
+    flask_client = server.app.test_client()
+    account = dict(
+        userNickname="owner", username="owner", password="pw", firstname="a", lastname="b", email="e"
+    )
+    flask_client.post("/api/register", json=account)
+    flask_client.post("/api/login", json=account)
+    client = server.socket.test_client(server.app, flask_test_client=flask_client)
+    client.get_received()
+
+    s = Session()
+    members = common.seed_users(s, largest, prefix="member")
+    s.close()
+    # online members get a sid in the Socket.IO manager, emits to it go nowhere
+    for n, member_id in enumerate(members[::2]):
+        register_sid(member_id, server.socket.server.manager.connect("bench-%d" % n, "/"))
+    names = ["member%d" % n for n in range(largest)]
+
+    rows = []
+    for size in sizes:
+        before_ms, before_sql = timed(legacy_add_chat, "owner", names[:size])
+        after_ms, after_sql = timed(handler_add_chat, client, names[:size])
+        rows.append((size, "%.1f" % before_ms, before_sql, "%.1f" % after_ms, after_sql))
+    common.print_table(
+        "ADD_CHAT of a group, half of the members online",
+        ["members", "before ms", "before SQL", "after ms", "after SQL"],
+        rows,
+    )
+
+    before = [timed(legacy_add_chat, "owner", ["member1"]) for _ in range(DIRECT_REPEAT)]
+    after = [timed(handler_add_chat, client, ["member1"]) for _ in range(DIRECT_REPEAT)]
+    s = Session()
+    chats = s.query(Chat).count()
+    s.close()
+    common.print_table(
+        "ADD_CHAT of the same direct chat %d times" % DIRECT_REPEAT,
+        ["path", "p50 ms", "SQL", "chats created"],
+        [
+            ("before", "%.2f" % common.percentile([i[0] for i in before], 50), before[-1][1], DIRECT_REPEAT),
+            ("after", "%.2f" % common.percentile([i[0] for i in after], 50), after[-1][1], chats - len(sizes) * 2 - DIRECT_REPEAT),
+        ],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import common
+import os, random, sys, time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+os.environ.setdefault("MESSAGE_ARCHIVE_DIR", os.path.join(common.WORKDIR, "archive"))
+
+import sqlalchemy_classes
+from sqlalchemy_classes import Message
+from sqlalchemy_base import Session, engine
+import archive, message_history
+
+"""
+Hot table size and history latency before and after archiving: CHATS chats with
+messages spread over the last year, everything older than MESSAGE_ARCHIVE_DAYS (90)
+is moved into segments and compacted.
+
+Latency is the median of one page of LOAD_ACTIVE_CHAT_MESSAGES (latest page) and of
+a page halfway back through each chat's history, which is in the archive afterwards
+(first read of a segment, then a cached one while scrolling on).
+
+    python benchmarks/bench_archive.py [chats] [messages per chat]
+"""
+
+CHATS = 100
+MESSAGES_PER_CHAT = 5000
+
+
+def seed(s, chats, per_chat):
+    users = common.seed_users(s, 2)
+    chat_ids = common.seed_chats(s, [(users[0], [users[1]]) for _ in range(chats)])
+    now = datetime.utcnow()
+    step = timedelta(days=365) / per_chat
+    for chat_id in chat_ids:
+        s.execute(
+            Message.__table__.insert(),
+            [
+                {
+                    "id": str(uuid4()),
+                    "message": "message %d with a bit of text to make rows realistic" % n,
+                    "created_at": now - step * (per_chat - n),
+                    "read_at": None,
+                    "chat_id": chat_id,
+                    "username": "user%d" % (n % 2),
+                    "userNickname": "user %d" % (n % 2),
+                    "image": None,
+                }
+                for n in range(per_chat)
+            ],
+        )
+    s.commit()
+    return chat_ids
+
+
+def database_bytes():
+    with engine.connect() as connection:
+        connection.exec_driver_sql("VACUUM")
+        page_size = connection.exec_driver_sql("PRAGMA page_size").scalar()
+        return connection.exec_driver_sql("PRAGMA page_count").scalar() * page_size
+
+
+def archive_bytes():
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(archive.ARCHIVE_DIR)
+        for name in names
+    )
+
+
+def halfway_cursors(s, chat_ids, per_chat):
+    # cursors of the messages halfway back, taken from the hot table before archiving
+    cursors = {}
+    for chat_id in chat_ids:
+        m = (
+            s.query(Message)
+            .filter(Message.chat_id == chat_id)
+            .order_by(Message.created_at.desc(), Message.id.desc())
+            .offset(per_chat // 2)
+            .first()
+        )
+        cursors[chat_id] = "%s|%s" % (m.created_at.isoformat(), m.id)
+    return cursors
+
+
+def page_latency(s, chat_ids, cursors=None):
+    timings = []
+    for chat_id in chat_ids:
+        start = time.perf_counter()
+        message_history.load_messages(s, chat_id, cursors[chat_id] if cursors else None)
+        timings.append((time.perf_counter() - start) * 1000)
+    return common.percentile(timings, 50)
+
+
+def measure(s, chat_ids, cursors):
+    sample = random.sample(chat_ids, min(20, len(chat_ids)))
+    archive.segment_cache.segments.clear()
+    return {
+        "rows": s.query(Message).count(),
+        "db": database_bytes(),
+        "latest": page_latency(s, sample),
+        "deep": page_latency(s, sample, cursors),
+        "deep cached": page_latency(s, sample, cursors),
+    }
+
+
+def main():
+    common.migrate()
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else CHATS
+    per_chat = int(sys.argv[2]) if len(sys.argv) > 2 else MESSAGES_PER_CHAT
+
+    s = Session()
+    chat_ids = seed(s, chats, per_chat)
+    cursors = halfway_cursors(s, chat_ids, per_chat)
+    before = measure(s, chat_ids, cursors)
+
+    start = time.perf_counter()
+    archived = archive.archive(s)
+    archive.compact(s)
+    elapsed = time.perf_counter() - start
+    after = measure(s, chat_ids, cursors)
+
+    rows = [
+        ("hot rows", before["rows"], after["rows"]),
+        ("database MB", "%.1f" % (before["db"] / 2**20), "%.1f" % (after["db"] / 2**20)),
+        ("archive MB", "-", "%.1f" % (archive_bytes() / 2**20)),
+        ("latest page ms", "%.2f" % before["latest"], "%.2f" % after["latest"]),
+        ("deep page ms", "%.2f" % before["deep"], "%.2f" % after["deep"]),
+        ("deep page, cached segment ms", "%.2f" % before["deep cached"], "%.2f" % after["deep cached"]),
+    ]
+    common.print_table(
+        "%d chats x %d messages, %d archived in %.1f s" % (chats, per_chat, archived, elapsed),
+        ["", "before", "after"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import eventlet
+
+eventlet.monkey_patch()
+
+import common
+import os, random, time
+
+import server_helpers
+
+# measures the send path, not its rate limit
+os.environ["RATE_LIMITS"] = "0"
+# every module that talks to Redis imports its client from server_helpers
+server_helpers.logon_session = common.redis_standin(db=0)
+server_helpers.socket_session = common.redis_standin(db=1)
+server_helpers.unread_store = common.redis_standin(db=2)
+
+import server
+import chat_cache
+from sqlalchemy_classes import Chat
+from sqlalchemy_base import Session, engine
+from metrics import handler_metrics
+
+"""
+The chat check of ADD_MESSAGE_TO_CHAT: the query it used to run per message (does the
+chat exist) against chat_members (does it exist and is the sender a member) from the
+chat cache, alone and as part of the whole send path through the Socket.IO handler.
+
+The sender is in CHATS chats of MEMBERS members each, messages go to random ones.
+The cache is warmed before the cached runs. SQL is the statements of the handler
+itself, the batched message insert runs in the message writer and is the same for both.
+
+    python benchmarks/bench_chat_cache.py
+"""
+
+CHATS = 1000
+MEMBERS = 20
+CHECKS = 20000
+MESSAGES = 1000
+
+
+def old_check(chat_id):
+    s = Session()
+    chat = s.query(Chat.id).filter(Chat.id == chat_id).first()
+    s.close()
+    return chat
+
+
+def cached_check(user_id, chat_id):
+    chat = chat_cache.chat_members(Session, chat_id)
+    return chat and user_id in chat.members
+
+
+def measure_checks(check, chats):
+    with common.count_queries(engine) as counter:
+        start = time.perf_counter()
+        for n in range(CHECKS):
+            check(chats[n % len(chats)])
+        elapsed = time.perf_counter() - start
+    return "%.1f" % (elapsed / CHECKS * 1e6), "%.2f" % (counter["statements"] / CHECKS)
+
+
+def measure_sends(client, chats):
+    stats = handler_metrics.stats(("socket", "ADD_MESSAGE_TO_CHAT"))
+    sql = stats.sql
+    timings = []
+    for n in range(MESSAGES):
+        start = time.perf_counter()
+        client.emit("ADD_MESSAGE_TO_CHAT", {"chat": random.choice(chats), "message": "hello %d" % n})
+        timings.append((time.perf_counter() - start) * 1000)
+        client.get_received()
+    return (
+        "%.3f" % common.percentile(timings, 50),
+        "%.3f" % common.percentile(timings, 99),
+        "%.2f" % ((stats.sql - sql) / MESSAGES),
+    )
+
+
+def main():
+    common.migrate()
+    flask_client = server.app.test_client()
+    account = dict(
+        userNickname="sender", username="sender", password="pw", firstname="a", lastname="b", email="e"
+    )
+    flask_client.post("/api/register", json=account)
+    user_id = flask_client.post("/api/login", json=account).get_json()["id"]
+
+    s = Session()
+    users = common.seed_users(s, CHATS, prefix="member")
+    chats = common.seed_chats(
+        s, [(user_id, random.sample(users, MEMBERS - 1)) for _ in range(CHATS)]
+    )
+    s.close()
+    client = server.socket.test_client(server.app, flask_test_client=flask_client)
+    client.get_received()
+
+    rows = [("query per message (exists only)",) + measure_checks(old_check, chats)]
+    chat_cache.chat_cache.capacity = 0
+    rows.append(("chat_members, no cache",) + measure_checks(lambda c: cached_check(user_id, c), chats))
+    chat_cache.chat_cache.capacity = chat_cache.CHAT_CACHE_SIZE
+    for chat_id in chats:
+        cached_check(user_id, chat_id)
+    rows.append(("chat_members, cache",) + measure_checks(lambda c: cached_check(user_id, c), chats))
+    common.print_table(
+        "chat check, %d chats of %d members" % (CHATS, MEMBERS),
+        ["check", "us / check", "SQL / check"],
+        rows,
+    )
+
+    chat_cache.chat_cache.capacity = 0
+    chat_cache.chat_cache.clear()
+    uncached = measure_sends(client, chats)
+    chat_cache.chat_cache.capacity = chat_cache.CHAT_CACHE_SIZE
+    for chat_id in chats:
+        cached_check(user_id, chat_id)
+    cached = measure_sends(client, chats)
+    common.print_table(
+        "ADD_MESSAGE_TO_CHAT through the handler, %d messages" % MESSAGES,
+        ["chat check", "p50 ms", "p99 ms", "handler SQL / message"],
+        [("no cache",) + uncached, ("chat cache",) + cached],
+    )
+
+
+if __name__ == "__main__":
+    main()
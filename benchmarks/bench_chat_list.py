@@ -0,0 +1,89 @@
+import common
+import random
+
+import sqlalchemy_classes
+from sqlalchemy_classes import User
+from sqlalchemy_base import Session, engine
+import chat_list
+import presence
+import unread_counters
+
+"""
+LOAD_CHATS benchmark: the per chat ORM walk used by the old getChats against the
+chat_list read model, for users with 10/100/1000 chats.
+
+    python benchmarks/bench_chat_list.py
+"""
+
+SIZES = [10, 100, 1000]
+
+
+"""
+Copy of the getChats body before the read model was introduced.
+"""
+
+
+def legacy_chat_list(s, user_id, socket_session):
+    query = s.query(User).get(user_id).chats.all()
+    return [
+        {
+            "id": i.id,
+            "chat_name": ("、".join([single.userNickname for single in i.users.filter(User.id != user_id).all()])),
+            "recipient": [single.username for single in i.users.filter(User.id != user_id).all()],
+            "recipientId": [single.id for single in i.users.filter(User.id != user_id).all()],
+            "active": socket_session.get(i.users.filter(User.id != user_id).first().id) != None,
+            "avatar": i.users.filter(User.id != user_id).first().avatar,
+            "last_message": i.last_message,
+            "last_message_timestamp": str(i.last_message_timestamp),
+        }
+        for i in query
+    ]
+
+
+def main():
+    common.migrate()
+    redis = common.redis_standin(db=1)
+    presence.socket_session = redis
+    unread_counters.unread_store = common.redis_standin(db=2)
+    s = Session()
+    others = common.seed_users(s, 2000, prefix="member")
+    # a quarter of the members are online
+    for user_id in others[::4]:
+        redis.set(user_id, "sid-%s" % user_id)
+
+    rows = []
+    for size in SIZES:
+        user_id = common.seed_users(s, 1, prefix="owner%d-" % size)[0]
+        # mix of direct chats and small groups
+        common.seed_chats(
+            s, [(user_id, random.sample(others, 1 if n % 3 else 4)) for n in range(size)]
+        )
+
+        with common.count_queries(engine) as legacy_sql:
+            legacy_chat_list(s, user_id, redis)
+        with common.count_queries(engine) as new_sql:
+            chat_list.load_chat_list(s, user_id)
+        legacy = common.median_ms(lambda: legacy_chat_list(s, user_id, redis), repeat=3)
+        new = common.median_ms(lambda: chat_list.load_chat_list(s, user_id))
+        rows.append(
+            (
+                size,
+                "%.1f" % legacy,
+                legacy_sql["statements"],
+                "%.1f" % new,
+                new_sql["statements"],
+                "%.1fx" % (legacy / new),
+            )
+        )
+        s.expunge_all()
+    s.close()
+
+    common.print_table(
+        "LOAD_CHATS build time per connect",
+        ["chats", "before ms", "before SQL", "after ms", "after SQL", "speedup"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
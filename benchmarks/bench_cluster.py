@@ -0,0 +1,139 @@
+import common
+import os, subprocess, sys, threading, time
+
+import requests
+import socketio
+
+"""
+Message throughput of cluster.py with 1, 2 and 4 workers on one machine.
+
+Users are paired into 1:1 chats, every client connects over a websocket through
+the sticky router (so pairs usually land on different workers and deliveries
+cross the message queue), then every sender fires MESSAGES messages and the
+benchmark waits until all of them reached the receiving side.
+
+Needs the requests and python-socketio client packages. Redis is BENCH_REDIS_URL
+or a fakeredis TCP server; fakeredis is single threaded Python, so a real Redis
+gives more representative numbers for 4 workers.
+
+    python benchmarks/bench_cluster.py [users] [messages]
+"""
+
+WORKERS = [1, 2, 4]
+
+
+class ChatClient:
+    def __init__(self, base, username):
+        self.username = username
+        self.http = requests.Session()
+        self.http.post(
+            base + "/api/register",
+            json={
+                "userNickname": username,
+                "username": username,
+                "password": "password",
+                "firstname": "bench",
+                "lastname": "bench",
+                "email": "%s@example.com" % username,
+            },
+        )
+        self.user = self.http.post(
+            base + "/api/login", json={"username": username, "password": "password"}
+        ).json()
+        self.chats = []
+        self.received = 0
+        self.done = threading.Event()
+        self.expected = None
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on("ADD_CHAT", self.on_chat)
+        self.sio.on("ADD_MESSAGE_TO_CHAT", self.on_message)
+        cookie = "; ".join("%s=%s" % item for item in self.http.cookies.items())
+        self.sio.connect(base, headers={"Cookie": cookie}, transports=["websocket"])
+
+    def on_chat(self, data):
+        self.chats.append(data["id"])
+
+    def on_message(self, data):
+        if data["message"]["username"] != self.username:
+            self.received += 1
+            if self.expected is not None and self.received >= self.expected:
+                self.done.set()
+
+    def wait_for_chat(self, timeout=30):
+        deadline = time.time() + timeout
+        while not self.chats and time.time() < deadline:
+            time.sleep(0.01)
+        return self.chats[0]
+
+
+def run(workers, users, messages, redis_url):
+    port = common.free_port()
+    # senders fire every message at once, measure throughput without the rate limits
+    env = dict(
+        os.environ, REDIS_URL=redis_url, SOCKETIO_MESSAGE_QUEUE=redis_url, RATE_LIMITS="0"
+    )
+    cluster = subprocess.Popen(
+        [sys.executable, "cluster.py", "--workers", str(workers), "--port", str(port)],
+        cwd=common.ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for i in range(workers):
+            common.wait_for_port(port + 1 + i, timeout=60)
+        base = "http://127.0.0.1:%d" % port
+        clients = [ChatClient(base, "w%du%d" % (workers, n)) for n in range(users)]
+        senders, receivers = clients[::2], clients[1::2]
+        for sender, receiver in zip(senders, receivers):
+            sender.sio.emit("ADD_CHAT", [receiver.username])
+            sender.wait_for_chat()
+        # let the room joins of the receivers propagate through the queue
+        time.sleep(1)
+
+        for receiver in receivers:
+            receiver.expected = messages
+        start = time.perf_counter()
+        for n in range(messages):
+            for sender in senders:
+                sender.sio.emit("ADD_MESSAGE_TO_CHAT", {"chat": sender.chats[0], "message": "m%d" % n})
+        for receiver in receivers:
+            receiver.done.wait(timeout=120)
+        elapsed = time.perf_counter() - start
+
+        delivered = sum(receiver.received for receiver in receivers)
+        for client in clients:
+            client.sio.disconnect()
+        return delivered, elapsed
+    finally:
+        common.stop_process(cluster)
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    redis_url, redis_process = common.start_redis_server()
+    try:
+        rows = []
+        for workers in WORKERS:
+            delivered, elapsed = run(workers, users, messages, redis_url)
+            rows.append(
+                (
+                    workers,
+                    "%d/%d" % (delivered, users // 2 * messages),
+                    "%.2f" % elapsed,
+                    "%.0f" % (delivered / elapsed),
+                )
+            )
+    finally:
+        common.stop_process(redis_process)
+
+    common.print_table(
+        "%d clients, %d messages per sender (%d cpus)" % (users, messages, os.cpu_count()),
+        ["workers", "delivered", "seconds", "messages/s"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
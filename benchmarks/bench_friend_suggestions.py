@@ -0,0 +1,176 @@
+import common
+import os, random, sys, time
+
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+from sqlalchemy_classes import Friendships, User
+from sqlalchemy_base import Session, engine
+import friend_suggestions
+
+"""
+Friend-of-friend suggestions (see friend_suggestions.py) on a synthetic friendship graph.
+
+USERS users in communities of COMMUNITY, each with about FRIENDS friends, most of
+them in the own community. Reported:
+- the batch rebuild: load of the adjacency list, counting and writing the top
+  TOP_K, ns per counted friend of friend and the time that extrapolates to for
+  1M users with 100 friends each (50M friendships);
+- add_friendship for ACCEPTS new friendships, as FRIEND_REQUEST_ACCEPTED runs it;
+- READS suggestion lists, read from friend_suggestions against counted in SQL on
+  every read.
+
+1M users and 50M friendships don't fit the benchmark's SQLite file in reasonable
+time, the default graph is smaller and the rate is extrapolated:
+
+    python benchmarks/bench_friend_suggestions.py [users] [friends per user]
+"""
+
+USERS = 20000
+FRIENDS = 40
+COMMUNITY = 200
+OUTSIDE = 0.2
+ACCEPTS = 200
+READS = 1000
+TARGET_USERS = 1000000
+TARGET_FRIENDS = 100
+
+
+def seed_graph(s, users, friends):
+    pairs = set()
+    for n in range(users):
+        community = n - n % COMMUNITY
+        for _ in range(friends // 2):
+            if random.random() < OUTSIDE:
+                other = random.randrange(users)
+            else:
+                other = community + random.randrange(min(COMMUNITY, users - community))
+            if other != n:
+                pairs.add((min(n, other), max(n, other)))
+    ids = common.seed_users(s, users, prefix="member")
+    rows = []
+    for a, b in pairs:
+        rows.append({"user_a_id": ids[a], "user_b_id": ids[b]})
+        rows.append({"user_a_id": ids[b], "user_b_id": ids[a]})
+    s.execute(Friendships.__table__.insert(), rows)
+    s.commit()
+    return ids, pairs
+
+
+def rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def suggestions_on_read(s, user_id, k=friend_suggestions.TOP_K):
+    first, second = aliased(Friendships), aliased(Friendships)
+    mutual = func.count().label("mutual")
+    return (
+        s.query(User.id, User.username, User.userNickname, User.avatar, mutual)
+        .select_from(first)
+        .join(second, second.user_a_id == first.user_b_id)
+        .join(User, User.id == second.user_b_id)
+        .filter(
+            first.user_a_id == user_id,
+            second.user_b_id != user_id,
+            second.user_b_id.not_in(friend_suggestions.friends_of(user_id)),
+            User.visible_in_searches == True,
+        )
+        .group_by(User.id)
+        .order_by(mutual.desc(), User.id)
+        .limit(k)
+        .all()
+    )
+
+
+def timed_reads(read, ids):
+    timings = []
+    with common.count_queries(engine) as counter:
+        for user_id in random.sample(ids, READS):
+            s = Session()
+            start = time.perf_counter()
+            read(s, user_id)
+            timings.append((time.perf_counter() - start) * 1000)
+            s.close()
+    return timings, counter["statements"] / READS
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    friends = int(sys.argv[2]) if len(sys.argv) > 2 else FRIENDS
+    random.seed(1)
+    common.migrate()
+    s = Session()
+    ids, pairs = seed_graph(s, users, friends)
+
+    rss = rss_mb()
+    start = time.perf_counter()
+    numbers, adjacency = friend_suggestions.load_adjacency(s)
+    load = time.perf_counter() - start
+    adjacency_mb = rss_mb() - rss
+    start = time.perf_counter()
+    for user in range(len(numbers)):
+        friend_suggestions.top_suggestions(adjacency, user)
+    count = time.perf_counter() - start
+    counted = sum(len(adjacency[f]) for friends_of in adjacency for f in friends_of)
+    del numbers, adjacency
+    start = time.perf_counter()
+    friend_suggestions.rebuild(s)
+    rebuild = time.perf_counter() - start
+    s.close()
+
+    ns = count / counted * 1e9
+    target = TARGET_USERS * TARGET_FRIENDS ** 2 * ns / 1e9
+    common.print_table(
+        "batch rebuild, %d users, %d friendships (%.1f friends per user)"
+        % (users, len(pairs), 2 * len(pairs) / users),
+        ["load s", "adjacency MB", "count s", "rebuild s", "ns / friend of friend", "1M x 100 count, est."],
+        [("%.1f" % load, "%.0f" % adjacency_mb, "%.1f" % count, "%.1f" % rebuild, "%.0f" % ns, "%.1f h" % (target / 3600))],
+    )
+
+    timings = []
+    with common.count_queries(engine) as counter:
+        for _ in range(ACCEPTS):
+            a, b = random.sample(range(users), 2)
+            s = Session()
+            start = time.perf_counter()
+            s.add(Friendships(user_a_id=ids[a], user_b_id=ids[b]))
+            s.add(Friendships(user_a_id=ids[b], user_b_id=ids[a]))
+            friend_suggestions.add_friendship(s, ids[a], ids[b])
+            s.commit()
+            timings.append((time.perf_counter() - start) * 1000)
+            s.close()
+    common.print_table(
+        "add_friendship, %d new friendships" % ACCEPTS,
+        ["p50 ms", "p99 ms", "SQL / friendship"],
+        [
+            (
+                "%.1f" % common.percentile(timings, 50),
+                "%.1f" % common.percentile(timings, 99),
+                "%.1f" % (counter["statements"] / ACCEPTS),
+            )
+        ],
+    )
+
+    rows = []
+    for name, read in (
+        ("counted on read", suggestions_on_read),
+        ("friend_suggestions", friend_suggestions.load_suggestions),
+    ):
+        timings, sql = timed_reads(read, ids)
+        rows.append(
+            (
+                name,
+                "%.2f" % common.percentile(timings, 50),
+                "%.2f" % common.percentile(timings, 99),
+                "%.1f" % sql,
+            )
+        )
+    common.print_table(
+        "%d suggestion lists of %d" % (READS, friend_suggestions.TOP_K),
+        ["read", "p50 ms", "p99 ms", "SQL / read"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import common
+import argparse, json, os, platform, random, subprocess, sys, threading, time
+
+from bench_cluster import ChatClient
+
+"""
+Load generator for server.py.
+
+Starts the server on a throwaway SQLite file and a Redis stand-in (see
+common.start_redis_server), registers and logs in N users through /api/login,
+opens one websocket Socket.IO client per user and pairs the users into 1:1 chats.
+Every client then replays a weighted mix of events for a fixed duration, waiting
+for the server's ack before sending the next one (closed loop).
+
+Reported per event: count, errors (no ack within ACK_TIMEOUT) and p50/p95/p99
+of the time until the ack. ADD_MESSAGE_TO_CHAT also reports delivery latency,
+from the send to the arrival of the message at the other member of the chat.
+The server's RSS is sampled during the run. The report is written as JSON, --compare prints it next to an older one.
+
+    python benchmarks/bench_load.py --users 50 --duration 20 \\
+        --mix ADD_MESSAGE_TO_CHAT=60,LOAD_ACTIVE_CHAT_MESSAGES=25,ADD_CIRCLE=10,FRIEND_REQUEST=5 \\
+        --output load.json --compare previous.json
+"""
+
+DEFAULT_MIX = "ADD_MESSAGE_TO_CHAT=60,LOAD_ACTIVE_CHAT_MESSAGES=25,ADD_CIRCLE=10,FRIEND_REQUEST=5"
+ACK_TIMEOUT = 30
+
+
+class LoadClient(ChatClient):
+    def __init__(self, base, username):
+        self.deliveries = []
+        super().__init__(base, username)
+
+    # message text is the sender's perf_counter, all clients live in this process
+    def on_message(self, data):
+        if data["message"]["username"] != self.username:
+            self.deliveries.append((time.perf_counter() - float(data["message"]["message"])) * 1000)
+
+    def payload(self, event, peers):
+        if event == "ADD_MESSAGE_TO_CHAT":
+            return {"chat": self.chats[0], "message": repr(time.perf_counter())}
+        if event == "LOAD_ACTIVE_CHAT_MESSAGES":
+            return self.chats[0]
+        if event == "ADD_CIRCLE":
+            return {"userId": self.user["id"], "circle": "load test circle"}
+        if event == "FRIEND_REQUEST":
+            return random.choice(peers).user["id"]
+        raise ValueError("%s is not supported by the load generator" % event)
+
+    def replay(self, mix, peers, deadline, think, latencies, errors):
+        events, weights = zip(*mix.items())
+        while time.perf_counter() < deadline:
+            event = random.choices(events, weights)[0]
+            start = time.perf_counter()
+            try:
+                self.sio.call(event, self.payload(event, peers), timeout=ACK_TIMEOUT)
+                latencies[event].append((time.perf_counter() - start) * 1000)
+            except Exception:
+                errors[event] += 1
+            if think:
+                time.sleep(think)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        event, _, weight = part.partition("=")
+        mix[event.strip()] = float(weight or 1)
+    return mix
+
+
+def rss_mb(pid):
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def summary(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(common.percentile(values, 50), 2),
+        "p95_ms": round(common.percentile(values, 95), 2),
+        "p99_ms": round(common.percentile(values, 99), 2),
+    }
+
+
+def run(args, redis_url):
+    port = common.free_port()
+    env = dict(
+        os.environ,
+        HOST="127.0.0.1",
+        PORT=str(port),
+        SERVER_DEBUG="0",
+        REDIS_URL=redis_url,
+        SQL_URL="sqlite:///%s" % os.path.join(common.WORKDIR, "load.sqlite3"),
+        # closed loop without think time, measures the server and not its rate limits
+        RATE_LIMITS="1" if args.rate_limits else "0",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "server.py"],
+        cwd=common.ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        common.wait_for_port(port, timeout=60)
+        base = "http://127.0.0.1:%d" % port
+        clients = [LoadClient(base, "load%d" % n) for n in range(args.users)]
+        for sender, receiver in zip(clients[::2], clients[1::2]):
+            sender.sio.emit("ADD_CHAT", [receiver.username])
+            # the server joins the receiver to the chat room, no need to wait for its ADD_CHAT
+            receiver.chats.append(sender.wait_for_chat())
+
+        rss = {"idle": rss_mb(server.pid), "peak": rss_mb(server.pid)}
+        stop = threading.Event()
+
+        def sample():
+            while not stop.wait(0.5):
+                current = rss_mb(server.pid)
+                if current and current > (rss["peak"] or 0):
+                    rss["peak"] = current
+
+        latencies = {event: [] for event in args.mix}
+        errors = {event: 0 for event in args.mix}
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        deadline = start + args.duration
+        threads = [
+            threading.Thread(
+                target=client.replay,
+                args=(args.mix, clients, deadline, args.think / 1000, latencies, errors),
+            )
+            for client in clients
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        # let the last deliveries arrive
+        time.sleep(1)
+        stop.set()
+        rss["end"] = rss_mb(server.pid)
+
+        for client in clients:
+            client.sio.disconnect()
+    finally:
+        common.stop_process(server)
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        "config": {
+            "users": args.users,
+            "duration_s": args.duration,
+            "think_ms": args.think,
+            "mix": args.mix,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "redis": "BENCH_REDIS_URL" if os.environ.get("BENCH_REDIS_URL") else "fakeredis",
+        },
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "events_per_second": round(completed / elapsed, 1),
+        "events": {
+            event: dict(summary(values), errors=errors[event])
+            for event, values in latencies.items()
+        },
+        "delivery": summary([ms for client in clients for ms in client.deliveries]),
+        "rss_mb": {name: round(value, 1) if value else None for name, value in rss.items()},
+    }
+
+
+def flatten(report):
+    rows = {"events/s": report["events_per_second"]}
+    for event, stats in report["events"].items():
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            rows["%s %s" % (event, key)] = stats[key]
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        rows["delivery %s" % key] = report["delivery"][key]
+    rows["peak rss MB"] = report["rss_mb"]["peak"]
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a mix of Socket.IO events against server.py.")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--think", type=float, default=0, help="ms each client waits between events")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help="EVENT=weight,...")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the server's rate limits on")
+    parser.add_argument("--output", default=os.path.join(common.WORKDIR, "bench_load.json"))
+    parser.add_argument("--compare", help="earlier JSON report to compare with")
+    args = parser.parse_args()
+    if args.users < 2:
+        parser.error("--users needs at least 2 users to pair into chats")
+
+    redis_url, redis_process = common.start_redis_server()
+    try:
+        report = run(args, redis_url)
+    finally:
+        common.stop_process(redis_process)
+
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+
+    current = flatten(report)
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = flatten(json.load(previous_file))
+        rows = [
+            (
+                name,
+                previous.get(name, "-"),
+                value,
+                "%+.1f%%" % ((value - previous[name]) / previous[name] * 100)
+                if previous.get(name) and value is not None
+                else "-",
+            )
+            for name, value in current.items()
+        ]
+        header = ["metric", "previous", "current", "change"]
+    else:
+        rows = list(current.items())
+        header = ["metric", "value"]
+    common.print_table(
+        "%d users, %.0f s (%d cpus)" % (args.users, args.duration, os.cpu_count()), header, rows
+    )
+    print("\nreport written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
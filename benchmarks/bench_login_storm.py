@@ -0,0 +1,82 @@
+import eventlet
+
+eventlet.monkey_patch()
+
+import common
+import hashlib, sys, time
+from binascii import hexlify
+from eventlet.semaphore import Semaphore
+
+import server_helpers
+
+"""
+Login storm: latency seen by an already connected user (a greenthread that wakes up
+every 5ms, standing in for message delivery) while N logins verify their password
+on the same hub. PBKDF2 inline on the hub (the old hash_password) against the
+thread pool offload with different HASH_CONCURRENCY limits.
+
+    python benchmarks/bench_login_storm.py [logins]
+"""
+
+TICK = 0.005
+
+
+def inline_verify(pw, pw2):
+    salt = pw2[:128].encode("ascii")
+    pwdhash = hexlify(hashlib.pbkdf2_hmac("sha512", pw.encode("utf-8"), salt, 100000))
+    return (salt + pwdhash).decode("ascii") == pw2
+
+
+def storm(verify, logins, stored):
+    lateness, running = [], [True]
+
+    def connected_user():
+        while running[0]:
+            start = time.perf_counter()
+            eventlet.sleep(TICK)
+            lateness.append((time.perf_counter() - start - TICK) * 1000)
+
+    ticker = eventlet.spawn(connected_user)
+    eventlet.sleep(TICK * 4)
+    start = time.perf_counter()
+    pool = eventlet.GreenPool(logins)
+    results = list(pool.imap(lambda _: verify("password", stored), range(logins)))
+    elapsed = time.perf_counter() - start
+    running[0] = False
+    ticker.wait()
+    assert all(results)
+    return elapsed, lateness
+
+
+def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    stored = server_helpers.hash_password("password")
+
+    modes = [("inline on hub", None, inline_verify)]
+    for limit in (1, 2, 4):
+        modes.append(("tpool, concurrency %d" % limit, limit, server_helpers.verify_password))
+
+    rows = []
+    for name, limit, verify in modes:
+        if limit:
+            server_helpers.hash_slots = Semaphore(limit)
+        elapsed, lateness = storm(verify, logins, stored)
+        rows.append(
+            (
+                name,
+                "%.2f" % elapsed,
+                "%.1f" % common.percentile(lateness, 50),
+                "%.1f" % common.percentile(lateness, 99),
+                "%.1f" % max(lateness),
+            )
+        )
+
+    common.print_table(
+        "%d concurrent logins, latency of a connected user's events" % logins,
+        ["mode", "storm s", "p50 ms", "p99 ms", "max ms"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
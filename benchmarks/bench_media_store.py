@@ -0,0 +1,98 @@
+import eventlet
+
+eventlet.monkey_patch()
+
+import common
+import os, time, uuid
+
+import sqlalchemy_classes
+from sqlalchemy_classes import Message
+from sqlalchemy_base import Session
+import media_store
+
+"""
+Media uploads: the old image_handler (a new uuid file per upload, written on the hub)
+against the content addressed store. The workload forwards each of 20 distinct
+images to 50 chats, then garbage-collects after half of the messages are deleted.
+
+    python benchmarks/bench_media_store.py
+"""
+
+DISTINCT_IMAGES = 20
+FORWARDS = 50
+IMAGE_SIZE = 200 * 1024
+
+
+def legacy_image_handler(image, extension, media_dir):
+    fileName = f"{str(uuid.uuid4())}.{extension}"
+    newFile = open(f"{media_dir}/{fileName}", "wb")
+    newFile.write(bytes(image))
+    newFile.close()
+    return "/static/media/%s" % fileName
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def run(upload, images):
+    latencies, urls = [], []
+    for image in images:
+        for _ in range(FORWARDS):
+            start = time.perf_counter()
+            urls.append(upload(image))
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, urls
+
+
+def main():
+    common.migrate()
+    images = [os.urandom(IMAGE_SIZE) for _ in range(DISTINCT_IMAGES)]
+
+    legacy_dir = os.path.join(common.WORKDIR, "legacy-media")
+    os.makedirs(legacy_dir)
+    legacy_latency, _ = run(lambda image: legacy_image_handler(image, "png", legacy_dir), images)
+
+    media_store.MEDIA_DIR = os.path.join(common.WORKDIR, "media")
+    store_latency, urls = run(lambda image: media_store.image_handler(image, "png"), images)
+
+    rows = []
+    for name, latency, path in (
+        ("uuid file per upload", legacy_latency, legacy_dir),
+        ("content addressed", store_latency, media_store.MEDIA_DIR),
+    ):
+        rows.append(
+            (
+                name,
+                len(os.listdir(path)),
+                "%.1f" % (dir_size(path) / 1024 / 1024),
+                "%.2f" % common.percentile(latency, 50),
+                "%.2f" % common.percentile(latency, 99),
+            )
+        )
+    common.print_table(
+        "%d images x %d forwards of %d KB" % (DISTINCT_IMAGES, FORWARDS, IMAGE_SIZE // 1024),
+        ["store", "files", "disk MB", "upload p50 ms", "upload p99 ms"],
+        rows,
+    )
+
+    # reference the first half of the images from messages, the rest was deleted
+    s = Session()
+    referenced = urls[: len(urls) // 2]
+    for url in referenced:
+        m = Message("bench", "bench")
+        m.image = url
+        s.add(m)
+    s.commit()
+    media_store.GC_GRACE_SECONDS = 0
+    start = time.perf_counter()
+    removed, freed = media_store.collect_garbage(s)
+    print(
+        "\ngc: removed %d unreferenced blobs, freed %.1f MB in %.1f ms, %d blobs kept"
+        % (removed, freed / 1024 / 1024, (time.perf_counter() - start) * 1000, len(os.listdir(media_store.MEDIA_DIR)))
+    )
+    s.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import common
+import sys
+from datetime import datetime, timedelta
+from uuid import uuid4
+from sqlalchemy import text
+
+import sqlalchemy_classes
+from sqlalchemy_classes import Message
+from sqlalchemy_base import Session, engine
+import message_history
+
+"""
+Message history page latency as a chat grows, for the latest page (LOAD_ACTIVE_CHAT_MESSAGES)
+and for a page deep in the history (LOAD_OLDER_MESSAGES from a cursor halfway back).
+Another chat of the same size is stored alongside so the table is twice the chat size.
+
+    python benchmarks/bench_message_history.py [sizes...]
+"""
+
+SIZES = [1000, 10000, 100000, 1000000]
+BATCH = 50000
+
+
+def grow_chat(s, chat_ids, start, count):
+    base = datetime(2020, 1, 1)
+    for offset in range(start, start + count, BATCH):
+        rows = []
+        for n in range(offset, min(offset + BATCH, start + count)):
+            for chat_id in chat_ids:
+                rows.append(
+                    {
+                        "id": str(uuid4()),
+                        "message": "message %d" % n,
+                        "created_at": base + timedelta(milliseconds=n),
+                        "chat_id": chat_id,
+                        "username": "bench",
+                        "userNickname": "bench",
+                    }
+                )
+        s.execute(Message.__table__.insert(), rows)
+        s.commit()
+
+
+def main():
+    common.migrate()
+    sizes = [int(x) for x in sys.argv[1:]] or SIZES
+    chat_id, other_chat = str(uuid4()), str(uuid4())
+    s = Session()
+
+    rows, current = [], 0
+    for size in sizes:
+        grow_chat(s, [chat_id, other_chat], current, size - current)
+        current = size
+
+        middle = (
+            s.query(Message)
+            .filter(Message.chat_id == chat_id)
+            .order_by(Message.created_at.desc(), Message.id.desc())
+            .offset(size // 2)
+            .first()
+        )
+        cursor = message_history.encode_cursor(middle)
+        with common.count_queries(engine) as sql:
+            message_history.load_messages(s, chat_id)
+        latest = common.median_ms(lambda: message_history.load_messages(s, chat_id), repeat=20)
+        deep = common.median_ms(lambda: message_history.load_messages(s, chat_id, cursor), repeat=20)
+        rows.append((size, "%.2f" % latest, "%.2f" % deep, sql["statements"]))
+        s.expunge_all()
+
+    plan = s.execute(
+        text(
+            "EXPLAIN QUERY PLAN SELECT id FROM messages WHERE chat_id = :c "
+            "ORDER BY created_at DESC, id DESC LIMIT 51"
+        ),
+        {"c": chat_id},
+    ).fetchall()
+    s.close()
+
+    common.print_table(
+        "Message history page latency (page size %d)" % message_history.PAGE_SIZE,
+        ["messages in chat", "latest page ms", "deep page ms", "SQL per page"],
+        rows,
+    )
+    print("\nquery plan: %s" % "; ".join(str(row[-1]) for row in plan))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import common
+import random, sys, time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import and_, func
+
+import sqlalchemy_classes
+from sqlalchemy_classes import Message, UsersChats
+from sqlalchemy_base import Session, engine
+import message_search
+
+"""
+SEARCH_MESSAGES over a large history: LIKE '%q%' over the messages of the caller's
+chats (what the search would be without an index) against the FTS5 index.
+
+"LIKE newest" stops at the first page of newest matches, which is cheap for common
+words but scans the caller's whole history for rare ones. "LIKE all" reads every
+match, which is what ranking them needs. The FTS5 search ranks with bm25 and reads
+only the posting lists of the caller's chats.
+
+The request asked for 10M messages, building that takes a while, so the default is
+1M, pass the size to go bigger:
+
+    python benchmarks/bench_message_search.py [messages]
+"""
+
+MESSAGES = 1000000
+USERS = 2000
+CHATS = 5000
+BATCH = 20000
+
+WORDS_CN = ["火锅", "今天", "明天", "开会", "项目", "周末", "电影", "吃饭", "上班", "下班",
+            "天气", "旅行", "音乐", "朋友", "学习", "考试", "工作", "晚上", "咖啡", "地铁"]
+WORDS_EN = ["hello", "meeting", "tomorrow", "lunch", "project", "deadline", "coffee",
+            "weekend", "movie", "release", "deploy", "review", "python", "sqlite"]
+# rare words, a handful of occurrences in the whole history
+RARE = ["量子纠缠", "zanzibar"]
+
+
+def sentence(rnd):
+    words = [rnd.choice(WORDS_CN if rnd.random() < 0.6 else WORDS_EN) for _ in range(rnd.randint(3, 10))]
+    if rnd.random() < 0.00002:
+        words.append(rnd.choice(RARE))
+    return " ".join(words) if rnd.random() < 0.5 else "".join(words)
+
+
+def seed(s, total):
+    rnd = random.Random(7)
+    users = common.seed_users(s, USERS)
+    chats = common.seed_chats(
+        s, [(rnd.choice(users), rnd.sample(users, rnd.randint(1, 4))) for _ in range(CHATS)]
+    )
+    start = datetime.utcnow() - timedelta(days=365)
+    build = 0.0
+    for begin in range(0, total, BATCH):
+        rows = [
+            {
+                "id": str(uuid4()),
+                "message": sentence(rnd),
+                "created_at": start + timedelta(seconds=n * 3),
+                "read_at": None,
+                "chat_id": rnd.choice(chats),
+                "username": "user%d" % (n % USERS),
+                "userNickname": "user %d" % (n % USERS),
+                "image": None,
+            }
+            for n in range(begin, min(total, begin + BATCH))
+        ]
+        s.execute(Message.__table__.insert(), rows)
+        clock = time.perf_counter()
+        message_search.index_messages(s.connection(), rows)
+        build += time.perf_counter() - clock
+        s.commit()
+    return users, build
+
+
+def like_search(s, query, user_id, limit=None):
+    my_chats = s.query(UsersChats.chat_id).filter(UsersChats.user_id == user_id)
+    found = (
+        s.query(Message.id, Message.message)
+        .filter(
+            Message.chat_id.in_(my_chats.scalar_subquery()),
+            and_(*[Message.message.like("%%%s%%" % word) for word in query.split()]),
+        )
+        .order_by(Message.created_at.desc())
+    )
+    return found.limit(limit).all() if limit else found.all()
+
+
+def main():
+    common.migrate()
+    total = int(sys.argv[1]) if sys.argv[1:] else MESSAGES
+    s = Session()
+    users, build = seed(s, total)
+
+    # the user in the most chats
+    user_id = (
+        s.query(UsersChats.user_id)
+        .group_by(UsersChats.user_id)
+        .order_by(func.count().desc())
+        .first()
+        .user_id
+    )
+    chats = s.query(UsersChats).filter(UsersChats.user_id == user_id).count()
+
+    rows = []
+    for query in ["火锅", "火", "吃饭 coffee", "deplo", "量子纠缠", "zanzibar"]:
+        fts = common.median_ms(lambda: message_search.search_messages(s, query, user_id))
+        newest = common.median_ms(
+            lambda: like_search(s, query, user_id, message_search.PAGE_SIZE + 1), repeat=3
+        )
+        like = common.median_ms(lambda: like_search(s, query, user_id), repeat=3)
+        matches = len(like_search(s, query, user_id))
+        rows.append(
+            (query, matches, "%.1f" % newest, "%.1f" % like, "%.1f" % fts, "%.1fx" % (like / fts))
+        )
+
+    common.print_table(
+        "%d messages, user in %d chats (index built at %.0f messages/s)"
+        % (total, chats, total / build),
+        ["query", "matches", "LIKE newest ms", "LIKE all ms", "FTS5 ms", "vs LIKE all"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
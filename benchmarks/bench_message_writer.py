@@ -0,0 +1,101 @@
+import eventlet
+
+eventlet.monkey_patch()
+
+import common
+import os, sys, time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import sqlalchemy_classes
+from sqlalchemy_classes import Base, Chat, Message
+from sqlalchemy_base import Session, engine
+import message_writer
+import unread_counters
+
+"""
+ADD_MESSAGE_TO_CHAT write path under 1 to 500 concurrent senders: a session and a
+commit per message on a rollback-journal database (the old handler) against the
+group commit writer on WAL. Each sender waits for its message to be committed
+before sending the next one, like a client waiting for its ack.
+
+    python benchmarks/bench_message_writer.py [senders...]
+"""
+
+SENDERS = [1, 10, 100, 500]
+CHATS = 50
+MESSAGES_PER_LEVEL = 2000
+
+
+def legacy_send(LegacySession, chat_id):
+    s = LegacySession()
+    try:
+        chat = s.query(Chat).get(chat_id)
+        m = Message("bench", "bench")
+        m.message = "hello"
+        chat.last_message = "hello..."
+        chat.messages.append(m)
+        chat.last_message_timestamp = m.created_at
+        s.commit()
+    finally:
+        s.close()
+
+
+def writer_send(writer, chat_id):
+    m = Message("bench", "bench")
+    m.message = "hello"
+    writer.write(message_writer.message_row(m, chat_id), "hello...")
+
+
+def run(send, chats, senders):
+    per_sender = max(5, MESSAGES_PER_LEVEL // senders)
+
+    def sender(n):
+        for _ in range(per_sender):
+            send(chats[n % len(chats)])
+
+    pool = eventlet.GreenPool(senders)
+    start = time.perf_counter()
+    for n in range(senders):
+        pool.spawn(sender, n)
+    pool.waitall()
+    return senders * per_sender / (time.perf_counter() - start)
+
+
+def main():
+    common.migrate()
+    unread_counters.unread_store = common.redis_standin(db=2)
+    levels = [int(x) for x in sys.argv[1:]] or SENDERS
+
+    legacy_engine = create_engine("sqlite:///%s" % os.path.join(common.WORKDIR, "legacy.sqlite3"))
+    Base.metadata.create_all(legacy_engine)
+    LegacySession = sessionmaker(bind=legacy_engine)
+
+    rows = []
+    for Maker in (LegacySession, Session):
+        s = Maker()
+        user_id = common.seed_users(s, 1)[0]
+        chats = common.seed_chats(s, [(user_id, []) for _ in range(CHATS)])
+        s.close()
+        rows.append(chats)
+    legacy_chats, chats = rows
+
+    writer = message_writer.MessageWriter(engine)
+    results = []
+    for senders in levels:
+        legacy = run(lambda chat: legacy_send(LegacySession, chat), legacy_chats, senders)
+        batches = writer.batches
+        grouped = run(lambda chat: writer_send(writer, chat), chats, senders)
+        per_batch = max(5, MESSAGES_PER_LEVEL // senders) * senders / max(1, writer.batches - batches)
+        results.append((senders, "%.0f" % legacy, "%.0f" % grouped, "%.1f" % per_batch))
+
+    common.print_table(
+        "Durable messages/s (flush interval %.0f ms)" % (writer.flush_interval * 1000),
+        ["senders", "commit per message", "group commit (WAL)", "messages/commit"],
+        results,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import common
+import random, time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import flask
+from socketio import packet
+
+import payloads
+from archive import ArchivedMessage
+from message_history import serialize_message
+
+"""
+Event payloads as JSON text (Flask's JSON provider, as Flask-SocketIO uses it) against
+the MessagePack mode of payloads.py, for a bootstrap (LOAD_CHATS, LOAD_FRIENDS,
+LOAD_NOTIFICATIONS), a page of messages, message deliveries and an image upload.
+Encode time is the whole Socket.IO packet, bytes are what goes on the wire (the text
+frame plus any binary attachment frames).
+
+Images are uploaded by the old client as a JSON array of byte values, both modes can
+send them as raw bytes in a binary attachment instead. Uploads are measured by the time
+the server takes to decode the packet into handler arguments.
+
+    python benchmarks/bench_payloads.py
+"""
+
+CHATS = 300
+FRIENDS = 500
+PAGE = 50
+IMAGE_BYTES = 200 * 1024
+REPEAT = 50
+# decoded as the MessagePack client it stands for, see payloads.unpack_args
+BENCH_SID = "bench-msgpack"
+payloads.binary_sids.add(BENCH_SID)
+
+WORDS = ["你好", "今天", "吃饭", "了吗", "周末", "一起", "火锅", "deploy", "meeting", "ok", "lol", "coffee"]
+
+
+def text(n):
+    return " ".join(random.choice(WORDS) for _ in range(n))
+
+
+def member(n):
+    return {
+        "id": str(uuid4()),
+        "username": "user%d" % n,
+        "userNickname": "用户 %d" % n,
+        "avatar": "/static/media/%s.png" % uuid4().hex,
+    }
+
+
+def bootstrap():
+    now = datetime.utcnow()
+    chats = []
+    for n in range(CHATS):
+        others = [member(n * 4 + i) for i in range(1 if n % 3 else 4)]
+        chats.append(
+            {
+                "id": str(uuid4()),
+                "chat_name": "、".join(i["userNickname"] for i in others),
+                "recipient": [i["username"] for i in others],
+                "recipientId": [i["id"] for i in others],
+                "active": n % 4 == 0,
+                "avatar": others[0]["avatar"],
+                "last_message": text(3)[:16] + "...",
+                "last_message_timestamp": str(now - timedelta(minutes=n)),
+                "unread": n % 7,
+            }
+        )
+    friends = [dict(member(n), active=n % 4 == 0) for n in range(FRIENDS)]
+    notices = [
+        {
+            "id": str(uuid4()),
+            "sender": "user%d" % n,
+            "type": "FRIEND_REQUEST",
+            "dismissed": n % 2 == 0,
+            "message": "用户 %d sent you a friend request" % n,
+            "avatar": None,
+            "timestamp": str(now - timedelta(hours=n)),
+        }
+        for n in range(20)
+    ]
+    return [("LOAD_CHATS", chats), ("LOAD_FRIENDS", friends), ("LOAD_NOTIFICATIONS", (notices, None, 10))]
+
+
+def message(n, now):
+    return ArchivedMessage(
+        id=str(uuid4()),
+        message=text(random.randint(2, 12)),
+        created_at=now - timedelta(seconds=n),
+        read_at=None,
+        chat_id=None,
+        username="user%d" % (n % 2),
+        userNickname="用户 %d" % (n % 2),
+        image=None,
+    )
+
+
+def message_traffic():
+    now = datetime.utcnow()
+    page = ([serialize_message(message(n, now)) for n in range(PAGE)], "cursor|%s" % uuid4())
+    deliveries = [
+        (
+            "ADD_MESSAGE_TO_CHAT",
+            {
+                "chatId": str(uuid4()),
+                "last_message": "...",
+                "last_message_timestamp": str(now)[:5],
+                "message": {
+                    key: value
+                    for key, value in serialize_message(message(n, now)).items()
+                    if key != "timestamp"
+                },
+            },
+        )
+        for n in range(20)
+    ]
+    return [("LOAD_ACTIVE_CHAT_MESSAGES", page)] + deliveries
+
+
+"""
+Encodes one emit the way python-socketio does, returns (seconds, bytes on the wire).
+"""
+
+
+def encode(event, data, binary):
+    start = time.perf_counter()
+    if binary:
+        args = [payloads.pack(list(data) if isinstance(data, tuple) else data)]
+    else:
+        args = list(data) if isinstance(data, tuple) else [data]
+    encoded = packet.Packet(packet.EVENT, data=[event] + args).encode()
+    elapsed = time.perf_counter() - start
+    frames = encoded if isinstance(encoded, list) else [encoded]
+    size = sum(len(f.encode("utf-8")) if isinstance(f, str) else len(f) for f in frames)
+    return elapsed, size
+
+
+def decode(frames, binary):
+    start = time.perf_counter()
+    pkt = packet.Packet(encoded_packet=frames[0])
+    for attachment in frames[1:]:
+        pkt.add_attachment(attachment)
+    args = pkt.data[1:]
+    if binary:
+        args = payloads.unpack_args(BENCH_SID, args)
+    bytes(args[0]["image"])
+    return time.perf_counter() - start
+
+
+def measure_upload(data, binary):
+    args = [payloads.pack(data)] if binary else [data]
+    encoded = packet.Packet(packet.EVENT, data=["ADD_MESSAGE_TO_CHAT"] + args).encode()
+    frames = encoded if isinstance(encoded, list) else [encoded]
+    size = sum(len(f.encode("utf-8")) if isinstance(f, str) else len(f) for f in frames)
+    timings = [decode(frames, binary) for _ in range(REPEAT)]
+    return common.percentile(timings, 50) * 1000, size
+
+
+def measure(emits, binary):
+    sizes = sum(encode(event, data, binary)[1] for event, data in emits)
+    timings = []
+    for _ in range(REPEAT):
+        timings.append(sum(encode(event, data, binary)[0] for event, data in emits))
+    return common.percentile(timings, 50) * 1000, sizes
+
+
+def main():
+    if payloads.msgpack is None:
+        print("msgpack is not installed")
+        return
+    app = flask.Flask(__name__)
+    # Flask-SocketIO hands python-socketio Flask's json module
+    packet.Packet.json = flask.json
+    image = bytes(random.getrandbits(8) for _ in range(IMAGE_BYTES))
+    upload = {"chat": str(uuid4()), "image": list(image), "extension": "png"}
+    upload_raw = dict(upload, image=image)
+
+    rows = []
+    with app.app_context():
+        for name, emits in (
+            ("bootstrap (%d chats, %d friends)" % (CHATS, FRIENDS), bootstrap()),
+            ("message page + 20 deliveries", message_traffic()),
+        ):
+            json_ms, json_bytes = measure(emits, False)
+            pack_ms, pack_bytes = measure(emits, True)
+            rows.append(
+                (
+                    name,
+                    json_bytes,
+                    "%.2f" % json_ms,
+                    pack_bytes,
+                    "%.2f" % pack_ms,
+                    "%.0f%%" % (100 - pack_bytes * 100 / json_bytes),
+                )
+            )
+        uploads = [
+            ("JSON array of byte values", upload, False),
+            ("raw bytes, JSON mode", upload_raw, False),
+            ("raw bytes, MessagePack", upload_raw, True),
+        ]
+        upload_rows = []
+        for name, data, binary in uploads:
+            ms, size = measure_upload(data, binary)
+            upload_rows.append((name, size, "%.2f" % ms))
+
+    common.print_table(
+        "Socket.IO packet encoding, JSON text against binary payloads",
+        ["traffic", "JSON bytes", "JSON ms", "binary bytes", "binary ms", "saved"],
+        rows,
+    )
+    common.print_table(
+        "%d KB image upload, decoded by the server" % (IMAGE_BYTES // 1024),
+        ["upload", "bytes", "decode ms"],
+        upload_rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
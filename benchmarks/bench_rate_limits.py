@@ -0,0 +1,226 @@
+import common
+import os, random, subprocess, sys, threading, time
+
+from bench_cluster import ChatClient
+
+"""
+Well-behaved clients while one client floods, on server.py without and with the rate
+limits (see rate_limits.py).
+
+CLIENTS users paired into 1:1 chats run a closed loop of ADD_MESSAGE_TO_CHAT and
+LOAD_ACTIVE_CHAT_MESSAGES, THINK_MS apart, for DURATION seconds. Reported per phase:
+p50/p95/p99 of the time until their ack. The flooder sends LOAD_USERS (SEEDED users
+to load), ACCOUNT_UPDATE with a new AVATAR_KB avatar and ADD_MESSAGE_TO_CHAT, FLOOD_RATE
+a second without waiting for acks. Reported for it: events sent and events answered
+with RATE_LIMITED.
+
+The flooder runs in its own process (the script started with --flood), so decoding
+its replies doesn't hold up the measured clients. The server runs in the benchmark's
+work directory, so the uploaded avatars stay out of client/build.
+
+    python benchmarks/bench_rate_limits.py
+"""
+
+CLIENTS = 10
+THINK_MS = 200
+DURATION = 10
+SEEDED = 5000
+AVATAR_KB = 16
+FLOOD_RATE = 200
+FLOOD_EVENTS = ["LOAD_USERS", "ACCOUNT_UPDATE", "ADD_MESSAGE_TO_CHAT"]
+
+
+class Flooder(ChatClient):
+    def __init__(self, base, username):
+        super().__init__(base, username)
+        self.rejected = 0
+        self.sent = 0
+        self.avatar = random.getrandbits(AVATAR_KB * 8192).to_bytes(AVATAR_KB * 1024, "little")
+        self.sio.on("RATE_LIMITED", self.on_rate_limited)
+
+    def on_rate_limited(self, data):
+        self.rejected += 1
+
+    def payload(self, event):
+        if event == "LOAD_USERS":
+            return None
+        if event == "ACCOUNT_UPDATE":
+            # a new file every time, the media store keeps one copy of equal uploads
+            avatar = self.sent.to_bytes(8, "little") + self.avatar
+            return {"update": "avatar", "value": avatar, "extension": "png"}
+        return {"chat": self.chats[0], "message": "flood"}
+
+    def flood(self, deadline):
+        start = time.perf_counter()
+        while time.perf_counter() < deadline:
+            event = random.choice(FLOOD_EVENTS)
+            self.sio.emit(event, self.payload(event))
+            self.sent += 1
+            time.sleep(max(0, start + self.sent / FLOOD_RATE - time.perf_counter()))
+
+
+def loop(client, deadline, latencies):
+    while time.perf_counter() < deadline:
+        if random.random() < 0.5:
+            event, data = "ADD_MESSAGE_TO_CHAT", {"chat": client.chats[0], "message": "hi"}
+        else:
+            event, data = "LOAD_ACTIVE_CHAT_MESSAGES", client.chats[0]
+        start = time.perf_counter()
+        try:
+            client.sio.call(event, data, timeout=30)
+            latencies.append((time.perf_counter() - start) * 1000)
+        except Exception:
+            latencies.append(30000)
+        time.sleep(THINK_MS / 1000)
+
+
+def pair(clients):
+    for sender, receiver in zip(clients[::2], clients[1::2]):
+        sender.sio.emit("ADD_CHAT", [receiver.username])
+        receiver.chats.append(sender.wait_for_chat())
+
+
+"""
+The flooder process: pairs the flooder with a target, says ready, floods for DURATION
+seconds once it reads a line and prints "<sent> <rejected>".
+"""
+
+
+def flood_process(base, prefix):
+    flooder = Flooder(base, prefix + "flooder")
+    pair([flooder, ChatClient(base, prefix + "target")])
+    print("ready", flush=True)
+    sys.stdin.readline()
+    flooder.flood(time.perf_counter() + DURATION)
+    # let the last replies arrive
+    time.sleep(1)
+    print(flooder.sent, flooder.rejected, flush=True)
+    flooder.sio.disconnect()
+
+
+def cpu_seconds(process):
+    with open("/proc/%d/stat" % process.pid) as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def phase(server, clients, flooder=None):
+    cpu = cpu_seconds(server)
+    flooder_cpu = cpu_seconds(flooder) if flooder else 0
+    deadline = time.perf_counter() + DURATION
+    if flooder:
+        flooder.stdin.write("go\n")
+        flooder.stdin.flush()
+    latencies = []
+    threads = [threading.Thread(target=loop, args=(c, deadline, latencies)) for c in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server_cpu = cpu_seconds(server) - cpu
+    if not flooder:
+        return latencies, server_cpu, None
+    sent, rejected = flooder.stdout.readline().split()
+    return latencies, server_cpu, (sent, rejected, cpu_seconds(flooder) - flooder_cpu)
+
+
+def run(redis_url, limits):
+    port = common.free_port()
+    env = dict(
+        os.environ,
+        HOST="127.0.0.1",
+        PORT=str(port),
+        SERVER_DEBUG="0",
+        REDIS_URL=redis_url,
+        RATE_LIMITS=limits,
+    )
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(common.ROOT, "server.py")],
+        cwd=common.WORKDIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    flooder = None
+    results = []
+    try:
+        common.wait_for_port(port, timeout=60)
+        base = "http://127.0.0.1:%d" % port
+        prefix = "limits%s_" % limits
+        clients = [ChatClient(base, "%s%d" % (prefix, n)) for n in range(CLIENTS)]
+        pair(clients)
+        flooder = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--flood", base, prefix],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        flooder.stdout.readline()
+
+        if limits == "1":
+            results.append(("no flood",) + phase(server, clients))
+        results.append(("flood, RATE_LIMITS=%s" % limits,) + phase(server, clients, flooder))
+        # let the server drain the flood before it is stopped
+        time.sleep(1)
+        for client in clients:
+            client.sio.disconnect()
+    finally:
+        if flooder:
+            common.stop_process(flooder)
+        common.stop_process(server)
+    return results
+
+
+def main():
+    common.migrate()
+    from sqlalchemy_base import Session
+
+    s = Session()
+    common.seed_users(s, SEEDED, prefix="seeded")
+    s.close()
+
+    redis_url, redis_process = common.start_redis_server()
+    try:
+        results = run(redis_url, "1") + run(redis_url, "0")
+    finally:
+        common.stop_process(redis_process)
+
+    rows = []
+    for name, latencies, server_cpu, flood in results:
+        rows.append(
+            (
+                name,
+                len(latencies),
+                "%.1f" % common.percentile(latencies, 50),
+                "%.1f" % common.percentile(latencies, 95),
+                "%.1f" % common.percentile(latencies, 99),
+                "%.1f" % server_cpu,
+                flood[0] if flood else "-",
+                flood[1] if flood else "-",
+                "%.1f" % flood[2] if flood else "-",
+            )
+        )
+    common.print_table(
+        "%d clients, %d ms think time, %d s per phase, one flooder at %d events/s"
+        % (CLIENTS, THINK_MS, DURATION, FLOOD_RATE),
+        [
+            "phase",
+            "acks",
+            "p50 ms",
+            "p95 ms",
+            "p99 ms",
+            "server CPU s",
+            "flood sent",
+            "RATE_LIMITED",
+            "flooder CPU s",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--flood"]:
+        flood_process(*sys.argv[2:4])
+    else:
+        main()
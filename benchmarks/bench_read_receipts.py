@@ -0,0 +1,126 @@
+import eventlet
+
+eventlet.monkey_patch()
+
+import common
+import sys, time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import sqlalchemy_classes
+from sqlalchemy_classes import Message
+from sqlalchemy_base import Session, engine
+from read_receipts import ReadReceipts, readable_message
+import unread_counters
+
+"""
+A group of MEMBERS users where everyone opens the chat at once and marks it read.
+
+Per event (the obvious way to use Message.read_at): update the read_at of every
+unread message up to the one read and emit a READ_RECEIPT to the room right away.
+Batched: one watermark per member, written in a single transaction per flush
+interval, and one READ_RECEIPT per room. "deliveries" is emits times room size,
+the number of packets the Socket.IO server has to send out.
+
+    python benchmarks/bench_read_receipts.py [members]
+"""
+
+MEMBERS = 500
+MESSAGES = 200
+
+
+def seed(members):
+    s = Session()
+    users = common.seed_users(s, members)
+    chat_id = common.seed_chats(s, [(users[0], users[1:])])[0]
+    start = datetime.utcnow() - timedelta(hours=1)
+    rows = [
+        {
+            "id": str(uuid4()),
+            "message": "hello %d" % n,
+            "created_at": start + timedelta(seconds=n),
+            "read_at": None,
+            "chat_id": chat_id,
+            "username": "user%d" % (n % members),
+            "userNickname": "user %d" % (n % members),
+            "image": None,
+        }
+        for n in range(MESSAGES)
+    ]
+    s.execute(Message.__table__.insert(), rows)
+    s.commit()
+    s.close()
+    return users, chat_id, rows[-1]["id"]
+
+
+def per_event_read(emits, user_id, chat_id, message_id):
+    s = Session()
+    try:
+        message = readable_message(s, user_id, chat_id, message_id)
+        s.query(Message).filter(
+            Message.chat_id == chat_id,
+            Message.created_at <= message.created_at,
+            Message.read_at == None,
+        ).update({Message.read_at: datetime.utcnow()}, synchronize_session=False)
+        s.commit()
+        emits.append(chat_id)
+    finally:
+        s.close()
+
+
+def batched_read(receipts, user_id, chat_id, message_id):
+    s = Session()
+    try:
+        message = readable_message(s, user_id, chat_id, message_id)
+        receipts.mark_read(user_id, chat_id, message.id, message.created_at)
+    finally:
+        s.close()
+
+
+def run(read, users, chat_id, message_id, settle=None):
+    pool = eventlet.GreenPool(len(users))
+    with common.count_queries(engine) as counter:
+        start = time.perf_counter()
+        for user_id in users:
+            pool.spawn(read, user_id, chat_id, message_id)
+        pool.waitall()
+        if settle:
+            settle()
+        elapsed = (time.perf_counter() - start) * 1000
+    return elapsed, counter["statements"]
+
+
+def main():
+    common.migrate()
+    unread_counters.unread_store = common.redis_standin(db=2)
+    members = int(sys.argv[1]) if sys.argv[1:] else MEMBERS
+    users, chat_id, last_id = seed(members)
+
+    emits = []
+    elapsed, statements = run(
+        lambda *args: per_event_read(emits, *args), users, chat_id, last_id
+    )
+    results = [("per event", "%.0f" % elapsed, statements, len(emits), len(emits) * members)]
+
+    batched = []
+    receipts = ReadReceipts(engine, lambda chat, payload: batched.append(payload))
+
+    def settle():
+        receipts.thread.wait()
+
+    elapsed, statements = run(
+        lambda *args: batched_read(receipts, *args), users, chat_id, last_id, settle
+    )
+    results.append(("batched", "%.0f" % elapsed, statements, len(batched), len(batched) * members))
+    assert sum(len(payload["reads"]) for payload in batched) == members
+
+    common.print_table(
+        "%d members read the latest of %d messages at once (flush interval %.0f ms)"
+        % (members, MESSAGES, receipts.flush_interval * 1000),
+        ["read path", "ms (incl. flush)", "SQL statements", "emits", "deliveries"],
+        results,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import common
+import json, time
+
+import server_helpers
+
+"""
+Per-event auth overhead: Flask-Login's user_loader plus the disconnect_unauthorised
+check, as two Redis GETs (the old path) against the in-process session cache.
+Redis round trips are counted on the client, with fakeredis they cost no network
+time, so on a real deployment add one RTT per round trip to the "before" column.
+
+    python benchmarks/bench_session_cache.py
+"""
+
+EVENTS = 20000
+USERS = 1000
+
+
+class CountingRedis:
+    def __init__(self, client):
+        self.client = client
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            return attr(*args, **kwargs)
+
+        return call
+
+
+def legacy_event(sessionId):
+    session = server_helpers.logon_session.get(sessionId)
+    user = json.loads(session)
+    server_helpers.FlaskLoginUser(user[0], user[1], user[2], sessionId, user[3])
+    return server_helpers.logon_session.get(sessionId)
+
+
+def cached_event(sessionId):
+    server_helpers.user_loader(sessionId)
+    return server_helpers.get_session(sessionId)
+
+
+def run(event, sessions):
+    server_helpers.logon_session.calls = 0
+    start = time.perf_counter()
+    for n in range(EVENTS):
+        event(sessions[n % len(sessions)])
+    elapsed = time.perf_counter() - start
+    return elapsed / EVENTS * 1e6, server_helpers.logon_session.calls / EVENTS
+
+
+def main():
+    server_helpers.logon_session = CountingRedis(common.redis_standin(db=0))
+    sessions = []
+    for n in range(USERS):
+        sessionId = "session-%d" % n
+        server_helpers.logon_session.set(sessionId, json.dumps(["user%d" % n, "nick", "id%d" % n, None]))
+        sessions.append(sessionId)
+
+    rows = []
+    for name, event in (("redis GET x2", legacy_event), ("session cache", cached_event)):
+        server_helpers.session_cache.clear()
+        us, calls = run(event, sessions)
+        rows.append((name, "%.1f" % us, "%.3f" % calls))
+
+    common.print_table(
+        "Auth overhead per socket event (%d events over %d sessions)" % (EVENTS, USERS),
+        ["path", "us/event", "redis calls/event"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
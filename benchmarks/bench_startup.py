@@ -0,0 +1,94 @@
+import common
+import argparse, json, os, statistics, subprocess, sys, time
+from urllib.request import urlopen
+
+"""
+Cold start of a server worker: the time from spawning `python server.py` to the first
+accepted Socket.IO handshake (an Engine.IO polling open request answered with 200),
+for a fresh database, an existing one, and a worker started with MIGRATE_ON_START=0
+the way cluster.py starts them after running migrate.py once.
+
+Meant to be tracked in CI, --max-ms makes the run fail when the median of a mode goes
+over the budget and --output writes the results as JSON.
+
+    python benchmarks/bench_startup.py --runs 5 --max-ms 3000 --output startup.json
+"""
+
+HANDSHAKE = "/socket.io/?EIO=4&transport=polling"
+
+
+def start(env, timeout=60):
+    port = common.free_port()
+    env = dict(env, HOST="127.0.0.1", PORT=str(port), SERVER_DEBUG="0")
+    begin = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "server.py"],
+        cwd=common.ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = begin + timeout
+        while time.perf_counter() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError("server.py exited with %d" % server.returncode)
+            try:
+                with urlopen("http://127.0.0.1:%d%s" % (port, HANDSHAKE), timeout=1) as response:
+                    if response.status == 200:
+                        return (time.perf_counter() - begin) * 1000
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError("no handshake within %d s" % timeout)
+    finally:
+        common.stop_process(server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time from spawning server.py to its first handshake.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, help="fail when a median is over this budget")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    redis_url, redis_process = common.start_redis_server()
+    base = dict(os.environ, REDIS_URL=redis_url)
+    existing = "sqlite:///%s" % os.path.join(common.WORKDIR, "startup.sqlite3")
+    modes = [
+        ("fresh database", lambda n: dict(base, SQL_URL="sqlite:///%s" % os.path.join(common.WORKDIR, "fresh%d.sqlite3" % n))),
+        ("existing database", lambda n: dict(base, SQL_URL=existing)),
+        ("MIGRATE_ON_START=0", lambda n: dict(base, SQL_URL=existing, MIGRATE_ON_START="0")),
+    ]
+    results = {}
+    try:
+        # creates the existing database's schema
+        start(dict(base, SQL_URL=existing))
+        for name, env in modes:
+            results[name] = [start(env(n)) for n in range(args.runs)]
+    finally:
+        common.stop_process(redis_process)
+
+    rows = [
+        (name, "%.0f" % statistics.median(timings), "%.0f" % min(timings), "%.0f" % max(timings))
+        for name, timings in results.items()
+    ]
+    common.print_table(
+        "spawn to first Socket.IO handshake (%d runs)" % args.runs,
+        ["mode", "median ms", "min ms", "max ms"],
+        rows,
+    )
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(
+                {name: {"median_ms": statistics.median(t), "runs_ms": t} for name, t in results.items()},
+                output,
+                indent=2,
+            )
+    over = [name for name, t in results.items() if args.max_ms and statistics.median(t) > args.max_ms]
+    if over:
+        print("over the %.0f ms budget: %s" % (args.max_ms, ", ".join(over)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import eventlet
+
+eventlet.monkey_patch()
+
+import common
+import json, random, time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import server_helpers
+
+# every module that talks to Redis imports its client from server_helpers
+server_helpers.logon_session = common.redis_standin(db=0)
+server_helpers.socket_session = common.redis_standin(db=1)
+server_helpers.unread_store = common.redis_standin(db=2)
+
+import server
+import sync
+from sqlalchemy_classes import Chat, Circle, Friendships, Notice
+from sqlalchemy_base import Session
+from metrics import handler_metrics
+
+"""
+Cost of a reconnect: the full bootstrap (LOAD_CHATS, LOAD_FRIENDS, LOAD_NOTIFICATIONS,
+LOAD_CIRCLES) every connect used to send, against the delta SYNC of a client that
+sends the cursor of its last sync. Measured per connect: bytes of Socket.IO payload
+sent to the client, SQL statements, Redis round trips and wall time.
+
+The user has FRIENDS friends, CHATS chats and a full notification and circle page.
+Between the connects a few chats get messages, a notice arrives, one is dismissed and
+two friends post circles.
+
+    python benchmarks/bench_sync.py
+"""
+
+FRIENDS = 500
+CHATS = 300
+NOTICES = 40
+CIRCLES = 500
+REPEAT = 5
+
+
+def seed(s, user_id):
+    old = datetime.utcnow() - timedelta(days=1)
+    friends = common.seed_users(s, FRIENDS, prefix="friend")
+    s.execute(
+        Friendships.__table__.insert(),
+        [
+            {"user_a_id": a, "user_b_id": b, "created_at": old}
+            for friend in friends
+            for a, b in ((user_id, friend), (friend, user_id))
+        ],
+    )
+    chats = common.seed_chats(
+        s, [(user_id, random.sample(friends, 1 if n % 3 else 4)) for n in range(CHATS)]
+    )
+    s.query(Chat).update({Chat.last_message_timestamp: old, Chat.created_at: old})
+    s.execute(
+        Notice.__table__.insert(),
+        [
+            {
+                "id": str(uuid4()),
+                "recipient": user_id,
+                "type": "FRIEND_REQUEST_ACCEPTED",
+                "sender": "friend%d" % n,
+                "senderNickname": "friend %d" % n,
+                "timestamp": old + timedelta(seconds=n),
+                "dismissed": n % 2 == 0,
+                "message": "friend %d accepted your friend request." % n,
+            }
+            for n in range(NOTICES)
+        ],
+    )
+    s.execute(
+        Circle.__table__.insert(),
+        [
+            {
+                "id": str(uuid4()),
+                "content": "circle %d" % n,
+                "created_at": old + timedelta(seconds=n),
+                "userNickname": "friend %d" % (n % FRIENDS),
+                "user_id": friends[n % FRIENDS],
+            }
+            for n in range(CIRCLES)
+        ],
+    )
+    s.commit()
+    return friends, chats
+
+
+"""
+The changes a client misses while its connection flaps.
+"""
+
+
+def activity(s, user_id, friends, chats):
+    now = datetime.utcnow()
+    for chat_id in random.sample(chats, 3):
+        s.query(Chat).filter(Chat.id == chat_id).update(
+            {Chat.last_message: "new message...", Chat.last_message_timestamp: now}
+        )
+    notice = Notice("ERROR", "System", "System", "new notice")
+    notice.recipient = user_id
+    s.add(notice)
+    dismissed = s.query(Notice).filter(Notice.recipient == user_id, Notice.dismissed == False).first()
+    dismissed.dismissed = True
+    sync.record_change(s, user_id, "notice", dismissed.id)
+    for friend in random.sample(friends, 2):
+        circle = Circle("friend", friend)
+        circle.content = "new circle"
+        s.add(circle)
+    s.commit()
+
+
+def totals():
+    stats = handler_metrics.handlers.values()
+    return sum(i.sql for i in stats), sum(i.redis for i in stats)
+
+
+def connect(flask_client, auth=None):
+    sql, redis = totals()
+    start = time.perf_counter()
+    client = server.socket.test_client(server.app, flask_test_client=flask_client, auth=auth)
+    received = client.get_received()
+    elapsed = (time.perf_counter() - start) * 1000
+    client.disconnect()
+    after_sql, after_redis = totals()
+    size = sum(
+        len(json.dumps([i["name"]] + i["args"], separators=(",", ":"), default=str).encode("utf-8"))
+        for i in received
+    )
+    cursor = [i["args"][0]["cursor"] for i in received if i["name"] == "SYNC"][0]
+    return {
+        "events": len(received),
+        "bytes": size,
+        "sql": after_sql - sql,
+        "redis": after_redis - redis,
+        "ms": elapsed,
+        "cursor": cursor,
+    }
+
+
+def main():
+    common.migrate()
+    flask_client = server.app.test_client()
+    account = dict(
+        userNickname="owner", username="owner", password="pw", firstname="a", lastname="b", email="e"
+    )
+    flask_client.post("/api/register", json=account)
+    user_id = flask_client.post("/api/login", json=account).get_json()["id"]
+
+    s = Session()
+    friends, chats = seed(s, user_id)
+
+    runs = {"full bootstrap": [], "delta, nothing changed": [], "delta, after activity": []}
+    for _ in range(REPEAT):
+        # deltas repeat the last SYNC_OVERLAP seconds, start every round with a quiet window
+        time.sleep(sync.OVERLAP + 0.1)
+        full = connect(flask_client)
+        runs["full bootstrap"].append(full)
+        time.sleep(sync.OVERLAP + 0.1)
+        unchanged = connect(flask_client, {"since": full["cursor"]})
+        runs["delta, nothing changed"].append(unchanged)
+        activity(s, user_id, friends, chats)
+        runs["delta, after activity"].append(connect(flask_client, {"since": unchanged["cursor"]}))
+    s.close()
+
+    rows = []
+    for name, results in runs.items():
+        last = results[-1]
+        rows.append(
+            (
+                name,
+                last["events"],
+                last["bytes"],
+                last["sql"],
+                last["redis"],
+                "%.1f" % common.percentile([i["ms"] for i in results], 50),
+            )
+        )
+    common.print_table(
+        "connect of a user with %d friends, %d chats (median of %d)" % (FRIENDS, CHATS, REPEAT),
+        ["connect", "events", "bytes", "SQL", "Redis", "ms"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
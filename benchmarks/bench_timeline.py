@@ -0,0 +1,127 @@
+import common
+from datetime import datetime, timedelta
+from uuid import uuid4
+from sqlalchemy import desc, func
+
+import sqlalchemy_classes
+from sqlalchemy_classes import User, Circle, Friendships, UsersCircles
+from sqlalchemy_base import Session, engine
+import timeline
+
+"""
+Circle write/read cost for a user with 10, 1k and 10k friends: fan-out-on-write
+(one users_circles row per friend, the old handle_new_circle) against the
+fan-out-on-read timeline, with and without the hot timeline cache.
+
+    python benchmarks/bench_timeline.py
+"""
+
+SIZES = [10, 1000, 10000]
+POSTS_PER_FRIEND = 3
+
+
+def legacy_publish(s, user_id, content):
+    user = s.query(User).get(user_id)
+    circle = Circle(user.userNickname, user.id)
+    circle.content = content
+    user.circles.append(circle)
+    for friend in user.friends:
+        friend.circles.append(circle)
+    s.commit()
+
+
+def legacy_feed(s, user_id):
+    return s.query(User).get(user_id).circles.order_by(desc(Circle.created_at)).limit(10).all()
+
+
+def seed_friends(s, user_id, size):
+    friends = common.seed_users(s, size, prefix="friend%d-" % size)
+    s.execute(
+        Friendships.__table__.insert(),
+        [{"user_a_id": user_id, "user_b_id": f} for f in friends]
+        + [{"user_a_id": f, "user_b_id": user_id} for f in friends],
+    )
+    # every friend has a few older posts, visible to the user the old way too
+    base = datetime(2020, 1, 1)
+    circles = [
+        {
+            "id": str(uuid4()),
+            "content": "post",
+            "created_at": base + timedelta(seconds=n * POSTS_PER_FRIEND + k),
+            "userNickname": "friend",
+            "user_id": f,
+        }
+        for n, f in enumerate(friends)
+        for k in range(POSTS_PER_FRIEND)
+    ]
+    s.execute(Circle.__table__.insert(), circles)
+    s.execute(
+        UsersCircles.__table__.insert(),
+        [{"user_id": user_id, "circle_id": c["id"]} for c in circles],
+    )
+    s.commit()
+
+
+def fanout_rows(s):
+    return s.query(func.count()).select_from(UsersCircles).scalar()
+
+
+def main():
+    common.migrate()
+    s = Session()
+    rows = []
+    for size in SIZES:
+        user_id = common.seed_users(s, 1, prefix="author%d-" % size)[0]
+        seed_friends(s, user_id, size)
+        user = s.query(User).get(user_id)
+
+        before = fanout_rows(s)
+        legacy_write = common.median_ms(lambda: legacy_publish(s, user_id, "hello"), repeat=3)
+        legacy_rows = (fanout_rows(s) - before) // 3
+        legacy_read = common.median_ms(lambda: legacy_feed(s, user_id))
+
+        friends = timeline.friend_ids(s, user_id)
+        before = fanout_rows(s)
+        new_write = common.median_ms(lambda: timeline.publish_circle(s, user, "hello", friends), repeat=3)
+        new_rows = (fanout_rows(s) - before) // 3
+
+        timeline.hot_timelines.capacity = 0
+        new_read = common.median_ms(lambda: timeline.load_timeline(s, user_id))
+        timeline.hot_timelines.capacity = 1000
+        timeline.load_timeline(s, user_id)
+        cached_read = common.median_ms(lambda: timeline.load_timeline(s, user_id))
+        timeline.hot_timelines.invalidate(user_id)
+
+        rows.append(
+            (
+                size,
+                "%.1f" % legacy_write,
+                legacy_rows,
+                "%.1f" % new_write,
+                new_rows,
+                "%.2f" % legacy_read,
+                "%.2f" % new_read,
+                "%.3f" % cached_read,
+            )
+        )
+        s.expunge_all()
+    s.close()
+
+    common.print_table(
+        "Circle write and feed read cost",
+        [
+            "friends",
+            "fan-out write ms",
+            "rows/post",
+            "timeline write ms",
+            "rows/post",
+            "fan-out read ms",
+            "timeline read ms",
+            "cached read ms",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import eventlet
+
+eventlet.monkey_patch()
+
+import common
+import random, sys, time
+
+import server_helpers
+
+# every module that talks to Redis imports its client from server_helpers
+server_helpers.logon_session = common.redis_standin(db=0)
+server_helpers.socket_session = common.redis_standin(db=1)
+server_helpers.unread_store = common.redis_standin(db=2)
+
+import server
+from sqlalchemy_base import Session
+from metrics import handler_metrics
+from typing_indicators import TypingIndicators
+
+"""
+Cost of typing indicators.
+
+Handler: PAIRS chats of two connected clients, one client of each sends KEYSTROKES
+TYPING events HANDLER_KEYSTROKE_MS apart and a stop. TYPING (typing_indicators.py) against the naive handler on the existing
+pattern, disconnect_unauthorised and one TYPING emit to the room per keystroke, with
+and without the session cache. Measured per keystroke: handler time, SQL statements,
+Redis round trips and the TYPING packets the other client receives.
+
+Scale: USERS sids typing in USERS / 2 chats for SECONDS, each one sending a TYPING
+every KEYSTROKE_MS while it types and a stop when it pauses. Measured: CPU spent in
+TYPING updates and in the interval flushes, room broadcasts, Redis round trips.
+
+    python benchmarks/bench_typing.py [users]
+"""
+
+PAIRS = 10
+KEYSTROKES = 100
+HANDLER_KEYSTROKE_MS = 20
+USERS = 10000
+SECONDS = 10
+KEYSTROKE_MS = 200
+TYPE_SECONDS = 3
+PAUSE_SECONDS = 2
+
+
+@server.socket.on("TYPING_NAIVE")
+@server_helpers.disconnect_unauthorised
+def naive_typing(data=None):
+    server.emitter.emit(
+        "TYPING",
+        {"chatId": data["chat"], "typing": [{"id": server.current_user.user_id}], "stopped": []},
+        room=data["chat"],
+    )
+
+
+def totals():
+    stats = handler_metrics.handlers.values()
+    return sum(i.sql for i in stats), sum(i.redis for i in stats)
+
+
+def connect_pairs():
+    users = []
+    for n in range(PAIRS * 2):
+        flask_client = server.app.test_client()
+        account = dict(
+            userNickname="typist %d" % n,
+            username="typist%d" % n,
+            password="pw",
+            firstname="a",
+            lastname="b",
+            email="e",
+        )
+        flask_client.post("/api/register", json=account)
+        user_id = flask_client.post("/api/login", json=account).get_json()["id"]
+        users.append((flask_client, user_id))
+    s = Session()
+    chats = common.seed_chats(s, [(users[n][1], [users[n + 1][1]]) for n in range(0, PAIRS * 2, 2)])
+    s.close()
+    # connecting joins the rooms of the seeded chats
+    clients = [server.socket.test_client(server.app, flask_test_client=c) for c, _ in users]
+    for client in clients:
+        client.get_received()
+    return chats, clients
+
+
+def measure_handler(event, chats, clients, cache=True):
+    server.typing_indicators.interval = 0.2
+    server_helpers.session_cache.capacity = server_helpers.SESSION_CACHE_SIZE if cache else 0
+    server_helpers.session_cache.clear()
+    key = ("socket", event)
+    before = handler_metrics.stats(key)
+    calls, latency, sql, redis = before.calls, before.latency_sum, before.sql, before.redis
+    for _ in range(KEYSTROKES):
+        for n, chat_id in enumerate(chats):
+            clients[n * 2].emit(event, {"chat": chat_id, "typing": True})
+        eventlet.sleep(HANDLER_KEYSTROKE_MS / 1000)
+    for n, chat_id in enumerate(chats):
+        clients[n * 2].emit(event, {"chat": chat_id, "typing": False})
+    # let the last interval flush
+    eventlet.sleep(0.5)
+    received = sum(
+        1 for n in range(len(chats)) for i in clients[n * 2 + 1].get_received() if i["name"] == "TYPING"
+    )
+    for client in clients:
+        client.get_received()
+    stats = handler_metrics.stats(key)
+    events = stats.calls - calls
+    return (
+        events,
+        "%.1f" % ((stats.latency_sum - latency) / events * 1e6),
+        "%.2f" % ((stats.sql - sql) / events),
+        "%.2f" % ((stats.redis - redis) / events),
+        received,
+    )
+
+
+"""
+USERS sids in pairs per chat, each one types for TYPE_SECONDS and pauses for
+PAUSE_SECONDS from a random offset, so typing starts and stops all the time.
+"""
+
+
+def measure_scale(users):
+    broadcasts = []
+    indicators = TypingIndicators(lambda chat_id, payload: broadcasts.append(chat_id))
+    flush = {"seconds": 0.0, "runs": 0}
+    run = indicators.run
+
+    def timed_run():
+        start = time.process_time()
+        run()
+        flush["seconds"] += time.process_time() - start
+        flush["runs"] += 1
+
+    indicators.run = timed_run
+
+    sids = [
+        (
+            "sid%d" % n,
+            {"id": "user%d" % n, "username": "user%d" % n, "userNickname": "user %d" % n},
+            "chat%d" % (n // 2),
+            random.uniform(0, TYPE_SECONDS + PAUSE_SECONDS),
+        )
+        for n in range(users)
+    ]
+    period = TYPE_SECONDS + PAUSE_SECONDS
+    tick = KEYSTROKE_MS / 1000
+    sql, redis = totals()
+    events, update_seconds, peak = 0, 0.0, 0
+    begin = time.perf_counter()
+    last = {}
+    while time.perf_counter() - begin < SECONDS:
+        now = time.perf_counter() - begin
+        batch = []
+        for sid, user, chat_id, offset in sids:
+            typing = (now + offset) % period < TYPE_SECONDS
+            # keystrokes while typing, one stop when the pause starts
+            if typing or last.get(sid):
+                batch.append((sid, user, chat_id, typing))
+            last[sid] = typing
+        start = time.process_time()
+        for args in batch:
+            indicators.update(*args)
+        update_seconds += time.process_time() - start
+        events += len(batch)
+        peak = max(peak, sum(len(i) for i in indicators.typing.values()))
+        eventlet.sleep(max(0, tick - (time.perf_counter() - begin - now)))
+    wall = time.perf_counter() - begin
+    after_sql, after_redis = totals()
+    return [
+        ("TYPING events", events),
+        ("TYPING events / s", "%.0f" % (events / wall)),
+        ("room broadcasts", len(broadcasts)),
+        ("broadcasts / s", "%.0f" % (len(broadcasts) / wall)),
+        ("sids typing at peak", peak),
+        ("update us / event", "%.2f" % (update_seconds / events * 1e6)),
+        ("flush ms / interval", "%.2f" % (flush["seconds"] / max(flush["runs"], 1) * 1000)),
+        ("CPU % of one core", "%.1f" % ((update_seconds + flush["seconds"]) / wall * 100)),
+        ("SQL statements", after_sql - sql),
+        ("Redis round trips", after_redis - redis),
+    ]
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    common.migrate()
+    chats, clients = connect_pairs()
+
+    rows = [
+        ("TYPING",) + measure_handler("TYPING", chats, clients),
+        ("naive, session cache",) + measure_handler("TYPING_NAIVE", chats, clients),
+        ("naive, no session cache",) + measure_handler("TYPING_NAIVE", chats, clients, cache=False),
+    ]
+    common.print_table(
+        "%d chats, %d keystrokes %d ms apart per typist, interval 200 ms"
+        % (PAIRS, KEYSTROKES, HANDLER_KEYSTROKE_MS),
+        ["handler", "events", "us / event", "SQL / event", "Redis / event", "TYPING received"],
+        rows,
+    )
+    common.print_table(
+        "%d sids typing in %d chats for %d s, a TYPING every %d ms, interval %d ms"
+        % (users, users // 2, SECONDS, KEYSTROKE_MS, TypingIndicators(None).interval * 1000),
+        ["", "value"],
+        measure_scale(users),
+    )
+
+
+if __name__ == "__main__":
+    main()
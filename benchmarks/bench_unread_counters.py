@@ -0,0 +1,89 @@
+import common
+import sys, time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import sqlalchemy_classes
+from sqlalchemy_classes import Message
+from sqlalchemy_base import Session, engine
+import unread_counters
+
+"""
+Unread counts for LOAD_CHATS of a user with 50 chats as the message log grows:
+counting unread messages with COUNT(*) (what the client would need without
+counters) against the HGETALL of the user's counters. The counters are built by
+the consistency checker, which is timed as well.
+
+    python benchmarks/bench_unread_counters.py [messages per chat...]
+"""
+
+CHATS = 50
+MESSAGES_PER_CHAT = [10, 100, 1000]
+
+
+def add_messages(s, chats, sender, count, start):
+    rows = [
+        {
+            "id": str(uuid4()),
+            "message": "hello",
+            "created_at": start + timedelta(milliseconds=n),
+            "read_at": None,
+            "chat_id": chat_id,
+            "username": sender,
+            "userNickname": sender,
+            "image": None,
+        }
+        for chat_id in chats
+        for n in range(count)
+    ]
+    for begin in range(0, len(rows), 50000):
+        s.execute(Message.__table__.insert(), rows[begin : begin + 50000])
+    s.commit()
+
+
+def main():
+    common.migrate()
+    levels = [int(x) for x in sys.argv[1:]] or MESSAGES_PER_CHAT
+    unread_counters.unread_store = common.redis_standin(db=2)
+
+    s = Session()
+    reader, sender = common.seed_users(s, 2, prefix="unread")
+    chats = common.seed_chats(s, [(sender, [reader]) for _ in range(CHATS)])
+
+    results, stored, start = [], 0, datetime.utcnow()
+    for per_chat in levels:
+        add_messages(s, chats, "unread1", per_chat - stored, start + timedelta(hours=len(results)))
+        stored = per_chat
+
+        fix_start = time.perf_counter()
+        unread_counters.check(s, fix=True)
+        check_ms = (time.perf_counter() - fix_start) * 1000
+
+        counted = dict(
+            (chat_id, count)
+            for _, chat_id, count in s.execute(unread_counters.count_unread(user_ids=[reader]))
+        )
+        assert counted == unread_counters.load_unread(reader)
+
+        count_ms = common.median_ms(
+            lambda: s.execute(unread_counters.count_unread(user_ids=[reader])).all()
+        )
+        counter_ms = common.median_ms(lambda: unread_counters.load_unread(reader))
+        results.append(
+            (
+                CHATS * per_chat,
+                "%.2f" % count_ms,
+                "%.2f" % counter_ms,
+                "%.0f" % check_ms,
+            )
+        )
+
+    common.print_table(
+        "Unread counts for a user with %d chats" % CHATS,
+        ["messages", "COUNT(*) ms", "counters ms", "check --fix ms"],
+        results,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import common
+import json, random, sys
+from datetime import datetime
+from uuid import uuid4
+
+import sqlalchemy_classes
+from sqlalchemy_classes import User
+from sqlalchemy_base import Session
+import user_search
+
+"""
+SEARCH_USERS against the old LOAD_USERS dump (every visible user sent to the client,
+which then filters locally), for 10k, 100k and 1M users with pinyin usernames and
+CJK nicknames.
+
+    python benchmarks/bench_user_search.py [sizes...]
+"""
+
+SIZES = [10000, 100000, 1000000]
+SYLLABLES = ["zhang", "wang", "li", "zhao", "chen", "liu", "yang", "huang", "wu", "zhou", "xu", "sun", "ma", "hu", "guo", "lin", "he", "gao", "luo", "zheng"]
+HANZI = "张王李赵陈刘杨黄吴周徐孙马胡郭林何高罗郑伟芳娜敏静丽强磊军洋勇艳杰娟涛明超秀霞平刚桂英华"
+QUERIES = ["zh", "wang", "ngli", "张", "华", "李明", "zhouxu", "nobody"]
+
+
+def add_users(s, start, count):
+    rng = random.Random(start)
+    now = datetime.utcnow()
+    for offset in range(start, start + count, 50000):
+        rows = []
+        for n in range(offset, min(offset + 50000, start + count)):
+            username = "".join(rng.choice(SYLLABLES) for _ in range(2)) + str(n)
+            rows.append(
+                {
+                    "id": str(uuid4()),
+                    "username": username,
+                    "userNickname": "".join(rng.choice(HANZI) for _ in range(rng.randint(2, 3))),
+                    "password": "x",
+                    "firstname": "bench",
+                    "lastname": "bench",
+                    "email": "%s@example.com" % username,
+                    "created_at": now,
+                    "updated_on": now,
+                    "visible_in_searches": n % 10 != 0,
+                    "avatar": None,
+                }
+            )
+        s.execute(User.__table__.insert(), rows)
+        s.execute(
+            sqlalchemy_classes.UserSearchTerm.__table__.insert(),
+            [t for r in rows for t in user_search.search_terms(r["id"], r["username"], r["userNickname"])],
+        )
+        s.commit()
+
+
+def legacy_dump(s):
+    query = s.query(User).filter(User.visible_in_searches == True, User.id != "me").all()
+    return json.dumps(
+        [{"id": i.id, "username": i.username, "userNickname": i.userNickname, "avatar": i.avatar} for i in query]
+    )
+
+
+def main():
+    common.migrate()
+    sizes = [int(x) for x in sys.argv[1:]] or SIZES
+    s = Session()
+    rows, current = [], 0
+    for size in sizes:
+        add_users(s, current, size - current)
+        current = size
+
+        dump_ms = common.median_ms(lambda: legacy_dump(s), repeat=1)
+        dump_kb = len(legacy_dump(s)) / 1024
+        s.expunge_all()
+
+        timings, payload = [], 0
+        for q in QUERIES:
+            timings.append(common.median_ms(lambda: user_search.search_users(s, q, "me")))
+            payload = max(payload, len(json.dumps(user_search.search_users(s, q, "me")[0])))
+        users, cursor = user_search.search_users(s, "zh", "me")
+        deep_ms = common.median_ms(lambda: user_search.search_users(s, "zh", "me", cursor))
+
+        rows.append(
+            (
+                size,
+                "%.0f" % dump_ms,
+                "%.0f" % dump_kb,
+                "%.2f" % common.percentile(timings, 50),
+                "%.2f" % max(timings),
+                "%.2f" % deep_ms,
+                "%.1f" % (payload / 1024),
+            )
+        )
+    s.close()
+
+    common.print_table(
+        "User search, top %d per query over %d queries" % (user_search.PAGE_SIZE, len(QUERIES)),
+        ["users", "LOAD_USERS ms", "LOAD_USERS KB", "search p50 ms", "search max ms", "next page ms", "search KB"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
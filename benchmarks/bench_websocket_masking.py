@@ -0,0 +1,58 @@
+import common
+import os
+
+import eventlet
+from eventlet.websocket import RFC6455WebSocket
+
+import websocket_masking
+
+"""
+Unmasking of incoming websocket frames, eventlet's RFC6455WebSocket._apply_mask against
+websocket_masking.apply_mask, for frames from a chat message to an image upload. The
+hub is blocked for the whole unmasking of a frame. Also reports whether the installed
+eventlet passes the check patch_websocket_masking runs before it replaces the method
+(WEBSOCKET_MASK_PATCH=1).
+
+    python benchmarks/bench_websocket_masking.py
+"""
+
+FRAMES = [
+    ("chat message", 200),
+    ("2 KB", 2 * 1024),
+    ("64 KB", 64 * 1024),
+    ("200 KB image", 200 * 1024),
+    ("1 MB image", 1024 * 1024),
+]
+MASK = b"\x12\x34\x56\x78"
+REPEAT = 5
+
+
+def main():
+    original = RFC6455WebSocket._apply_mask
+    rows = []
+    for name, size in FRAMES:
+        frame = os.urandom(size)
+        assert original(frame, MASK, size, 0) == websocket_masking.apply_mask(frame, MASK, size, 0)
+        eventlet_ms = common.median_ms(lambda: original(frame, MASK, size, 0), REPEAT)
+        patched_ms = common.median_ms(
+            lambda: websocket_masking.apply_mask(frame, MASK, size, 0), REPEAT
+        )
+        rows.append(
+            (
+                name,
+                size,
+                "%.3f" % eventlet_ms,
+                "%.3f" % patched_ms,
+                "%.0fx" % (eventlet_ms / max(patched_ms, 1e-6)),
+            )
+        )
+    common.print_table(
+        "websocket frame unmasking, eventlet %s (patch applies: %s)"
+        % (eventlet.__version__, websocket_masking.compatible(original)),
+        ["frame", "bytes", "eventlet ms", "apply_mask ms", "speedup"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import os, sys, tempfile, time, statistics
+from contextlib import contextmanager
+
+"""
+Shared setup for the benchmark scripts.
+
+Every script is run from the repository root, e.g. `python benchmarks/bench_chat_list.py`.
+Importing this module points SQL_URL at a throwaway SQLite file (unless one is set already)
+so the models never touch foo.sqlite3, and puts the repository root on sys.path. Benchmarks
+that use the models in process call migrate() first.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+WORKDIR = tempfile.mkdtemp(prefix="onlinechat-bench-")
+os.environ.setdefault("SQL_URL", "sqlite:///%s" % os.path.join(WORKDIR, "bench.sqlite3"))
+
+
+"""
+Creates the schema of the benchmark database (the models no longer do it on import, see
+migrate.py). Benchmarks that start server.py get theirs from the server.
+"""
+
+
+def migrate():
+    from migrate import migrate
+    from sqlalchemy_base import engine
+
+    migrate(engine)
+
+
+"""
+Returns a Redis client for the given db, fakeredis is used when installed,
+otherwise BENCH_REDIS_URL (default local redis) is used.
+"""
+
+_fake_server = None
+
+
+def redis_standin(db=0):
+    global _fake_server
+    try:
+        import fakeredis
+
+        if _fake_server is None:
+            _fake_server = fakeredis.FakeServer()
+        return fakeredis.FakeRedis(server=_fake_server, db=db, decode_responses=True)
+    except ImportError:
+        import redis
+
+        url = os.environ.get("BENCH_REDIS_URL", "redis://127.0.0.1:6379")
+        return redis.Redis.from_url(url, db=db, decode_responses=True)
+
+
+"""
+Counts the SQL statements issued on the engine inside the with block.
+"""
+
+
+@contextmanager
+def count_queries(engine):
+    from sqlalchemy import event
+
+    counter = {"statements": 0}
+
+    def before_cursor_execute(*args):
+        counter["statements"] += 1
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+"""
+Runs fn `repeat` times and returns the median wall time in milliseconds.
+"""
+
+
+def median_ms(fn, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def print_table(title, header, rows):
+    print("\n%s" % title)
+    widths = [max(len(str(x)) for x in col) for col in zip(header, *rows)]
+    line = "  ".join("%%-%ds" % w for w in widths)
+    print(line % tuple(header))
+    print(line % tuple("-" * w for w in widths))
+    for row in rows:
+        print(line % tuple(row))
+
+
+"""
+Bulk inserts n users without going through User.__init__ (which runs PBKDF2),
+returns the list of user ids.
+"""
+
+
+def seed_users(s, n, prefix="user"):
+    from datetime import datetime
+    from uuid import uuid4
+    from sqlalchemy_classes import User
+
+    now = datetime.utcnow()
+    rows = [
+        {
+            "id": str(uuid4()),
+            "username": "%s%d" % (prefix, i),
+            "userNickname": "%s %d" % (prefix, i),
+            "password": "x",
+            "firstname": "bench",
+            "lastname": "bench",
+            "email": "%s%d@example.com" % (prefix, i),
+            "created_at": now,
+            "updated_on": now,
+            "visible_in_searches": True,
+            "avatar": "/static/media/%s%d.png" % (prefix, i),
+        }
+        for i in range(n)
+    ]
+    s.execute(User.__table__.insert(), rows)
+    s.commit()
+    return [row["id"] for row in rows]
+
+
+"""
+Bulk inserts one chat per (creator, members) pair, returns the list of chat ids.
+"""
+
+
+def seed_chats(s, chats):
+    from datetime import datetime, timedelta
+    from uuid import uuid4
+    from sqlalchemy_classes import Chat, UsersChats
+
+    now = datetime.utcnow()
+    chat_rows, member_rows = [], []
+    for n, (creator, members) in enumerate(chats):
+        chat_id = str(uuid4())
+        chat_rows.append(
+            {
+                "id": chat_id,
+                "chatname": "chat %d" % n,
+                "createrID": creator,
+                "created_at": now,
+                "last_message": "hello %d..." % n,
+                "last_message_timestamp": now - timedelta(seconds=n),
+            }
+        )
+        member_rows += [{"user_id": m, "chat_id": chat_id} for m in {creator, *members}]
+    s.execute(Chat.__table__.insert(), chat_rows)
+    s.execute(UsersChats.__table__.insert(), member_rows)
+    s.commit()
+    return [row["id"] for row in chat_rows]
+
+
+def free_port():
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    import socket
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("nothing listening on port %d" % port)
+
+
+"""
+Returns (redis url, process) for the benchmarks that run the real server: BENCH_REDIS_URL
+when set (process is None), otherwise a fakeredis TCP server started in a subprocess.
+"""
+
+
+def start_redis_server():
+    import subprocess
+
+    if os.environ.get("BENCH_REDIS_URL"):
+        return os.environ["BENCH_REDIS_URL"], None
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "from fakeredis import TcpFakeServer; "
+            "TcpFakeServer(('127.0.0.1', %d), server_type='redis').serve_forever()" % port,
+        ]
+    )
+    wait_for_port(port)
+    return "redis://127.0.0.1:%d" % port, process
+
+
+def stop_process(process):
+    if process is not None and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except Exception:
+            process.kill()
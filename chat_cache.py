@@ -0,0 +1,96 @@
+import os
+import eventlet, redis
+from sqlalchemy_classes import Chat, UsersChats
+from server_helpers import SessionCache, logon_session
+
+"""
+In-process cache of chat metadata and members for the message hot path.
+
+ADD_MESSAGE_TO_CHAT used to query the chat for every message just to see that it
+exists, and never checked that the sender is a member. chat_members() answers both
+from an LRU of CHAT_CACHE_SIZE chats (the same one as the session cache), a miss loads
+the chat and its member ids in one query. Unknown chats are not cached, so a chat
+created by another process is found as soon as it is committed.
+
+Entries live for CHAT_CACHE_TTL seconds. A change of membership calls invalidate_chat,
+which evicts the chat here and, through CHAT_INVALIDATION_CHANNEL, in every other
+process (see listen_for_chat_invalidation).
+"""
+
+CHAT_CACHE_TTL = float(os.environ.get("CHAT_CACHE_TTL", 300))
+CHAT_CACHE_SIZE = int(os.environ.get("CHAT_CACHE_SIZE", 10000))
+CHAT_INVALIDATION_CHANNEL = "chat_cache:invalidate"
+
+
+class CachedChat:
+    __slots__ = ("id", "name", "creator_id", "members")
+
+    def __init__(self, id, name, creator_id, members):
+        self.id = id
+        self.name = name
+        self.creator_id = creator_id
+        self.members = members
+
+
+chat_cache = SessionCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL)
+
+
+def load_chat(s, chat_id):
+    rows = (
+        s.query(Chat.id, Chat.name, Chat.createrID, UsersChats.user_id)
+        .outerjoin(UsersChats, UsersChats.chat_id == Chat.id)
+        .filter(Chat.id == chat_id)
+        .all()
+    )
+    if not rows:
+        return None
+    members = frozenset(row.user_id for row in rows if row.user_id is not None)
+    return CachedChat(rows[0].id, rows[0].name, rows[0].createrID, members)
+
+
+"""
+Returns the CachedChat of chat_id, or None if there is no such chat. Takes the session
+factory, only a cache miss opens a session and queries.
+"""
+
+
+def chat_members(Session, chat_id):
+    chat = chat_cache.get(chat_id)
+    if chat is None:
+        s = Session()
+        try:
+            chat = load_chat(s, chat_id)
+        finally:
+            s.close()
+        if chat is not None:
+            chat_cache.put(chat_id, chat)
+    return chat
+
+
+"""
+Evicts a chat whose members changed from the cache of every process.
+"""
+
+
+def invalidate_chat(chat_id):
+    chat_cache.invalidate(chat_id)
+    logon_session.publish(CHAT_INVALIDATION_CHANNEL, chat_id)
+
+
+"""
+Evicts chats invalidated by other processes, runs forever in a greenthread. If the
+subscription drops the whole cache is cleared, invalidations may have been missed.
+"""
+
+
+def listen_for_chat_invalidation():
+    while True:
+        try:
+            pubsub = logon_session.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHAT_INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                chat_cache.invalidate(message["data"])
+        except redis.RedisError as err:
+            print(err)
+        chat_cache.clear()
+        eventlet.sleep(1)
@@ -0,0 +1,108 @@
+import hashlib
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy_classes import Chat, DirectChat, User, UsersChats
+
+"""
+Chat creation for ADD_CHAT.
+
+Members are resolved from their usernames with IN queries (one up to IN_CHUNK names)
+and the memberships are written with one bulk INSERT, instead of a query per username
+and a relationship append per member. A direct chat (the creator and one other user)
+is registered in direct_chats under the hash of its member set, asking for it again
+returns the existing chat with one primary key lookup. Direct chats created before
+direct_chats existed are registered by backfill_direct_chats (run by migrate.py).
+"""
+
+# names per IN query, well below SQLite's limit on bound parameters
+IN_CHUNK = 500
+
+
+def direct_key(member_ids):
+    return hashlib.sha256("\n".join(sorted(set(member_ids))).encode("utf-8")).hexdigest()
+
+
+"""
+Returns the (id, username, userNickname, avatar) rows of the given usernames in the
+order they were asked for, names without a user are left out.
+"""
+
+
+def find_users(s, usernames):
+    rows = []
+    for n in range(0, len(usernames), IN_CHUNK):
+        rows += (
+            s.query(User.id, User.username, User.userNickname, User.avatar)
+            .filter(User.username.in_(usernames[n : n + IN_CHUNK]))
+            .all()
+        )
+    order = {name: n for n, name in reversed(list(enumerate(usernames)))}
+    return sorted(rows, key=lambda row: order[row.username])
+
+
+def find_direct_chat(s, member_ids):
+    return (
+        s.query(DirectChat.chat_id)
+        .filter(DirectChat.member_key == direct_key(member_ids))
+        .scalar()
+    )
+
+
+"""
+Creates a chat with the given members and commits, returns (chat id, created). A direct
+chat that another request registered first is returned instead with created False.
+"""
+
+
+def create_chat(s, name, creator_id, member_ids, direct=False):
+    chat = Chat(name, creator_id)
+    s.add(chat)
+    # the chat row goes in before the memberships referencing it
+    s.flush()
+    s.execute(
+        UsersChats.__table__.insert(),
+        [{"user_id": member_id, "chat_id": chat.id} for member_id in member_ids],
+    )
+    if direct:
+        s.add(DirectChat(member_key=direct_key(member_ids), chat_id=chat.id))
+    try:
+        s.commit()
+    except IntegrityError:
+        s.rollback()
+        if not direct:
+            raise
+        return find_direct_chat(s, member_ids), False
+    return chat.id, True
+
+
+"""
+Registers the existing two member chats in direct_chats, the most recently active one
+per pair of users. Only runs while direct_chats is empty.
+"""
+
+
+def backfill_direct_chats(connection):
+    if connection.execute(select(DirectChat.member_key).limit(1)).first():
+        return
+    pairs = (
+        select(UsersChats.chat_id)
+        .group_by(UsersChats.chat_id)
+        .having(func.count() == 2)
+    )
+    rows = connection.execute(
+        select(UsersChats.chat_id, UsersChats.user_id)
+        .join(Chat, Chat.id == UsersChats.chat_id)
+        .where(UsersChats.chat_id.in_(pairs))
+        .order_by(Chat.last_message_timestamp.desc(), Chat.created_at.desc())
+    ).all()
+    members = {}
+    for chat_id, user_id in rows:
+        members.setdefault(chat_id, []).append(user_id)
+    chats = {}
+    for chat_id, member_ids in members.items():
+        chats.setdefault(direct_key(member_ids), chat_id)
+    if chats:
+        connection.execute(
+            DirectChat.__table__.insert(),
+            [{"member_key": key, "chat_id": chat_id} for key, chat_id in chats.items()],
+        )
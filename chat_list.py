@@ -0,0 +1,95 @@
+from sqlalchemy_classes import User, Chat, UsersChats
+from presence import online_sids
+from unread_counters import load_unread
+
+"""
+Chat list read model used by LOAD_CHATS.
+
+The sidebar used to be built by walking User.chats and issuing several
+member queries plus a Redis GET per chat. Here the whole list is built from
+two set based queries (the user's chats, then every other member of those
+chats), one batched presence lookup and one read of the unread counters.
+"""
+
+
+"""
+Returns the chats the user belongs to (only those in chat_ids when given), most recently
+active first.
+"""
+
+
+def query_user_chats(s, user_id, chat_ids=None):
+    query = (
+        s.query(Chat.id, Chat.last_message, Chat.last_message_timestamp)
+        .join(UsersChats, UsersChats.chat_id == Chat.id)
+        .filter(UsersChats.user_id == user_id)
+    )
+    if chat_ids is not None:
+        query = query.filter(Chat.id.in_(chat_ids))
+    return query.order_by(Chat.last_message_timestamp.desc()).all()
+
+
+"""
+Returns {chat_id: [member rows]} for every member of the user's chats (only those in
+chat_ids when given) except the user.
+"""
+
+
+def query_chat_members(s, user_id, chat_ids=None):
+    my_chats = s.query(UsersChats.chat_id).filter(UsersChats.user_id == user_id)
+    if chat_ids is not None:
+        my_chats = my_chats.filter(UsersChats.chat_id.in_(chat_ids))
+    rows = (
+        s.query(
+            UsersChats.chat_id,
+            User.id,
+            User.username,
+            User.userNickname,
+            User.avatar,
+        )
+        .join(User, User.id == UsersChats.user_id)
+        .filter(UsersChats.chat_id.in_(my_chats.scalar_subquery()), User.id != user_id)
+        .all()
+    )
+    members = {}
+    for row in rows:
+        members.setdefault(row.chat_id, []).append(row)
+    return members
+
+
+"""
+Builds the LOAD_CHATS payload for a user, the shape matches what the client already expects.
+Reconnects only rebuild the chats that changed (chat_ids, see sync.py) and pass the unread
+counters they already read.
+"""
+
+
+def load_chat_list(s, user_id, chat_ids=None, unread=None):
+    if chat_ids is not None and not chat_ids:
+        return []
+    chats = query_user_chats(s, user_id, chat_ids)
+    members = query_chat_members(s, user_id, chat_ids)
+
+    # the first other member decides the avatar and online state of the chat
+    sids = online_sids([members[i.id][0].id for i in chats if members.get(i.id)])
+    if unread is None:
+        unread = load_unread(user_id)
+
+    result = []
+    for i in chats:
+        others = members.get(i.id, [])
+        first = others[0] if others else None
+        result.append(
+            {
+                "id": i.id,
+                "chat_name": "、".join([single.userNickname for single in others]),
+                "recipient": [single.username for single in others],
+                "recipientId": [single.id for single in others],
+                "active": first is not None and first.id in sids,
+                "avatar": first.avatar if first else None,
+                "last_message": i.last_message,
+                "last_message_timestamp": str(i.last_message_timestamp),
+                "unread": unread.get(i.id, 0),
+            }
+        )
+    return result
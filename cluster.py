@@ -0,0 +1,137 @@
+import eventlet
+
+eventlet.monkey_patch()
+
+import argparse, hashlib, itertools, os, signal, socket, subprocess, sys
+
+"""
+Runs the chat server as several worker processes behind a sticky TCP router.
+
+    python cluster.py --workers 4 --port 5000
+
+Worker i runs server.py on port+1+i with NODE_ID=worker-i. SOCKETIO_MESSAGE_QUEUE
+is set to REDIS_URL, so emits to a room or sid reach sockets owned by any worker
+and presence knows which node owns which sid (see presence.py). The schema is
+migrated once (migrate.py) before the workers start, they skip it (MIGRATE_ON_START=0).
+
+Socket.IO long-polling sends every request of a session to the same worker, so
+polling and handshake requests are routed by a hash of the client address. A
+connection that opens straight onto a websocket (transport=websocket with no
+sid yet) carries the whole session, so it goes to the least loaded worker.
+"""
+
+PEEK_BYTES = 4096
+
+
+class StickyRouter:
+    def __init__(self, workers):
+        self.workers = workers
+        self.connections = [0] * len(workers)
+        self.round_robin = itertools.count()
+
+    def pick(self, client_host, first_bytes):
+        request_line = first_bytes.split(b"\r\n", 1)[0]
+        if b"transport=websocket" in request_line and b"sid=" not in request_line:
+            least = min(self.connections)
+            candidates = [i for i, n in enumerate(self.connections) if n == least]
+            return candidates[next(self.round_robin) % len(candidates)]
+        digest = hashlib.sha1(client_host.encode("utf-8")).digest()
+        return int.from_bytes(digest[:4], "big") % len(self.workers)
+
+    def pipe(self, source, target):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                target.sendall(data)
+        except OSError:
+            pass
+        finally:
+            try:
+                target.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def handle(self, client, address):
+        try:
+            first_bytes = client.recv(PEEK_BYTES)
+            if not first_bytes:
+                return
+            index = self.pick(address[0], first_bytes)
+            upstream = eventlet.connect(self.workers[index])
+        except OSError:
+            client.close()
+            return
+        self.connections[index] += 1
+        try:
+            upstream.sendall(first_bytes)
+            reader = eventlet.spawn(self.pipe, upstream, client)
+            self.pipe(client, upstream)
+            reader.wait()
+        finally:
+            self.connections[index] -= 1
+            upstream.close()
+            client.close()
+
+    def serve(self, host, port):
+        server = eventlet.listen((host, port))
+        eventlet.serve(server, self.handle)
+
+
+def start_workers(count, host, port):
+    processes, addresses = [], []
+    for i in range(count):
+        env = dict(os.environ)
+        env.update(
+            {
+                "HOST": host,
+                "PORT": str(port + 1 + i),
+                "NODE_ID": "worker-%d" % i,
+                "SERVER_DEBUG": "0",
+                "MIGRATE_ON_START": "0",
+            }
+        )
+        if count > 1:
+            env.setdefault("SOCKETIO_MESSAGE_QUEUE", env.get("REDIS_URL", "redis://:12345@127.0.0.1:6379"))
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, "server.py"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=env,
+            )
+        )
+        addresses.append((host, port + 1 + i))
+    return processes, addresses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run N chat server workers behind a sticky router.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    subprocess.run(
+        [sys.executable, "migrate.py"], cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+    )
+    processes, addresses = start_workers(args.workers, args.host, args.port)
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda *_: stopping.append(True))
+
+    print("--- routing %s:%d to %d workers" % (args.host, args.port, len(addresses)))
+    router = eventlet.spawn(StickyRouter(addresses).serve, args.host, args.port)
+    # stop everything when asked to or when a worker dies
+    while not stopping and all(process.poll() is None for process in processes):
+        eventlet.sleep(0.5)
+
+    router.kill()
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        process.wait()
+
+if __name__ == "__main__":
+    main()
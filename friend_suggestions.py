@@ -0,0 +1,257 @@
+import heapq, os, sys
+from array import array
+from collections import Counter
+from itertools import chain
+from operator import itemgetter
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import aliased
+from sqlalchemy_classes import Friendships, FriendSuggestion, User
+
+"""
+"People you may know": the TOP_K users with the most mutual friends who are not yet
+friends of the user, precomputed into friend_suggestions and served with one indexed
+read (load_suggestions).
+
+rebuild() computes the whole table in batch. The friendships are loaded once into an
+adjacency list (users numbered 0..n-1), and each user's friend-of-friend counts are
+counted by Counter over the concatenated friend lists of the user's friends, in C. The
+cost is the sum of the squared friend counts. Existing databases are filled with:
+
+    python friend_suggestions.py rebuild
+
+Afterwards add_friendship keeps the table exact when FRIEND_REQUEST_ACCEPTED has added
+a friendship (friendships are never removed), see record_friendship. A new friendship
+a-b only changes the pairs (a, friends of b), (b, friends of a) and a-b itself. The
+lists of a and b are recomputed, and b (a) is offered to every friend of a (b) with
+their exact mutual count.
+"""
+
+TOP_K = int(os.environ.get("FRIEND_SUGGESTIONS_TOP_K", 20))
+WRITE_BATCH = 10000
+
+
+"""
+Returns (ids, adjacency) for the friendships table: adjacency[n] holds the numbers of
+the friends of the user ids[n], as 4 byte ints (half the memory of a list).
+"""
+
+
+def load_adjacency(s, batch=100000):
+    ids, numbers, adjacency = [], {}, []
+    for a, b in s.query(Friendships.user_a_id, Friendships.user_b_id).yield_per(batch):
+        for user_id in (a, b):
+            if user_id not in numbers:
+                numbers[user_id] = len(ids)
+                ids.append(user_id)
+                adjacency.append(array("i"))
+        adjacency[numbers[a]].append(numbers[b])
+    return ids, adjacency
+
+
+"""
+Returns the (number, mutual friends) of the top k suggestions for the user `user`,
+most mutual friends first.
+"""
+
+
+def top_suggestions(adjacency, user, k=TOP_K):
+    friends = adjacency[user]
+    counts = Counter(chain.from_iterable(adjacency[friend] for friend in friends))
+    counts.pop(user, None)
+    for friend in friends:
+        counts.pop(friend, None)
+    return heapq.nlargest(k, counts.items(), key=itemgetter(1))
+
+
+"""
+Recomputes friend_suggestions from the friendships table and commits.
+"""
+
+
+def rebuild(s, k=TOP_K):
+    ids, adjacency = load_adjacency(s)
+    s.query(FriendSuggestion).delete()
+    rows = []
+    for user in range(len(ids)):
+        rows += [
+            {"user_id": ids[user], "suggested_id": ids[suggested], "mutual": mutual}
+            for suggested, mutual in top_suggestions(adjacency, user, k)
+        ]
+        if len(rows) >= WRITE_BATCH:
+            s.execute(FriendSuggestion.__table__.insert(), rows)
+            rows = []
+    if rows:
+        s.execute(FriendSuggestion.__table__.insert(), rows)
+    s.commit()
+
+
+def friends_of(user_id):
+    return select(Friendships.user_b_id).where(Friendships.user_a_id == user_id)
+
+
+"""
+Replaces the suggestions of user_id with its top k friends of friends, counted in SQL.
+"""
+
+
+def refresh_user(s, user_id, k=TOP_K):
+    first, second = aliased(Friendships), aliased(Friendships)
+    mutual = func.count().label("mutual")
+    rows = (
+        s.query(second.user_b_id, mutual)
+        .select_from(first)
+        .join(second, second.user_a_id == first.user_b_id)
+        .filter(
+            first.user_a_id == user_id,
+            second.user_b_id != user_id,
+            second.user_b_id.not_in(friends_of(user_id)),
+        )
+        .group_by(second.user_b_id)
+        .order_by(mutual.desc(), second.user_b_id)
+        .limit(k)
+        .all()
+    )
+    s.query(FriendSuggestion).filter(FriendSuggestion.user_id == user_id).delete()
+    if rows:
+        s.execute(
+            FriendSuggestion.__table__.insert(),
+            [{"user_id": user_id, "suggested_id": i[0], "mutual": i[1]} for i in rows],
+        )
+
+
+"""
+Offers `other` to every friend of user_id that is not a friend of `other`, with the
+number of friends the two have in common, and keeps each list at the top k.
+"""
+
+
+def offer_to_friends(s, user_id, other, k=TOP_K):
+    candidates = (
+        select(Friendships.user_b_id)
+        .where(Friendships.user_a_id == user_id, Friendships.user_b_id != other)
+        .where(Friendships.user_b_id.not_in(friends_of(other)))
+    )
+    counts = dict(
+        s.query(Friendships.user_a_id, func.count())
+        .filter(
+            Friendships.user_a_id.in_(candidates),
+            Friendships.user_b_id.in_(friends_of(other)),
+        )
+        .group_by(Friendships.user_a_id)
+        .all()
+    )
+    lists = {}
+    for row in s.query(
+        FriendSuggestion.user_id, FriendSuggestion.suggested_id, FriendSuggestion.mutual
+    ).filter(FriendSuggestion.user_id.in_(candidates)):
+        lists.setdefault(row.user_id, {})[row.suggested_id] = row.mutual
+
+    upserts, evictions = [], []
+    for friend_id, mutual in counts.items():
+        suggestions = lists.get(friend_id, {})
+        suggestions[other] = mutual
+        kept = heapq.nlargest(k, suggestions.items(), key=itemgetter(1))
+        if (other, mutual) in kept:
+            upserts.append({"user_id": friend_id, "suggested_id": other, "mutual": mutual})
+        kept = {suggested_id for suggested_id, _ in kept}
+        evictions += [
+            {"user": friend_id, "suggested": suggested_id}
+            for suggested_id in suggestions
+            if suggested_id not in kept and suggested_id != other
+        ]
+
+    table = FriendSuggestion.__table__
+    if evictions:
+        s.execute(
+            table.delete().where(
+                table.c.user_id == bindparam("user"),
+                table.c.suggested_id == bindparam("suggested"),
+            ),
+            evictions,
+        )
+    if upserts:
+        statement = insert(table)
+        s.execute(
+            statement.on_conflict_do_update(
+                index_elements=[table.c.user_id, table.c.suggested_id],
+                set_={"mutual": statement.excluded.mutual},
+            ),
+            upserts,
+        )
+
+
+"""
+Updates friend_suggestions for the new friendship of user ids a and b, whose
+friendships rows are in the session already. The caller commits.
+"""
+
+
+def add_friendship(s, a, b, k=TOP_K):
+    s.flush()
+    refresh_user(s, a, k)
+    refresh_user(s, b, k)
+    offer_to_friends(s, a, b, k)
+    offer_to_friends(s, b, a, k)
+
+
+"""
+Runs add_friendship for the committed friendship of a and b in a session and transaction
+of its own, so a failure can't undo the friendship. It is printed and the suggestions
+stay behind until the next rebuild.
+"""
+
+
+def record_friendship(Session, a, b):
+    s = Session()
+    try:
+        add_friendship(s, a, b)
+        s.commit()
+    except SQLAlchemyError as err:
+        print(err)
+        s.rollback()
+    finally:
+        s.close()
+
+
+"""
+Returns the precomputed suggestions of user_id, most mutual friends first. Users that
+have not opted in to being visible in searches are left out.
+"""
+
+
+def load_suggestions(s, user_id, limit=TOP_K):
+    rows = (
+        s.query(
+            User.id, User.username, User.userNickname, User.avatar, FriendSuggestion.mutual
+        )
+        .join(User, User.id == FriendSuggestion.suggested_id)
+        .filter(FriendSuggestion.user_id == user_id, User.visible_in_searches == True)
+        .order_by(FriendSuggestion.mutual.desc(), FriendSuggestion.suggested_id)
+        .limit(max(1, min(int(limit), TOP_K)))
+        .all()
+    )
+    return [
+        {
+            "id": i.id,
+            "username": i.username,
+            "userNickname": i.userNickname,
+            "avatar": i.avatar,
+            "mutual": i.mutual,
+        }
+        for i in rows
+    ]
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python friend_suggestions.py rebuild")
+        sys.exit(1)
+    from sqlalchemy_base import Session
+
+    s = Session()
+    try:
+        rebuild(s)
+    finally:
+        s.close()
@@ -0,0 +1,154 @@
+import hashlib, os, pathlib, sys, tempfile, time
+from eventlet import tpool
+from sqlalchemy import func, union_all, select
+from sqlalchemy_classes import Message, User, Circle, SegmentMedia
+
+"""
+Content addressed media store for chat images, circle images and avatars.
+
+Uploads are stored once under static/media/<sha256>.<ext>, so the same image sent
+to many chats takes the space of one file. Hashing and disk IO run on eventlet's
+thread pool. A blob is referenced by Message.image, Circle.image, User.avatar and
+the images of archived messages (SegmentMedia, see archive.py). Blobs that nothing
+references any more are removed by release_media (for replaced avatars) or by the
+garbage collector:
+
+    python media_store.py gc
+"""
+
+MEDIA_DIR = "./client/build/static/media"
+MEDIA_URL = "/static/media/"
+ALLOWED_EXTENSIONS = {"jpg", "png", "gif"}
+# freshly uploaded blobs are kept this long even without references,
+# their message/avatar row may not be committed yet
+GC_GRACE_SECONDS = int(os.environ.get("MEDIA_GC_GRACE_SECONDS", 3600))
+
+
+def blob_path(url):
+    return os.path.join(MEDIA_DIR, os.path.basename(url))
+
+
+def write_blob(data, extension):
+    digest = hashlib.sha256(data).hexdigest()
+    fileName = f"{digest}.{extension}"
+    path = os.path.join(MEDIA_DIR, fileName)
+    if os.path.exists(path):
+        # dedup hit, refresh mtime so the GC grace period restarts
+        os.utime(path)
+        return fileName
+    # a temp file of its own per upload, concurrent uploads of the same image race on path only
+    fd, tmp = tempfile.mkstemp(dir=MEDIA_DIR, prefix=fileName + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as newFile:
+            newFile.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        if not os.path.exists(path):
+            raise
+        # another upload of the same image got there first
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return fileName
+
+
+"""
+Stores an uploaded image (bytes or the list of ints sent by the client) and
+returns its url, returns False if the upload is invalid.
+"""
+
+
+def image_handler(image, extension):
+    try:
+        if not image or extension in {None, ""}:
+            raise TypeError("Image and/or extension not provided!")
+
+        extension = str(extension).lower()
+        if extension not in ALLOWED_EXTENSIONS:
+            raise ValueError("%s image format not allowed" % extension)
+
+        pathlib.Path(MEDIA_DIR).mkdir(parents=True, exist_ok=True)
+        fileName = tpool.execute(write_blob, bytes(image), extension)
+        return MEDIA_URL + fileName
+    except (TypeError, ValueError, OSError) as err:
+        print(err)
+        return False
+
+
+"""
+Returns {url: number of rows referencing it}, for all media or only the given urls.
+"""
+
+
+def reference_counts(s, urls=None):
+    refs = union_all(
+        select(Message.image.label("url")).where(Message.image != None),
+        select(Circle.image.label("url")).where(Circle.image != None),
+        select(User.avatar.label("url")).where(User.avatar != None),
+        select(SegmentMedia.url.label("url")),
+    ).subquery()
+    query = s.query(refs.c.url, func.count()).group_by(refs.c.url)
+    if urls is not None:
+        query = query.filter(refs.c.url.in_(list(urls)))
+    return dict(query.all())
+
+
+def remove_unreferenced(s, urls):
+    counts = reference_counts(s, urls)
+    cutoff = time.time() - GC_GRACE_SECONDS
+    removed, freed = 0, 0
+    for url in urls:
+        path = blob_path(url)
+        if counts.get(url) or not os.path.exists(path):
+            continue
+        stat = os.stat(path)
+        if stat.st_mtime > cutoff:
+            continue
+        tpool.execute(os.remove, path)
+        removed += 1
+        freed += stat.st_size
+    return removed, freed
+
+
+"""
+Called after a reference was dropped (e.g. an avatar replaced), removes the blob
+if nothing else uses it.
+"""
+
+
+def release_media(s, url):
+    if url and url.startswith(MEDIA_URL):
+        return remove_unreferenced(s, [url])
+    return 0, 0
+
+
+"""
+Removes every blob in the media directory that is no longer referenced.
+Returns (files removed, bytes freed).
+"""
+
+
+def collect_garbage(s):
+    if not os.path.isdir(MEDIA_DIR):
+        return 0, 0
+    urls = [MEDIA_URL + name for name in os.listdir(MEDIA_DIR) if not name.endswith(".tmp")]
+    removed, freed = 0, 0
+    for start in range(0, len(urls), 500):
+        chunk_removed, chunk_freed = remove_unreferenced(s, urls[start : start + 500])
+        removed += chunk_removed
+        freed += chunk_freed
+    return removed, freed
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["gc"]:
+        print("usage: python media_store.py gc")
+        sys.exit(1)
+    from sqlalchemy_base import Session
+
+    s = Session()
+    try:
+        removed, freed = collect_garbage(s)
+        print("removed %d unreferenced blobs, freed %d bytes" % (removed, freed))
+    finally:
+        s.close()
@@ -0,0 +1,54 @@
+from sqlalchemy import or_
+from sqlalchemy_classes import Message
+from server_helpers import encode_cursor, decode_cursor
+from archive import archived_messages
+
+"""
+Keyset pagination over a chat's message history.
+
+Pages are read newest first from a (created_at, id) cursor, which is served by the
+(chat_id, created_at, id) index on messages, so the cost of a page does not depend
+on how long the chat is or how far back the user has scrolled. Once the hot table
+runs out the page continues in the chat's archived segments (see archive.py).
+"""
+
+PAGE_SIZE = 50
+
+
+"""
+Returns (messages, cursor) for the page before `cursor` (the latest page when cursor is None).
+Messages are in chronological order, cursor is None once the start of the chat is reached.
+"""
+
+
+def load_messages(s, chat_id, cursor=None, limit=PAGE_SIZE):
+    query = s.query(Message).filter(Message.chat_id == chat_id)
+    if cursor:
+        created_at, message_id = decode_cursor(cursor)
+        query = query.filter(
+            Message.created_at <= created_at,
+            or_(Message.created_at < created_at, Message.id < message_id),
+        )
+    rows = query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        if rows:
+            before = (rows[-1].created_at, rows[-1].id)
+        else:
+            before = decode_cursor(cursor) if cursor else None
+        rows += archived_messages(s, chat_id, before, limit + 1 - len(rows))
+
+    page = rows[:limit]
+    next_cursor = encode_cursor(page[-1]) if len(rows) > limit else None
+    page.reverse()
+    return page, next_cursor
+
+
+def serialize_message(i):
+    return {
+        "id": i.id,
+        "message": i.message,
+        "username": i.username,
+        "userNickname": i.userNickname,
+        "timestamp": str(i.created_at),
+        "image": i.image,
+    }
@@ -0,0 +1,259 @@
+import hashlib, re, sys
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy_classes import Message, MessageSegment, UsersChats
+from user_search import normalize
+
+"""
+Full text message search for SEARCH_MESSAGES, on the SQLite FTS5 table message_search
+(created by migrate.py).
+
+FTS5's unicode61 tokenizer keeps a run of CJK characters as one token and the
+trigram tokenizer cannot match two character words, the most common length in
+Chinese. So text is tokenized here before it is indexed: latin words are kept as
+they are, runs of CJK characters become overlapping bigrams (column bi, so a
+phrase of bigrams matches any CJK substring of two or more characters) plus
+single characters (column uni, for one character queries).
+
+Every token is prefixed with a fixed length token of its chat, so a term has one
+posting list per chat and a search only reads the lists of the caller's chats
+(an OR over them) instead of every occurrence of the term in the whole history.
+
+The original text and message metadata are stored unindexed next to the tokens,
+so results and snippets need no join and archived messages (see archive.py)
+stay searchable. Rows are added by the message writer in the transaction that
+stores the message. Existing messages are indexed with:
+
+    python message_search.py rebuild
+"""
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+# chats per MATCH, callers in more chats are searched in several queries
+MAX_CHAT_TERMS = 200
+SNIPPET_CONTEXT = 24
+
+CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+# CJK runs, and words made of the characters unicode61 keeps in a token
+TOKENS = re.compile("([%s]+)|([^\\W_%s]+)" % (CJK, CJK))
+
+INSERT = text(
+    "INSERT INTO message_search "
+    "(bi, uni, message, message_id, chat_id, username, userNickname, created_at) "
+    "VALUES (:bi, :uni, :message, :message_id, :chat_id, :username, :userNickname, :created_at)"
+)
+
+
+def chat_token(chat_id):
+    return "c" + hashlib.sha1(chat_id.encode("utf-8")).hexdigest()[:16]
+
+
+def tokenize(value, prefix):
+    bigrams, unigrams = [], []
+    for cjk, word in TOKENS.findall(normalize(value)):
+        if word:
+            bigrams.append(prefix + word)
+            continue
+        unigrams += [prefix + c for c in cjk]
+        bigrams += [prefix + cjk[i : i + 2] for i in range(max(1, len(cjk) - 1))]
+    return " ".join(bigrams), " ".join(unigrams)
+
+
+def quote(token):
+    return '"%s"' % token.replace('"', '""')
+
+
+"""
+Builds the FTS5 query for the given chats: every word and CJK run of the search must
+match, the last word as a prefix so results show up while typing.
+"""
+
+
+def query_tokens(query):
+    tokens = TOKENS.findall(normalize(query))
+    if not tokens:
+        raise ValueError("Search query not provided!")
+    return tokens
+
+
+def match_query(query, chat_ids):
+    tokens = query_tokens(query)
+
+    def terms(prefix):
+        for n, (cjk, word) in enumerate(tokens):
+            if word:
+                yield "bi : %s%s" % (quote(prefix + word), " *" if n == len(tokens) - 1 else "")
+            elif len(cjk) == 1:
+                yield "uni : %s" % quote(prefix + cjk)
+            else:
+                yield "bi : %s" % quote(" ".join(prefix + cjk[i : i + 2] for i in range(len(cjk) - 1)))
+
+    return " OR ".join("(%s)" % " AND ".join(terms(chat_token(i))) for i in chat_ids)
+
+
+def search_row(row, chat_id):
+    bi, uni = tokenize(row["message"], chat_token(chat_id))
+    return {
+        "bi": bi,
+        "uni": uni,
+        "message": row["message"],
+        "message_id": row["id"],
+        "chat_id": chat_id,
+        "username": row["username"],
+        "userNickname": row["userNickname"],
+        "created_at": row["created_at"].isoformat(sep=" "),
+    }
+
+
+"""
+Adds message rows (see message_writer.message_row) to the search index, in the caller's transaction.
+"""
+
+
+def index_messages(connection, rows):
+    rows = [search_row(row, row["chat_id"]) for row in rows if row.get("message")]
+    if rows:
+        connection.execute(INSERT, rows)
+
+
+"""
+Returns [(start, length)] of the query's words and CJK runs in text.
+"""
+
+
+def find_matches(value, query):
+    folded = normalize(value)
+    needles = [cjk or word for cjk, word in TOKENS.findall(normalize(query))]
+    matches = []
+    for needle in needles:
+        start = folded.find(needle)
+        while start != -1:
+            matches.append((start, len(needle)))
+            start = folded.find(needle, start + len(needle))
+    return sorted(matches)
+
+
+def snippet(value, query):
+    matches = find_matches(value, query)
+    if not matches or len(normalize(value)) != len(value):
+        # offsets of the folded text do not line up with the original, send the start of it
+        return value[: SNIPPET_CONTEXT * 3], []
+    start = max(0, matches[0][0] - SNIPPET_CONTEXT)
+    end = min(len(value), matches[0][0] + matches[0][1] + SNIPPET_CONTEXT * 2)
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(value) else ""
+    shown = [
+        [match_start - start + len(prefix), length]
+        for match_start, length in matches
+        if match_start >= start and match_start + length <= end
+    ]
+    return prefix + value[start:end] + suffix, shown
+
+
+"""
+Returns (results, cursor): one page of the messages matching the query in the chats the
+user belongs to (only chat_id when given), best match first. cursor is None on the last page.
+"""
+
+
+def search_messages(s, query, user_id, chat_id=None, cursor=None, limit=PAGE_SIZE):
+    query_tokens(query)
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    try:
+        offset = int(cursor or 0)
+    except ValueError:
+        raise ValueError("Invalid cursor provided!")
+    if offset < 0:
+        raise ValueError("Invalid cursor provided!")
+
+    chats = [
+        i.chat_id
+        for i in s.query(UsersChats.chat_id).filter(
+            UsersChats.user_id == user_id,
+            *([UsersChats.chat_id == chat_id] if chat_id else []),
+        )
+    ]
+    if not chats:
+        return [], None
+
+    rows = []
+    for start in range(0, len(chats), MAX_CHAT_TERMS):
+        try:
+            rows += s.execute(
+                text(
+                    "SELECT message_id, chat_id, message, username, userNickname, created_at, "
+                    "bm25(message_search) AS score "
+                    "FROM message_search WHERE message_search MATCH :match "
+                    "ORDER BY score, created_at DESC LIMIT :limit"
+                ),
+                {
+                    "match": match_query(query, chats[start : start + MAX_CHAT_TERMS]),
+                    "limit": offset + limit + 1,
+                },
+            ).all()
+        except OperationalError as err:
+            print(err)
+            raise ValueError("Invalid search query!")
+    if len(chats) > MAX_CHAT_TERMS:
+        # bm25 scores of the same query are comparable across the chat chunks
+        rows.sort(key=lambda i: i.created_at, reverse=True)
+        rows.sort(key=lambda i: i.score)
+    # a chat token is a hash, make sure no row of another chat slipped in
+    member = set(chats)
+    rows = [i for i in rows if i.chat_id in member][offset:]
+
+    results = []
+    for i in rows[:limit]:
+        text_snippet, matches = snippet(i.message, query)
+        results.append(
+            {
+                "id": i.message_id,
+                "chatId": i.chat_id,
+                "username": i.username,
+                "userNickname": i.userNickname,
+                "timestamp": i.created_at,
+                "snippet": text_snippet,
+                "matches": matches,
+                "score": round(-i.score, 4),
+            }
+        )
+    next_cursor = str(offset + limit) if len(rows) > limit else None
+    return results, next_cursor
+
+
+"""
+Rebuilds the search index from the messages table and the archived segments.
+"""
+
+
+def rebuild(s, batch=5000):
+    from archive import read_segment
+
+    s.execute(text("DELETE FROM message_search"))
+    rows = []
+    for i in s.query(*Message.__table__.columns).yield_per(batch):
+        rows.append(dict(i._mapping))
+        if len(rows) >= batch:
+            index_messages(s.connection(), rows)
+            rows = []
+    for segment in s.query(MessageSegment.path).all():
+        rows += [m._asdict() for m in read_segment(segment.path)]
+        if len(rows) >= batch:
+            index_messages(s.connection(), rows)
+            rows = []
+    index_messages(s.connection(), rows)
+    s.commit()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python message_search.py rebuild")
+        sys.exit(1)
+    from sqlalchemy_base import Session
+
+    s = Session()
+    try:
+        rebuild(s)
+        print("indexed %d messages" % s.execute(text("SELECT count(*) FROM message_search")).scalar())
+    finally:
+        s.close()
@@ -0,0 +1,132 @@
+import os, time
+import eventlet
+from eventlet.event import Event
+from eventlet.queue import Queue, Empty
+from sqlalchemy import bindparam
+from sqlalchemy_classes import Message, Chat
+from unread_counters import count_new_messages
+from message_search import index_messages
+
+"""
+Group commit writer for chat messages.
+
+ADD_MESSAGE_TO_CHAT used to open a session and commit every message on its own, one
+fsync per message. Handlers now hand the message to the writer and wait: a single
+greenthread collects what arrives within MESSAGE_FLUSH_INTERVAL (ms), up to
+MESSAGE_BATCH_SIZE messages (a lone message is written at once), and stores them,
+together with the last_message summary of every chat touched and their search index
+rows (see message_search.py), in one transaction. The waiting handlers resume once
+that transaction is committed, so nothing is acknowledged before it is durable. The
+unread counters of the other members are bumped after the commit.
+"""
+
+FLUSH_INTERVAL = float(os.environ.get("MESSAGE_FLUSH_INTERVAL", 5)) / 1000
+BATCH_SIZE = int(os.environ.get("MESSAGE_BATCH_SIZE", 500))
+
+
+class MessageWriter:
+    def __init__(self, engine, flush_interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE):
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = Queue()
+        self.thread = None
+        self.batches = 0
+
+    # queues a message row (see message_row) with the chat summary that goes with it and
+    # blocks the calling greenthread until it is committed, ValueError if that failed
+    def write(self, row, last_message):
+        if self.thread is None or self.thread.dead:
+            self.thread = eventlet.spawn(self.run)
+        done = Event()
+        self.pending.put((row, last_message, done))
+        try:
+            done.wait()
+        except Exception as err:
+            print(err)
+            raise ValueError("Message could not be saved!")
+
+    def collect(self):
+        batch = [self.pending.get()]
+        # let the greenthreads that are ready queue their messages, a lone sender is
+        # flushed straight away instead of waiting for the interval
+        eventlet.sleep(0)
+        while len(batch) < self.batch_size and not self.pending.empty():
+            batch.append(self.pending.get_nowait())
+        if len(batch) == 1:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def flush(self, batch):
+        summaries = {}
+        for row, last_message, done in batch:
+            summaries[row["chat_id"]] = {
+                "chat": row["chat_id"],
+                "summary": last_message,
+                "timestamp": row["created_at"],
+            }
+        with self.engine.begin() as connection:
+            connection.execute(Message.__table__.insert(), [row for row, _, _ in batch])
+            index_messages(connection, [row for row, _, _ in batch])
+            connection.execute(
+                Chat.__table__.update()
+                .where(Chat.__table__.c.id == bindparam("chat"))
+                .values(
+                    last_message=bindparam("summary"),
+                    last_message_timestamp=bindparam("timestamp"),
+                ),
+                list(summaries.values()),
+            )
+        self.batches += 1
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            try:
+                self.flush(batch)
+            except Exception as err:
+                for _, _, done in batch:
+                    done.send_exception(err)
+                continue
+            for _, _, done in batch:
+                done.send(True)
+            try:
+                with self.engine.connect() as connection:
+                    count_new_messages(connection, [row for row, _, _ in batch])
+            except Exception as err:
+                # the counters drift until `python unread_counters.py check --fix`
+                print(err)
+
+
+def message_row(m, chat_id):
+    return {
+        "id": m.id,
+        "message": m.message if m.message is not None else "",
+        "created_at": m.created_at,
+        "read_at": None,
+        "chat_id": chat_id,
+        "username": m.username,
+        "userNickname": m.userNickname,
+        "image": m.image,
+    }
+
+
+message_writer = None
+
+
+def get_message_writer():
+    global message_writer
+    if message_writer is None:
+        from sqlalchemy_base import engine
+
+        message_writer = MessageWriter(engine)
+    return message_writer
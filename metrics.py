@@ -0,0 +1,184 @@
+import time
+from bisect import bisect_left
+from eventlet.corolocal import local
+from sqlalchemy import event
+
+"""
+Per handler metrics for socket events and HTTP routes, exported in the Prometheus
+text format on /metrics.
+
+Every socket handler goes through disconnect_unauthorised, which tracks the call
+under its event name (TYPING tracks itself, it skips the check), HTTP routes are
+tracked by request hooks in server.py. For each handler this records calls, errors
+(an exception or a genError), calls rejected by the rate limits (see rate_limits.py),
+a latency histogram, and the SQL statements and Redis round trips issued while it ran.
+Work done outside a handler (message writer, read flushes, heartbeat) is
+recorded under kind="background".
+
+Metrics are kept per process, with cluster.py scrape every worker's own port.
+"""
+
+# histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BACKGROUND = ("background", "")
+
+
+class HandlerStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.sql = 0
+        self.redis = 0
+        self.rate_limited = 0
+        self.latency_sum = 0.0
+        # one slot per bucket plus +Inf
+        self.latency_counts = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.latency_sum += seconds
+        self.latency_counts[bisect_left(BUCKETS, seconds)] += 1
+
+
+class Call:
+    def __init__(self, stats):
+        self.stats = stats
+        self.start = time.perf_counter()
+        self.failed = False
+
+
+class HandlerMetrics:
+    def __init__(self):
+        self.handlers = {}
+        # the call running in the current greenthread
+        self.current = local()
+
+    def stats(self, key):
+        stats = self.handlers.get(key)
+        if stats is None:
+            stats = self.handlers[key] = HandlerStats()
+        return stats
+
+    def start(self, kind, name):
+        call = Call(self.stats((kind, name)))
+        self.current.call = call
+        return call
+
+    def finish(self, call, failed=False):
+        call.stats.calls += 1
+        if failed or call.failed:
+            call.stats.errors += 1
+        call.stats.observe(time.perf_counter() - call.start)
+        if getattr(self.current, "call", None) is call:
+            self.current.call = None
+
+    def active(self):
+        call = getattr(self.current, "call", None)
+        return call.stats if call else self.stats(BACKGROUND)
+
+    # counts a call rejected by the rate limits (see rate_limits.py)
+    def rate_limited(self):
+        self.active().rate_limited += 1
+
+    # marks the running call as failed, for handlers that catch their errors
+    def error(self):
+        call = getattr(self.current, "call", None)
+        if call:
+            call.failed = True
+
+    def track(self, kind, name, f, *args, **kwargs):
+        call = self.start(kind, name)
+        try:
+            result = f(*args, **kwargs)
+        except Exception:
+            self.finish(call, failed=True)
+            raise
+        self.finish(call)
+        return result
+
+    def count_sql(self, *args):
+        self.active().sql += 1
+
+    def count_redis(self):
+        self.active().redis += 1
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help, value):
+            lines.append("# HELP onlinechat_%s %s" % (name, help))
+            lines.append("# TYPE onlinechat_%s %s" % (name, kind))
+            for (handler_kind, handler), stats in sorted(self.handlers.items()):
+                labels = 'kind="%s",handler="%s"' % (handler_kind, handler)
+                lines.extend(value("onlinechat_" + name, labels, stats))
+
+        def counter(attribute):
+            return lambda name, labels, stats: ["%s{%s} %d" % (name, labels, getattr(stats, attribute))]
+
+        def histogram(name, labels, stats):
+            rows, cumulative = [], 0
+            for bound, count in zip(BUCKETS + ("+Inf",), stats.latency_counts):
+                cumulative += count
+                rows.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+            rows.append("%s_sum{%s} %f" % (name, labels, stats.latency_sum))
+            rows.append("%s_count{%s} %d" % (name, labels, cumulative))
+            return rows
+
+        family("handler_calls_total", "counter", "Handler calls.", counter("calls"))
+        family("handler_errors_total", "counter", "Handler calls that failed.", counter("errors"))
+        family(
+            "handler_rate_limited_total",
+            "counter",
+            "Handler calls rejected by the rate limits.",
+            counter("rate_limited"),
+        )
+        family(
+            "handler_latency_seconds", "histogram", "Handler wall time in seconds.", histogram
+        )
+        family(
+            "handler_sql_statements_total",
+            "counter",
+            "SQL statements issued while the handler ran.",
+            counter("sql"),
+        )
+        family(
+            "handler_redis_calls_total",
+            "counter",
+            "Redis round trips made while the handler ran.",
+            counter("redis"),
+        )
+        return "\n".join(lines) + "\n"
+
+
+handler_metrics = HandlerMetrics()
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", handler_metrics.count_sql)
+
+
+"""
+Counts the round trips of Redis clients: every command, and every pipeline once.
+"""
+
+
+def instrument_redis(*clients):
+    for client in clients:
+        client.execute_command = counted(client.execute_command)
+        client.pipeline = pipelines(client.pipeline)
+
+
+def counted(f):
+    def wrapped(*args, **kwargs):
+        handler_metrics.count_redis()
+        return f(*args, **kwargs)
+
+    return wrapped
+
+
+def pipelines(pipeline):
+    def wrapped(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        pipe.execute = counted(pipe.execute)
+        return pipe
+
+    return wrapped
@@ -0,0 +1,50 @@
+import sys
+from sqlalchemy_classes import Base
+from chat_create import backfill_direct_chats
+
+"""
+Schema migration, run once per deployment instead of on every import of the models.
+
+Creates missing tables and the indexes added to existing tables since, then the FTS5
+search table (see message_search.py), and registers the direct chats of databases
+older than direct_chats (see chat_create.py). Everything is idempotent. server.py
+runs it on start unless MIGRATE_ON_START=0, cluster.py runs it once before starting
+its workers with MIGRATE_ON_START=0.
+
+    python migrate.py
+"""
+
+# 信息全文检索（FTS5虚表，不属于metadata，分词和查询见message_search.py）
+MESSAGE_SEARCH_TABLE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(
+    bi, uni,
+    message UNINDEXED, message_id UNINDEXED, chat_id UNINDEXED,
+    username UNINDEXED, userNickname UNINDEXED, created_at UNINDEXED
+)
+"""
+
+
+def migrate(engine):
+    # Serialize all classes that inherit from Base into tables
+    Base.metadata.create_all(engine)
+    # create_all skips existing tables, make sure indexes added later exist on old databases too
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+    if engine.dialect.name == "sqlite":
+        with engine.begin() as connection:
+            connection.exec_driver_sql(MESSAGE_SEARCH_TABLE)
+
+    with engine.begin() as connection:
+        backfill_direct_chats(connection)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:]:
+        print("usage: python migrate.py")
+        sys.exit(1)
+    from sqlalchemy_base import engine
+
+    migrate(engine)
+    print("schema is up to date")
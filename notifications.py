@@ -0,0 +1,131 @@
+import os, sys
+from datetime import datetime, timedelta
+import eventlet
+from sqlalchemy import func, or_
+from sqlalchemy_classes import Notice
+from server_helpers import decode_cursor
+
+"""
+Notification inbox.
+
+Notices are paged newest first from a (timestamp, id) cursor. A page is merged
+from two range scans of the (recipient, dismissed, timestamp, id) index, one over
+the unread and one over the dismissed notices, and the unread count is a count on
+the same index, so neither grows with the size of the inbox.
+
+Old dismissed notices and old ERROR notices (see genError) are pruned by a
+retention job, every NOTICE_RETENTION_INTERVAL seconds in the server or by hand:
+
+    python notifications.py prune
+"""
+
+PAGE_SIZE = 20
+RETENTION_DAYS = float(os.environ.get("NOTICE_RETENTION_DAYS", 30))
+RETENTION_INTERVAL = int(os.environ.get("NOTICE_RETENTION_INTERVAL", 3600))
+# notices deleted per transaction, keeps the write lock short
+PRUNE_CHUNK = 1000
+
+
+def encode_notice_cursor(notice):
+    return "%s|%s" % (notice.timestamp.isoformat(), notice.id)
+
+
+"""
+Returns (notices, cursor) for the page before `cursor` (the latest page when cursor
+is None), newest first. cursor is None once there are no older notices.
+"""
+
+
+def load_notices(s, user_id, cursor=None, limit=PAGE_SIZE):
+    rows = []
+    for dismissed in (False, True):
+        query = s.query(Notice).filter(Notice.recipient == user_id, Notice.dismissed == dismissed)
+        if cursor:
+            timestamp, notice_id = decode_cursor(cursor)
+            query = query.filter(
+                Notice.timestamp <= timestamp,
+                or_(Notice.timestamp < timestamp, Notice.id < notice_id),
+            )
+        rows += query.order_by(Notice.timestamp.desc(), Notice.id.desc()).limit(limit + 1).all()
+
+    rows.sort(key=lambda notice: (notice.timestamp, notice.id), reverse=True)
+    page = rows[:limit]
+    next_cursor = encode_notice_cursor(page[-1]) if len(rows) > limit else None
+    return page, next_cursor
+
+
+def unread_notices(s, user_id):
+    return (
+        s.query(func.count(Notice.id))
+        .filter(Notice.recipient == user_id, Notice.dismissed == False)
+        .scalar()
+    )
+
+
+def serialize_notice(x):
+    return {
+        "id": x.id,
+        "sender": x.sender,
+        "type": x.type,
+        "dismissed": x.dismissed,
+        "message": x.message,
+        "avatar": x.avatar,
+        "timestamp": str(x.timestamp),
+    }
+
+
+"""
+Deletes dismissed and ERROR notices older than the retention period, returns the
+number of notices removed.
+"""
+
+
+def prune_notices(s, now=None):
+    cutoff = (now or datetime.utcnow()) - timedelta(days=RETENTION_DAYS)
+    expired = [
+        i.id
+        for i in s.query(Notice.id).filter(
+            Notice.timestamp < cutoff,
+            or_(Notice.dismissed == True, Notice.type == "ERROR"),
+        )
+    ]
+    for start in range(0, len(expired), PRUNE_CHUNK):
+        s.query(Notice).filter(Notice.id.in_(expired[start : start + PRUNE_CHUNK])).delete(
+            synchronize_session=False
+        )
+        s.commit()
+        # let the handlers in between chunks
+        eventlet.sleep(0)
+    return len(expired)
+
+
+"""
+Runs the retention job forever in a greenthread.
+"""
+
+
+def notice_retention(Session):
+    while True:
+        s = Session()
+        try:
+            removed = prune_notices(s)
+            if removed:
+                print("--- pruned %d notices" % removed)
+        except Exception as err:
+            print(err)
+        finally:
+            s.close()
+        eventlet.sleep(RETENTION_INTERVAL)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["prune"]:
+        print("usage: python notifications.py prune")
+        sys.exit(1)
+    from sqlalchemy_base import Session
+
+    s = Session()
+    try:
+        print("removed %d notices" % prune_notices(s))
+    finally:
+        s.close()
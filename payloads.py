@@ -0,0 +1,132 @@
+from flask_socketio import join_room, leave_room
+from flask import request
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+"""
+Binary MessagePack event payloads, opted into by the client.
+
+Event payloads are JSON text by default. A client that connects with auth
+{"format": "msgpack"} (see handle_user_connect) gets every event as a single
+binary attachment holding the MessagePack encoded payload instead, a payload
+that is a tuple (several arguments for JSON clients) arrives as one array. Such
+a client may send its events the same way, one binary argument, and upload
+images as raw bytes. JSON clients can send raw bytes for images too, Socket.IO
+delivers binary attachments as bytes and image_handler stores them as they are.
+
+Clients are kept apart by rooms, so emits need no lookup of the recipient's
+format: a MessagePack client leaves its own sid room and joins "<room>#msgpack"
+for its sid and every chat, and an emit goes to the JSON room and, packed, to its
+#msgpack twin if that has members.
+
+When emits go through a message queue (see cluster.py) the emitter is given the
+socket_session Redis as its store, where the format and the rooms of MessagePack
+clients are kept for all processes: the BINARY_SIDS set holds their sids, so
+join() picks the right room for a sid connected to another process, and
+"binary_members:<room>" holds the MessagePack sids in a room. A process that dies
+leaves its sids in the member sets, which only costs packed emits nobody receives,
+sweep_dead_nodes (presence.py) drops them from BINARY_SIDS.
+
+Without the msgpack package the negotiation falls back to JSON.
+"""
+
+FORMAT_SUFFIX = "#msgpack"
+BINARY_SIDS = "binary_sids"
+
+
+def binary_room(room):
+    return "%s%s" % (room, FORMAT_SUFFIX)
+
+
+def negotiate(auth):
+    if msgpack is not None and isinstance(auth, dict) and auth.get("format") == "msgpack":
+        return "msgpack"
+    return "json"
+
+
+# anything msgpack has no type for is sent as its str(), like the timestamps of the JSON payloads
+def pack(data):
+    return msgpack.packb(data, use_bin_type=True, default=str)
+
+
+# sids of MessagePack clients connected to this process
+binary_sids = set()
+
+
+"""
+Decodes the arguments a MessagePack client (sid) sent as binary, other arguments and
+the arguments of JSON clients (binary attachments are theirs) are passed on as they are.
+Raises ValueError if a payload is not valid MessagePack.
+"""
+
+
+def unpack_args(sid, args):
+    if msgpack is None or sid not in binary_sids:
+        return args
+    try:
+        return [
+            msgpack.unpackb(arg, raw=False) if isinstance(arg, (bytes, bytearray)) else arg
+            for arg in args
+        ]
+    except (ValueError, TypeError, msgpack.UnpackException):
+        raise ValueError("Invalid MessagePack payload!")
+
+
+class PayloadEmitter:
+    def __init__(self, socket, store=None):
+        self.socket = socket
+        # Redis shared with the other processes, None when emits stay in this one
+        self.store = store
+        self.binary_sids = binary_sids
+
+    def has_binary_members(self, room):
+        if self.store is not None:
+            return self.store.exists("binary_members:%s" % room) > 0
+        return bool(self.socket.server.manager.rooms.get("/", {}).get(binary_room(room)))
+
+    def is_binary(self, sid):
+        if sid in self.binary_sids:
+            return True
+        return self.store is not None and bool(self.store.sismember(BINARY_SIDS, sid))
+
+    def emit(self, event, data=None, room=None, **kwargs):
+        self.socket.emit(event, data, room=room, **kwargs)
+        if msgpack is not None and self.has_binary_members(room):
+            self.socket.emit(
+                event,
+                pack(list(data) if isinstance(data, tuple) else data),
+                room=binary_room(room),
+                **kwargs
+            )
+
+    # moves the connecting client to its format's rooms
+    def connect(self, payload_format):
+        if payload_format == "msgpack":
+            self.binary_sids.add(request.sid)
+            if self.store is not None:
+                self.store.sadd(BINARY_SIDS, request.sid)
+            leave_room(request.sid)
+            self.join(request.sid)
+
+    def disconnect(self, sid):
+        if sid not in self.binary_sids:
+            return
+        self.binary_sids.discard(sid)
+        if self.store is not None:
+            pipe = self.store.pipeline()
+            pipe.srem(BINARY_SIDS, sid)
+            for room in self.socket.server.manager.get_rooms(sid, "/"):
+                if room.endswith(FORMAT_SUFFIX):
+                    pipe.srem("binary_members:%s" % room[: -len(FORMAT_SUFFIX)], sid)
+            pipe.execute()
+
+    def join(self, room, sid=None):
+        sid = sid or request.sid
+        if not self.is_binary(sid):
+            return join_room(room, sid=sid)
+        if self.store is not None:
+            self.store.sadd("binary_members:%s" % room, sid)
+        join_room(binary_room(room), sid=sid)
@@ -0,0 +1,114 @@
+import os, socket as net
+import eventlet
+from server_helpers import socket_session
+from payloads import BINARY_SIDS
+
+"""
+Presence lookups on top of the socket_session Redis (user id -> socket sid).
+
+Handlers that need the online state of many users (friends, chat members)
+resolve them here with a single MGET instead of one GET per user.
+
+When several server processes run (see cluster.py) each one is a node: the sids a
+node owns are kept in the "node:<NODE_ID>" hash (sid -> user id) and the node
+refreshes "node_alive:<NODE_ID>" while it runs. If a node dies without cleaning up,
+the heartbeat of the other nodes removes its users from socket_session.
+"""
+
+NODE_ID = os.environ.get("NODE_ID", "%s:%d" % (net.gethostname(), os.getpid()))
+NODE_TTL = int(os.environ.get("NODE_TTL", 30))
+
+# keys per MGET, keeps a single command from growing unbounded for huge friend lists
+MGET_CHUNK = 1000
+
+# deletes the user's entry only while it still holds the given sid, in one step: a
+# reconnect (another tab or node) between a GET and a DEL would lose its presence
+RELEASE_SID = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+"""
+Returns {user_id: sid} for the users in user_ids that are currently online.
+"""
+
+
+def online_sids(user_ids):
+    ids = list(dict.fromkeys(user_ids))
+    online = {}
+    for start in range(0, len(ids), MGET_CHUNK):
+        chunk = ids[start : start + MGET_CHUNK]
+        for user_id, sid in zip(chunk, socket_session.mget(chunk)):
+            if sid:
+                online[user_id] = sid
+    return online
+
+
+
+"""
+Marks the user online on this node.
+"""
+
+
+def register_sid(user_id, sid):
+    pipe = socket_session.pipeline()
+    pipe.set(user_id, sid)
+    pipe.hset("node:%s" % NODE_ID, sid, user_id)
+    pipe.execute()
+
+
+"""
+Marks the user offline, sid is the connection that went away (None drops any connection).
+"""
+
+
+def unregister_sid(user_id, sid=None):
+    pipe = socket_session.pipeline()
+    if sid is None:
+        pipe.delete(user_id)
+    else:
+        socket_session.register_script(RELEASE_SID)(keys=[user_id], args=[sid], client=pipe)
+        pipe.hdel("node:%s" % NODE_ID, sid)
+    pipe.execute()
+
+
+"""
+Removes the users of nodes whose heartbeat expired, returns the number of sids removed.
+"""
+
+
+def sweep_dead_nodes():
+    removed = 0
+    for key in socket_session.scan_iter("node:*"):
+        node = key[len("node:") :]
+        if node == NODE_ID or socket_session.exists("node_alive:%s" % node):
+            continue
+        owned = socket_session.hgetall(key)
+        release = socket_session.register_script(RELEASE_SID)
+        pipe = socket_session.pipeline()
+        # only drop users whose current sid is still the dead node's one
+        for sid, user_id in owned.items():
+            release(keys=[user_id], args=[sid], client=pipe)
+        if owned:
+            pipe.srem(BINARY_SIDS, *owned)
+        pipe.delete(key)
+        removed += sum(pipe.execute()[: len(owned)])
+    return removed
+
+
+"""
+Keeps this node alive and sweeps dead nodes, runs forever in a greenthread.
+"""
+
+
+def heartbeat():
+    while True:
+        try:
+            socket_session.set("node_alive:%s" % NODE_ID, 1, ex=NODE_TTL)
+            sweep_dead_nodes()
+        except Exception as err:
+            print(err)
+        eventlet.sleep(NODE_TTL / 3)
@@ -0,0 +1,123 @@
+import os, time
+from collections import OrderedDict
+from functools import wraps
+from eventlet.semaphore import Semaphore
+from flask import request
+from flask_login import current_user
+from metrics import handler_metrics
+
+"""
+Rate limits and backpressure for socket handlers, per process.
+
+Each limited event has a token bucket per sid and one per user, refilled at rate
+tokens a second up to burst. The user's bucket holds RATE_LIMIT_USER_FACTOR times
+as much, so a few tabs of one user can't multiply its rate either. An event of an
+expensive handler (DB scans, disk writes) also has to get one of EXPENSIVE_CONCURRENCY
+slots shared by all clients. It waits at most EXPENSIVE_WAIT (ms) for one.
+
+A rejected event is answered with RATE_LIMITED {"event", "retryAfter" (ms)} to the
+sid and counted in the handler metrics. It never reaches the handler, so no DB session
+is opened. The limit goes under disconnect_unauthorised, which knows the user:
+
+    @socket.on("LOAD_USERS")
+    @disconnect_unauthorised
+    @rate_limits.limit("LOAD_USERS", 0.05, 1, expensive=True)
+
+RATE_LIMIT_<EVENT>="<rate>/<burst>" overrides the defaults of an event, RATE_LIMITS=0
+turns the limits off (the throughput benchmarks do).
+"""
+
+ENABLED = os.environ.get("RATE_LIMITS", "1") == "1"
+USER_FACTOR = float(os.environ.get("RATE_LIMIT_USER_FACTOR", 2))
+EXPENSIVE_CONCURRENCY = int(os.environ.get("EXPENSIVE_CONCURRENCY", 8))
+EXPENSIVE_WAIT = float(os.environ.get("EXPENSIVE_WAIT", 500)) / 1000
+# buckets kept, the least recently used ones go first (a dropped bucket starts full again)
+BUCKETS = int(os.environ.get("RATE_LIMIT_BUCKETS", 100000))
+
+
+def configured(event, rate, burst):
+    spec = os.environ.get("RATE_LIMIT_%s" % event)
+    if not spec:
+        return rate, burst
+    rate, burst = spec.split("/")
+    return float(rate), float(burst)
+
+
+class RateLimits:
+    def __init__(
+        self,
+        reject,
+        user_factor=USER_FACTOR,
+        concurrency=EXPENSIVE_CONCURRENCY,
+        wait=EXPENSIVE_WAIT,
+        capacity=BUCKETS,
+    ):
+        # reject(sid, payload) sends the RATE_LIMITED
+        self.reject = reject
+        self.user_factor = user_factor
+        self.wait = wait
+        self.capacity = capacity
+        # {(sid or user id, event): [tokens, updated]}
+        self.buckets = OrderedDict()
+        self.expensive = Semaphore(concurrency)
+
+    def bucket(self, key, burst, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [burst, now]
+            while len(self.buckets) > self.capacity:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    # takes a token from the sid's and the user's bucket of the event, only if both have one,
+    # returns 0 or the seconds until the emptier bucket has a token again
+    def take(self, sid, user_id, event, rate, burst):
+        now = time.monotonic()
+        factor = self.user_factor
+        limits = (
+            (self.bucket((sid, event), burst, now), rate, burst),
+            (self.bucket((user_id, event), burst * factor, now), rate * factor, burst * factor),
+        )
+        wait = 0
+        for bucket, refill, size in limits:
+            bucket[0] = min(size, bucket[0] + (now - bucket[1]) * refill)
+            bucket[1] = now
+            if bucket[0] < 1:
+                wait = max(wait, (1 - bucket[0]) / refill)
+        if wait:
+            return wait
+        for bucket, _, _ in limits:
+            bucket[0] -= 1
+        return 0
+
+    def rejected(self, event, retry_after):
+        handler_metrics.rate_limited()
+        self.reject(request.sid, {"event": event, "retryAfter": int(retry_after * 1000) + 1})
+
+    def limit(self, event, rate, burst, expensive=False):
+        rate, burst = configured(event, rate, burst)
+
+        def decorator(f):
+            if not ENABLED:
+                return f
+
+            @wraps(f)
+            def limited(*args, **kwargs):
+                retry_after = self.take(request.sid, current_user.user_id, event, rate, burst)
+                if retry_after:
+                    return self.rejected(event, retry_after)
+                if not expensive:
+                    return f(*args, **kwargs)
+                # backpressure, every client waits for a slot and gives up after self.wait
+                if not self.expensive.acquire(timeout=self.wait):
+                    return self.rejected(event, self.wait)
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.expensive.release()
+
+            return limited
+
+        return decorator
@@ -0,0 +1,163 @@
+import logging, os
+from datetime import datetime
+import eventlet
+from sqlalchemy import or_, and_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy_classes import ChatReads, Message, UsersChats
+from unread_counters import reset_unread
+
+"""
+Read receipts for MARK_READ.
+
+Reading a chat is stored as one watermark per user and chat (chat_reads: the last
+message read), so marking a chat read never updates the messages themselves.
+Read events are merged in memory: READ_FLUSH_INTERVAL (ms) after the first one the
+newest watermark of every (chat, user) is written in a single transaction, and each
+chat room gets one READ_RECEIPT holding all the reads of that interval. The unread
+counters of the readers are reset in the same flush (see unread_counters.py). If the
+flush fails, its watermarks go back into the pending ones and are retried with the next.
+"""
+
+FLUSH_INTERVAL = float(os.environ.get("READ_FLUSH_INTERVAL", 200)) / 1000
+
+
+class ReadReceipts:
+    def __init__(self, engine, emit, flush_interval=FLUSH_INTERVAL, logger=None):
+        self.engine = engine
+        # emit(chat_id, payload) delivers a READ_RECEIPT to the chat room
+        self.emit = emit
+        self.logger = logger or logging.getLogger(__name__)
+        self.flush_interval = flush_interval
+        # {chat_id: {user_id: {"message_id", "message_created_at", "read_at"}}}
+        self.pending = {}
+        self.thread = None
+        self.flushes = 0
+
+    def mark_read(self, user_id, chat_id, message_id, message_created_at):
+        read = {
+            "message_id": message_id,
+            "message_created_at": message_created_at,
+            "read_at": datetime.utcnow(),
+        }
+        if self.merge(chat_id, user_id, read) and (self.thread is None or self.thread.dead):
+            self.thread = eventlet.spawn_after(self.flush_interval, self.run)
+
+    # keeps the newest watermark of (chat_id, user_id), returns whether read is it
+    def merge(self, chat_id, user_id, read):
+        reads = self.pending.setdefault(chat_id, {})
+        current = reads.get(user_id)
+        if current and (current["message_created_at"], current["message_id"]) >= (
+            read["message_created_at"],
+            read["message_id"],
+        ):
+            return False
+        reads[user_id] = read
+        return True
+
+    def flush(self, pending):
+        rows = [
+            dict(read, user_id=user_id, chat_id=chat_id)
+            for chat_id, reads in pending.items()
+            for user_id, read in reads.items()
+        ]
+        statement = insert(ChatReads.__table__)
+        stored = ChatReads.__table__.c
+        with self.engine.begin() as connection:
+            connection.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[stored.user_id, stored.chat_id],
+                    set_={
+                        "message_id": statement.excluded.message_id,
+                        "message_created_at": statement.excluded.message_created_at,
+                        "read_at": statement.excluded.read_at,
+                    },
+                    # a late flush never moves a watermark backwards
+                    where=or_(
+                        statement.excluded.message_created_at > stored.message_created_at,
+                        and_(
+                            statement.excluded.message_created_at == stored.message_created_at,
+                            statement.excluded.message_id > stored.message_id,
+                        ),
+                    ),
+                ),
+                rows,
+            )
+        self.flushes += 1
+
+    def run(self):
+        # reads marked while this flush yields (reset_unread, emit) schedule the next one
+        self.thread = None
+        pending, self.pending = self.pending, {}
+        try:
+            self.deliver(pending)
+        finally:
+            if self.pending and (self.thread is None or self.thread.dead):
+                self.thread = eventlet.spawn_after(self.flush_interval, self.run)
+
+    def deliver(self, pending):
+        if not pending:
+            return
+        try:
+            self.flush(pending)
+        except Exception:
+            self.logger.exception("read receipt flush failed, retrying")
+            # run() schedules the retry, reads marked meanwhile may be newer
+            for chat_id, reads in pending.items():
+                for user_id, read in reads.items():
+                    self.merge(chat_id, user_id, read)
+            return
+        try:
+            with self.engine.connect() as connection:
+                reset_unread(connection, {chat_id: list(reads) for chat_id, reads in pending.items()})
+        except Exception:
+            self.logger.exception("unread counters not reset")
+        for chat_id, reads in pending.items():
+            self.emit(chat_id, receipt_payload(chat_id, reads))
+
+
+def receipt_payload(chat_id, reads):
+    return {
+        "chatId": chat_id,
+        "reads": [
+            {
+                "userId": user_id,
+                "messageId": read["message_id"],
+                "readAt": str(read["read_at"]),
+            }
+            for user_id, read in reads.items()
+        ],
+    }
+
+
+"""
+Returns (id, created_at) of the message if it belongs to chat_id and user_id is a
+member of that chat, None otherwise.
+"""
+
+
+def readable_message(s, user_id, chat_id, message_id):
+    return (
+        s.query(Message.id, Message.created_at)
+        .join(UsersChats, UsersChats.chat_id == Message.chat_id)
+        .filter(
+            Message.id == message_id,
+            Message.chat_id == chat_id,
+            UsersChats.user_id == user_id,
+        )
+        .first()
+    )
+
+
+"""
+Returns the READ_RECEIPT payload with every stored watermark of a chat.
+"""
+
+
+def load_read_states(s, chat_id):
+    reads = {
+        i.user_id: {"message_id": i.message_id, "read_at": i.read_at}
+        for i in s.query(ChatReads.user_id, ChatReads.message_id, ChatReads.read_at).filter(
+            ChatReads.chat_id == chat_id
+        )
+    }
+    return receipt_payload(chat_id, reads)
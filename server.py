@@ -1,9 +1,13 @@
-import datetime, os, eventlet, uuid
-from flask import Flask, request, make_response, json, render_template
-from flask_socketio import SocketIO, join_room, leave_room, disconnect
+import eventlet
+
+# patch before anything else imports socket/threading (redis, tpool locks, sqlalchemy pools)
+eventlet.monkey_patch()
+
+import datetime, os, uuid
+from flask import Flask, request, make_response, json, render_template, g, session
+from flask_socketio import SocketIO, join_room, leave_room, disconnect, rooms
 from flask_cors import CORS
 from flask_login import login_user, current_user, logout_user
-from numpy import single
 from sqlalchemy import true,desc
 from sqlalchemy_classes import Circle, User, Message, Chat, Notice
 from sqlalchemy_base import Session, Base, engine
@@ -14,9 +18,51 @@ from server_helpers import (
     disconnect_unauthorised,
     login_manager,
     verify_password,
-    image_handler,
+    delete_session,
+    listen_for_session_invalidation,
+    on_payload_error,
+)
+from chat_list import load_chat_list
+from presence import online_sids, register_sid, unregister_sid, heartbeat
+from message_history import load_messages, serialize_message
+from timeline import load_timeline, publish_circle, friend_ids, hot_timelines
+from media_store import image_handler, release_media
+from user_search import index_user, search_users, PAGE_SIZE as SEARCH_PAGE_SIZE
+from message_writer import get_message_writer, message_row
+from read_receipts import ReadReceipts, readable_message, load_read_states
+from notifications import (
+    load_notices,
+    unread_notices,
+    serialize_notice,
+    notice_retention,
+)
+from metrics import handler_metrics, instrument_engine, instrument_redis
+from migrate import migrate
+from message_search import search_messages, PAGE_SIZE as MESSAGE_SEARCH_PAGE_SIZE
+from unread_counters import unread_store
+from payloads import (
+    PayloadEmitter,
+    negotiate,
+    binary_room,
+    unpack_args,
+)
+from websocket_masking import patch_websocket_masking
+from typing_indicators import TypingIndicators
+from rate_limits import RateLimits
+from chat_cache import chat_members, invalidate_chat, listen_for_chat_invalidation
+from chat_create import find_users, find_direct_chat, create_chat
+from friend_suggestions import (
+    record_friendship,
+    load_suggestions,
+    TOP_K as SUGGESTIONS_TOP_K,
+)
+from sync import (
+    load_delta,
+    decode_sync_cursor,
+    encode_sync_cursor,
+    record_change,
+    sync_retention,
 )
-eventlet.monkey_patch()
 
 # init the flask
 app = Flask(
@@ -28,11 +74,83 @@ CORS(app, supports_credentials=True)
 login_manager.init_app(app)
 
 # init socketIO
-socket = SocketIO(app, async_mode="eventlet", cors_allowed_origins='*')
+# with SOCKETIO_MESSAGE_QUEUE (a redis url) emits and room joins reach sockets of every
+# server process, see cluster.py
+socket = SocketIO(
+    app,
+    async_mode="eventlet",
+    cors_allowed_origins='*',
+    message_queue=os.environ.get("SOCKETIO_MESSAGE_QUEUE"),
+)
+
+# every emit goes through the emitter, which also delivers it to MessagePack clients (see payloads.py)
+emitter = PayloadEmitter(
+    socket, store=socket_session if os.environ.get("SOCKETIO_MESSAGE_QUEUE") else None
+)
+# opt-in (WEBSOCKET_MASK_PATCH=1): eventlet unmasks uploads at a microsecond per byte,
+# see websocket_masking.py
+patch_websocket_masking()
+
+# read watermarks are flushed in batches, one READ_RECEIPT per chat room and interval
+read_receipts = ReadReceipts(
+    engine,
+    lambda chat_id, payload: emitter.emit("READ_RECEIPT", payload, room=chat_id),
+    logger=app.logger,
+)
+
+# per sid and user token buckets, checked before a handler opens its DB session
+rate_limits = RateLimits(
+    lambda sid, payload: emitter.emit("RATE_LIMITED", payload, room=sid)
+)
+
+# typing state lives in memory only, one TYPING per chat room and interval
+typing_indicators = TypingIndicators(
+    lambda chat_id, payload: emitter.emit("TYPING", payload, room=chat_id)
+)
 
 # setting the secret_key
 app.config["SECRET_KEY"] = "1234567890"
 
+# count the SQL statements and Redis round trips of every handler, see metrics.py
+instrument_engine(engine)
+instrument_redis(logon_session, socket_session, unread_store)
+
+
+"""
+Tracks every HTTP route in the handler metrics, socket events are tracked by disconnect_unauthorised.
+"""
+
+
+@app.before_request
+def start_request_metrics():
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_call = handler_metrics.start("http", rule)
+
+
+@app.after_request
+def mark_failed_request(response):
+    if response.status_code >= 500:
+        handler_metrics.error()
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(err=None):
+    if "metrics_call" in g:
+        handler_metrics.finish(g.pop("metrics_call"), failed=err is not None)
+
+
+"""
+Prometheus scrape endpoint with the handler metrics of this process.
+"""
+
+
+@app.route("/metrics")
+def handle_metrics():
+    return make_response(
+        handler_metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+    )
+
 
 """
 Catch all for react SPA.
@@ -73,6 +191,7 @@ def handle_register():
         # New user -> Create User object, add user to DB.
         user = User(nickname, username,  password, firstname, lastname, email)
         s.add(user)
+        index_user(s, user)
         s.commit()
 
         # Return 201 on successful creation of user
@@ -96,10 +215,10 @@ def handle_logout():
         login_status("SET_FRIEND_OFFLINE", current_user.user_id, s)
         # tell all the sockets the user is logout
         if sid:
-            socket.emit("LOGOUT", room=sid)
+            emitter.emit("LOGOUT", room=sid)
             # according to the key in the two redis to delete the corresponding save
-            logon_session.delete(current_user.session)
-            socket_session.delete(current_user.user_id)
+            delete_session(current_user.session)
+            unregister_sid(current_user.user_id, sid)
             # the client will recieve a disconnect message
             disconnect(sid=sid, namespace="/")
             # log out change the current_user in flasklogin
@@ -203,14 +322,16 @@ Error function to emit an error message to the client with a messaged to display
 """
 
 
+@on_payload_error
 def genError(sid, msg):
+    handler_metrics.error()
     try:
         s = Session()
         user = s.query(User).get(current_user.user_id)
-        singleNotice = Notice("ERROR", "System", msg)
+        singleNotice = Notice("ERROR", "System", "System", str(msg))
         user.Notices.append(singleNotice)
         s.commit()
-        return socket.emit(
+        return emitter.emit(
             "ADD_NOTIFICATION",
             {
                 "id": singleNotice.id,
@@ -228,8 +349,8 @@ def genError(sid, msg):
 
 
 """
-Retrieves the users chats from the DB, parses the data and returns a dict with the chat info
-and the last 50 messages for the chat. Each chat(socketio room) then be 'joined'.
+Retrieves the users chats from the DB through the chat list read model (see chat_list.py),
+each chat(socketio room) then be 'joined'.
 The data will then be emitted to the client.
 """
 
@@ -238,32 +359,11 @@ def getChats(sid, s):
     try:
         if sid in {None, ""}:
             raise ValueError("SID and/or session not provided!")
-        query = s.query(User).get(current_user.user_id).chats.all()
-        chats = [
-            {
-                "id": i.id,
-                "chat_name":("、".join([ single.userNickname for single in i.users.filter(User.id != current_user.user_id)
-                .all()])),
-                "recipient": [ single.username for single in i.users.filter(User.id != current_user.user_id)
-                .all()],
-                "recipientId": [ single.id for single in i.users.filter(User.id != current_user.user_id)
-                .all()],
-                "active": socket_session.get(
-                    i.users.filter(User.id != current_user.user_id).first().id
-                )
-                != None,
-                "avatar": i.users.filter(User.id != current_user.user_id)
-                .first()
-                .avatar,
-                "last_message": i.last_message,
-                "last_message_timestamp": str(i.last_message_timestamp),
-            }
-            for i in query
-        ]
+        chats = load_chat_list(s, current_user.user_id)
 
         for i in chats:
-            join_room(i["id"])
-        socket.emit("LOAD_CHATS", chats, room=sid)
+            emitter.join(i["id"])
+        emitter.emit("LOAD_CHATS", chats, room=sid)
 
     except ValueError as err:
         print(err)
@@ -280,8 +380,9 @@ def getFriends(sid, s):
         print("getFriends: ", sid)
         if sid in {None, ""}:
             raise TypeError("SID and/or session not provided!")
-        friends = s.query(User).get(current_user.user_id).friends
-        socket.emit(
+        friends = s.query(User).get(current_user.user_id).friends.all()
+        online = online_sids([i.id for i in friends])
+        emitter.emit(
             "LOAD_FRIENDS",
             #todo change the form to the same as above chats
             [
@@ -290,7 +391,7 @@ def getFriends(sid, s):
                     "username": i.username,
                     "userNickname": i.userNickname,
                     "avatar": i.avatar,
-                    "active": socket_session.get(i.id) != None,
+                    "active": i.id in online,
                 }
                 for i in friends
             ],
@@ -302,7 +403,8 @@ def getFriends(sid, s):
 
 
 """
-Retrieves the users Notices from the DB, parses the data and emits to the client.
+Retrieves the latest page of the users Notices from the DB (see notifications.py) and emits it
+to the client with the cursor for LOAD_OLDER_NOTIFICATIONS and the number of unread Notices.
 """
 
 
@@ -310,50 +412,37 @@ def getNotices(sid, s):
     try:
         if sid in {None, ""}:
             raise TypeError("SID and/or session not provided!")
-        Notices = s.query(User).get(current_user.user_id).Notices.all()
-        socket.emit(
+        notices, cursor = load_notices(s, current_user.user_id)
+        emitter.emit(
             "LOAD_NOTIFICATIONS",
-            [
-                {
-                    "id": x.id,
-                    #todo check this for what?
-                    "sender": x.sender,
-                    "type": x.type,
-                    "dismissed": x.dismissed,
-                    "message": x.message,
-                    "avatar": x.avatar,
-                }
-                for x in Notices
-            ],
+            # a tuple is delivered as three arguments: (notices, cursor, unread)
+            (
+                [serialize_notice(x) for x in notices],
+                cursor,
+                unread_notices(s, current_user.user_id),
+            ),
             room=sid,
         )
     except (ValueError, TypeError) as err:
         print(err)
         genError(request.sid, err)
 
+
+"""
+Retrieves the first page of the users circle timeline and emits it to the client.
+"""
+
+
 def getCircles(sid ,s):
     try:
         print("getCircles: ", sid)
         if sid in {None, ""}:
             raise TypeError("SID and/or session not provided!")
-        circles = s.query(User).get(current_user.user_id).circles.order_by(desc(Circle.created_at)).limit(10).all()
-        print([ str(i.created_at) for i in circles])
-        socket.emit(
+        circles, cursor = load_timeline(s, current_user.user_id)
+        emitter.emit(
             "LOAD_CIRCLES",
-            #todo change the form to the same as above chats
-            [
-                {
-                    "id": i.id,
-                    "userNickname": i.userNickname,
-                    "avatar":
-                    i.visiable.filter(User.id == i.user_id)
-                    .first()
-                    .avatar,
-                    "circle": i.content,
-                    "create_at": str(i.created_at.strftime("%Y-%m-%d %H:%M:%S"))
-                }
-                for i in circles
-            ],
+            # a tuple is delivered as two arguments: (circles, cursor)
+            (circles, cursor),
             room=sid,
         )
     except TypeError as err:
@@ -361,13 +450,84 @@ def getCircles(sid ,s):
         genError(request.sid, err)
 
 
+"""
+Emits only what changed since the client's last sync (see sync.py) and joins the rooms of all
+the users chats. Notices and circles that changed too much are sent in full.
+"""
+
+
+def syncChanges(sid, s, since):
+    chat_ids, delta, reload = load_delta(s, current_user.user_id, since)
+    for chat_id in chat_ids:
+        emitter.join(chat_id)
+    if "notices" in reload:
+        getNotices(sid, s)
+    if "circles" in reload:
+        getCircles(sid, s)
+    return delta
+
+
+"""
+Loads the page of circles older than the given cursor when the user scrolls down the timeline.
+"""
+
+
+@socket.on("LOAD_OLDER_CIRCLES")
+@disconnect_unauthorised
+@rate_limits.limit("LOAD_OLDER_CIRCLES", 2, 10)
+def handleLoadOlderCircles(cursor=None):
+    try:
+        if cursor in {None, ""}:
+            raise TypeError("Cursor not provided!")
+
+        s = Session()
+        circles, cursor = load_timeline(s, current_user.user_id, cursor)
+        emitter.emit(
+            "LOAD_OLDER_CIRCLES",
+            {"circles": circles, "cursor": cursor},
+            room=request.sid,
+        )
+    except (ValueError, TypeError) as err:
+        print(err)
+        genError(request.sid, err)
+    finally:
+        if "s" in locals():
+            s.close()
+
+
+"""
+Loads the page of Notices older than the given cursor.
+"""
+
+
+@socket.on("LOAD_OLDER_NOTIFICATIONS")
+@disconnect_unauthorised
+@rate_limits.limit("LOAD_OLDER_NOTIFICATIONS", 2, 10)
+def handleLoadOlderNotices(cursor=None):
+    try:
+        if cursor in {None, ""}:
+            raise TypeError("Cursor not provided!")
+
+        s = Session()
+        notices, cursor = load_notices(s, current_user.user_id, cursor)
+        emitter.emit(
+            "LOAD_OLDER_NOTIFICATIONS",
+            {"notices": [serialize_notice(x) for x in notices], "cursor": cursor},
+            room=request.sid,
+        )
+    except (ValueError, TypeError) as err:
+        print(err)
+        genError(request.sid, err)
+    finally:
+        if "s" in locals():
+            s.close()
+
+
 def login_status(status, id, s):
     try:
         friends = s.query(User).get(id).friends
-        for i in friends:
-            friend_sid = socket_session.get(i.id)
-            if friend_sid:
-                socket.emit(status, id, room=friend_sid)
+        for friend_sid in online_sids([i.id for i in friends]).values():
+            emitter.emit(status, id, room=friend_sid)
     except (ValueError, TypeError) as err:
         print(err)
 
@@ -380,20 +540,42 @@ emits chats, friends, Notices and login status.
 
 @socket.on("connect")
 @disconnect_unauthorised
-def handle_user_connect():
+def handle_user_connect(auth=None):
     print("--- CONNECTED_USER: %s" % current_user.user)
     try:
         # Store session details in redis
         # sid come from client
-        socket_session.set(current_user.user_id, request.sid)
+        # clients that ask for MessagePack get binary payloads from here on, the format
+        # is stored before the sid can be looked up by other processes
+        emitter.connect(negotiate(auth))
+        register_sid(current_user.user_id, request.sid)
+        # the Socket.IO session lives as long as the sid, TYPING reads the sender from it
+        session["typing_user"] = {
+            "id": current_user.user_id,
+            "username": current_user.user,
+            "userNickname": current_user.userNickname,
+        }
+
+        # a reconnecting client sends the cursor of its last SYNC, see sync.py
+        now = datetime.datetime.utcnow()
+        since = decode_sync_cursor(auth.get("since"), now) if isinstance(auth, dict) else None
 
-        # Get initial data and send to client
         s = Session()
-        getChats(request.sid, s)
-        getFriends(request.sid, s)
-        getNotices(request.sid, s)
-        #todo
-        getCircles(request.sid, s)
+        if since is None:
+            # Get initial data and send to client
+            getChats(request.sid, s)
+            getFriends(request.sid, s)
+            getNotices(request.sid, s)
+            #todo
+            getCircles(request.sid, s)
+            sync = {}
+        else:
+            sync = syncChanges(request.sid, s, since)
+        emitter.emit(
+            "SYNC",
+            dict(sync, cursor=encode_sync_cursor(now), full=since is None),
+            room=request.sid,
+        )
         # Send login status to all friends
         login_status("SET_FRIEND_ONLINE", current_user.user_id, s)
 
@@ -415,13 +597,15 @@ Removes the use from socket s Redis and emits the user's login status
 def handle_user_disconnect():
     try:
         print("--- DISCONNECTED: ", current_user.user)
+        emitter.disconnect(request.sid)
+        typing_indicators.disconnect(request.sid)
         # Check if user is anonymous(when user logs out)
         if not current_user.is_anonymous:
             return
 
         # Delete the users session from Redis
         # logon_session.delete(current_user.session)
-        socket_session.delete(current_user.user_id)
+        unregister_sid(current_user.user_id, request.sid)
 
         # Create session and pass to login_status function
         s = Session()
@@ -436,13 +620,14 @@ def handle_user_disconnect():
 
 
 """
-Emits data for all users to client, used for searching.
+Emits data for all users to client, used for searching by older clients, prefer SEARCH_USERS.
 Excludes users that have not opted in to being visible in searches.
 """
 
 
 @socket.on("LOAD_USERS")
 @disconnect_unauthorised
+@rate_limits.limit("LOAD_USERS", 0.05, 1, expensive=True)
 def handle_all_accounts():
     try:
         print("--- LOAD_USERS: ", current_user.user)
@@ -454,7 +639,7 @@ def handle_all_accounts():
         )
         print(query)
         #todo clearify the room parameter meaning and usage
-        socket.emit(
+        emitter.emit(
             "LOAD_USERS",
             [{"id": i.id, "username": i.username,"userNickname": i.userNickname, "avatar": i.avatar} for i in query],
             room=request.sid,
@@ -468,49 +653,151 @@ def handle_all_accounts():
 
 
 """
-Stores message in DB and emits message to intended recipient/chat.
+Searches users by username/nickname substring through the search index (see user_search.py),
+emits one page of matches and the cursor of the next page.
+Excludes users that have not opted in to being visible in searches.
+"""
+
+
+@socket.on("SEARCH_USERS")
+@disconnect_unauthorised
+@rate_limits.limit("SEARCH_USERS", 2, 10, expensive=True)
+def handle_search_users(data=None):
+    try:
+        if data is None or data.get("query") in {None, ""}:
+            raise TypeError("Search query not provided!")
+
+        s = Session()
+        users, cursor = search_users(
+            s,
+            data["query"],
+            current_user.user_id,
+            data.get("cursor"),
+            data.get("limit") or SEARCH_PAGE_SIZE,
+        )
+        emitter.emit(
+            "SEARCH_USERS",
+            {"query": data["query"], "users": users, "cursor": cursor},
+            room=request.sid,
+        )
+    except (ValueError, TypeError) as err:
+        print(err)
+        genError(request.sid, err)
+    finally:
+        if "s" in locals():
+            s.close()
+
+
+"""
+Emits the users precomputed as "people you may know" (see friend_suggestions.py),
+most mutual friends first. Excludes users that have not opted in to being visible in searches.
+"""
+
+
+@socket.on("LOAD_FRIEND_SUGGESTIONS")
+@disconnect_unauthorised
+@rate_limits.limit("LOAD_FRIEND_SUGGESTIONS", 1, 5)
+def handle_friend_suggestions(data=None):
+    try:
+        s = Session()
+        emitter.emit(
+            "LOAD_FRIEND_SUGGESTIONS",
+            load_suggestions(
+                s, current_user.user_id, (data or {}).get("limit") or SUGGESTIONS_TOP_K
+            ),
+            room=request.sid,
+        )
+    except (ValueError, TypeError) as err:
+        print(err)
+        genError(request.sid, err)
+    finally:
+        if "s" in locals():
+            s.close()
+
+
+"""
+Full text search over the messages of the users chats (or of one chat), see message_search.py.
+Emits one page of ranked results with snippets and the cursor of the next page.
+"""
+
+
+@socket.on("SEARCH_MESSAGES")
+@disconnect_unauthorised
+@rate_limits.limit("SEARCH_MESSAGES", 1, 5, expensive=True)
+def handle_search_messages(data=None):
+    try:
+        if data is None or data.get("query") in {None, ""}:
+            raise TypeError("Search query not provided!")
+
+        s = Session()
+        results, cursor = search_messages(
+            s,
+            data["query"],
+            current_user.user_id,
+            data.get("chat") or None,
+            data.get("cursor"),
+            data.get("limit") or MESSAGE_SEARCH_PAGE_SIZE,
+        )
+        emitter.emit(
+            "SEARCH_MESSAGES",
+            {"query": data["query"], "chat": data.get("chat"), "results": results, "cursor": cursor},
+            room=request.sid,
+        )
+    except (ValueError, TypeError) as err:
+        print(err)
+        genError(request.sid, err)
+    finally:
+        if "s" in locals():
+            s.close()
+
+
+"""
+Stores message in DB through the group commit writer (see message_writer.py)
+and emits message to intended recipient/chat.
 """
 
 
 @socket.on("ADD_MESSAGE_TO_CHAT")
 @disconnect_unauthorised
+@rate_limits.limit("ADD_MESSAGE_TO_CHAT", 5, 20)
 def handle_new_message(data=None):
     try:
         if data.get("chat") in {None, ""}:
             raise TypeError("Chat ID not provided!")
 
         if data.get("message") in {None, ""}:
-            if None or "" in {data.get("image"), data.get("extension")}:
+            if not (data.get("image") and data.get("extension")):
                 raise TypeError("Message, image and/or extension not provided.")
 
-        s = Session()
-        chat = s.query(Chat).get(data["chat"])
+        # cached chat and member ids, no SQL once the chat is known (see chat_cache.py)
+        chat = chat_members(Session, data["chat"])
 
         if not chat:
             raise ValueError("Chat not found!")
+        if current_user.user_id not in chat.members:
+            raise ValueError("You are not a member of this chat!")
 
         m = Message(current_user.user,current_user.userNickname)
         if data.get("message"):
             m.message = data["message"]
-            chat.last_message = f"{data['message'][:16]}..."
+            last_message = f"{data['message'][:16]}..."
 
         if data.get("image") and data.get("extension"):
             fileName = image_handler(data["image"], data["extension"])
             if not fileName:
                 raise ValueError("File not created")
             m.image = fileName
-            chat.last_message = "Image"
+            last_message = "Image"
 
-        chat.messages.append(m)
-        chat.last_message_timestamp = m.created_at
-        s.commit()
+        # returns once the batch holding the message is committed
+        get_message_writer().write(message_row(m, data["chat"]), last_message)
 
-        socket.emit(
+        emitter.emit(
             "ADD_MESSAGE_TO_CHAT",
             {
                 "chatId": data["chat"],
-                "last_message": chat.last_message,
-                "last_message_timestamp": str(chat.last_message_timestamp)[:5],
+                "last_message": last_message,
+                "last_message_timestamp": str(m.created_at)[:5],
                 "message": {
                     "username": current_user.user,
                     "userNickname": current_user.userNickname,
@@ -521,6 +808,8 @@ def handle_new_message(data=None):
             },
             room=data["chat"],
         )
+        # ack for clients that passed a callback, only sent after the durable commit
+        return {"chatId": data["chat"], "id": m.id}
 
     except (TypeError, ValueError) as err:
         print(err)
@@ -531,37 +820,143 @@ def handle_new_message(data=None):
 
 
 """
-Loads messages for the currently active chat
+Records that the user has read the chat up to the given message. The watermark is
+written once and READ_RECEIPTs are sent to the chat room in batches (see read_receipts.py).
+"""
+
+
+@socket.on("MARK_READ")
+@disconnect_unauthorised
+@rate_limits.limit("MARK_READ", 10, 30)
+def handleMarkRead(data=None):
+    try:
+        if data is None or data.get("chat") in {None, ""}:
+            raise TypeError("Chat id not provided!")
+        if data.get("message") in {None, ""}:
+            raise TypeError("Message id not provided!")
+
+        s = Session()
+        message = readable_message(s, current_user.user_id, data["chat"], data["message"])
+
+        if not message:
+            raise ValueError("Invalid chat or message id provided!")
+
+        read_receipts.mark_read(current_user.user_id, data["chat"], message.id, message.created_at)
+
+    except (ValueError, TypeError) as err:
+        print(err)
+        genError(request.sid, err)
+
+    finally:
+        if "s" in locals():
+            s.close()
+
+
+"""
+Marks the user as typing or not in a chat, see typing_indicators.py. Sent on keystrokes,
+so it skips disconnect_unauthorised and its session lookup: the sender was authorised
+on connect (a logout disconnects it) and is only accepted for chats whose room
+its sid has joined.
+"""
+
+
+@socket.on("TYPING")
+def handleTyping(data=None):
+    handler_metrics.track("socket", "TYPING", typing_notice, request.sid, data)
+
+
+def typing_notice(sid, data):
+    try:
+        data = unpack_args(sid, [data])[0]
+        user = session.get("typing_user")
+        if user is None:
+            return
+        if not isinstance(data, dict) or data.get("chat") in {None, ""}:
+            raise TypeError("Chat id not provided!")
+
+        joined = rooms()
+        if data["chat"] not in joined and binary_room(data["chat"]) not in joined:
+            raise ValueError("Invalid chat id provided!")
+
+        typing_indicators.update(sid, user, data["chat"], bool(data.get("typing", True)))
+
+    # dropped without an ERROR notice, genError writes one to the database
+    except (ValueError, TypeError) as err:
+        print(err)
+
+
+"""
+Loads the latest page of messages for the currently active chat, the cursor for
+LOAD_OLDER_MESSAGES is sent as a second argument (None when there is no older page).
 """
 
 
 @socket.on("LOAD_ACTIVE_CHAT_MESSAGES")
 @disconnect_unauthorised
+@rate_limits.limit("LOAD_ACTIVE_CHAT_MESSAGES", 5, 20)
 def handleLoadMessages(chatId=None):
     try:
         if chatId in {None, ""}:
             raise TypeError("Chat id not provided!")
 
-        s = Session()
-        chat = s.query(Chat).get(chatId)
+        # cached chat and member ids, as for ADD_MESSAGE_TO_CHAT (see chat_cache.py)
+        chat = chat_members(Session, chatId)
 
         if not chat:
-            return ValueError("Invalid chat id provided!")
+            raise ValueError("Invalid chat id provided!")
+        if current_user.user_id not in chat.members:
+            raise ValueError("You are not a member of this chat!")
 
-        messages = chat.messages.limit(50).all()
-        socket.emit(
+        s = Session()
+        messages, cursor = load_messages(s, chatId)
+        emitter.emit(
             "LOAD_ACTIVE_CHAT_MESSAGES",
-            [
-                {
-                    "id": i.id,
-                    "message": i.message,
-                    "username": i.username,
-                    "userNickname": i.userNickname,
-                    "timestamp": str(i.created_at),
-                    "image": i.image,
-                }
-                for i in messages
-            ],
+            # a tuple is delivered as two arguments: (messages, cursor)
+            ([serialize_message(i) for i in messages], cursor),
+            room=request.sid,
+        )
+        emitter.emit("READ_RECEIPT", load_read_states(s, chatId), room=request.sid)
+
+    except (ValueError, TypeError) as err:
+        print(err)
+        genError(request.sid, err)
+
+    finally:
+        if "s" in locals():
+            s.close()
+
+
+"""
+Loads the page of messages older than the given cursor when the user scrolls up.
+"""
+
+
+@socket.on("LOAD_OLDER_MESSAGES")
+@disconnect_unauthorised
+@rate_limits.limit("LOAD_OLDER_MESSAGES", 2, 10)
+def handleLoadOlderMessages(data=None):
+    try:
+        if data is None or data.get("chat") in {None, ""}:
+            raise TypeError("Chat id not provided!")
+        if data.get("cursor") in {None, ""}:
+            raise TypeError("Cursor not provided!")
+
+        chat = chat_members(Session, data["chat"])
+
+        if not chat:
+            raise ValueError("Invalid chat id provided!")
+        if current_user.user_id not in chat.members:
+            raise ValueError("You are not a member of this chat!")
+
+        s = Session()
+        messages, cursor = load_messages(s, data["chat"], data["cursor"])
+        emitter.emit(
+            "LOAD_OLDER_MESSAGES",
+            {
+                "chatId": data["chat"],
+                "messages": [serialize_message(i) for i in messages],
+                "cursor": cursor,
+            },
             room=request.sid,
         )
 
@@ -571,14 +966,16 @@ def handleLoadMessages(chatId=None):
 
     finally:
         if "s" in locals():
-            s.close
+            s.close()
 
 
 """
-Creates a circle, adds the creater, Stores circle in DB and emits to the friends the circle details
+Creates a circle, stores it once in the DB (friends read it through their timeline, see timeline.py)
+and emits the circle details to the creater and the online friends.
 """
 @socket.on("ADD_CIRCLE")
 @disconnect_unauthorised
+@rate_limits.limit("ADD_CIRCLE", 0.5, 5)
 def handle_new_circle(data=None):
     try:
         if data.get("userId") in {None, ""}:
@@ -592,49 +989,16 @@ def handle_new_circle(data=None):
         if not user:
             raise ValueError("User doesn't exist")
 
-        userNickname = user.userNickname
-        userid = user.id
-        friends = user.friends
-        NewCircle = Circle(userNickname,userid)
-        NewCircle.content =data["circle"]
-        print("---receive content:",NewCircle.content)
-        
-        user.circles.append(NewCircle)
-        for singleFriend in friends:
-            singleFriend.circles.append(NewCircle)
-        s.commit()
+        friends = friend_ids(s, user.id)
+        post = publish_circle(s, user, data["circle"], friends)
+        print("---receive content:", post["circle"])
 
         #emit to the creater
-        socket.emit(
-            "ADD_CIRCLE",
-            {
-                "id": NewCircle.id,
-                "username": user.username,
-                "userNickname": NewCircle.userNickname,
-                "avatar":NewCircle.visiable.filter(User.id ==NewCircle.user_id)
-                    .first()
-                    .avatar,
-                "circle": NewCircle.content,
-                "create_at":str(NewCircle.created_at.strftime("%Y-%m-%d %H:%M:%S")),
-                },
-            room=request.sid,
-            )
+        emitter.emit("ADD_CIRCLE", dict(post, username=user.username), room=request.sid)
 
-        
         #emit to his friends
-        for recipient in friends:
-            recipient_sid = socket_session.get(recipient.id)
-            if recipient_sid:
-                socket.emit(
-                    "ADD_CIRCLE",
-                    {
-                        "id": NewCircle.id,
-                        "user": NewCircle.userNickname,
-                        "circle": NewCircle.content,
-                        "create_at":NewCircle.created_at
-                    },
-                    room=recipient_sid,
-                )
+        for recipient_sid in online_sids(friends).values():
+            emitter.emit("ADD_CIRCLE", dict(post, user=post["userNickname"]), room=recipient_sid)
     except (ValueError, TypeError) as err:
         print(err)
         genError(request.sid, err)
@@ -642,45 +1006,56 @@ def handle_new_circle(data=None):
         if "s" in locals():
             s.close()
 
+
+"""
+Creates a chat of the current user and the given usernames and sends it to every member
+online. A direct chat (one username) that exists already is only sent to the current user
+again, see chat_create.py.
+"""
+
+
 @socket.on("ADD_CHAT")
 @disconnect_unauthorised
+@rate_limits.limit("ADD_CHAT", 1, 10)
 def handle_new_group_chat(users=None):
     try:
-        if users == None:
+        if users == None or not isinstance(users, list):
             raise TypeError("User not provided.")
         print(users)
         s = Session()
 
-        # set the sender and recipients of the chat
-        sender = s.query(User).filter(User.username == current_user.user).first()
-        recipients = [s.query(User).filter(User.username == user).first() for user in users]
+        # set the creator and recipients of the chat, resolved with one IN query (see chat_create.py)
+        usernames = list(dict.fromkeys(users))
+        found = find_users(s, list(dict.fromkeys(usernames + [current_user.user])))
+        creator = next((i for i in found if i.id == current_user.user_id), None)
+        recipients = [i for i in found if i.username in usernames]
 
-        if not recipients:
+        if not recipients or len(recipients) < len(usernames):
             raise ValueError("User doesn't exist")
 
-        # init the chat name \ the chat id\ chat avatar
-        if len(users) == 1:
+        # init the chat name \ the chat avatar
+        if len(recipients) == 1:
             chat_avatar = recipients[0].avatar
             chat_name = recipients[0].userNickname
-            
         else:
             chat_avatar = ""
             chat_name = ("、".join([ i.userNickname for i in recipients]))
-        createrID=sender.id
-        chat = Chat(chat_name,createrID)
-        chat_id = chat.id
-        
-
-        # add chat to user
-        sender.chats.append(chat)
-        for recipient in recipients:
-            recipient.chats.append(chat)
-        s.commit()
+        member_ids = list(dict.fromkeys([current_user.user_id] + [i.id for i in recipients]))
+        direct = len(recipients) == 1
+
+        # a direct chat is only created once, asking again returns the existing one
+        chat_id = find_direct_chat(s, member_ids) if direct else None
+        created = False
+        if chat_id is None:
+            chat_id, created = create_chat(s, chat_name, current_user.user_id, member_ids, direct)
+        if created:
+            # evicts a lookup of the id made before the members were committed
+            invalidate_chat(chat_id)
 
         # set a room
-        join_room(chat_id)
+        emitter.join(chat_id)
 
-        socket.emit(
+        emitter.emit(
             "ADD_CHAT",
             {
                 "id": chat_id,
@@ -692,34 +1067,42 @@ def handle_new_group_chat(users=None):
             room=request.sid,
         )
 
+        # the other member of an existing direct chat has it already
+        if not created:
+            return
+
         # set the avatar of the chat for other recipient
-        if len(users) > 1:
-            recipient_chat_avatar = sender.avatar
+        if len(recipients) > 1:
+            # from the database, the login session's copy is stale after ACCOUNT_UPDATE
+            recipient_chat_avatar = creator.avatar if creator else ""
         else:
             recipient_chat_avatar = ""
 
+        members = [(current_user.user_id, current_user.user, current_user.userNickname)]
+        members += [(i.id, i.username, i.userNickname) for i in recipients]
+
         #todo what if he dont active now?
+        online = online_sids([recipient.id for recipient in recipients])
         for recipient in recipients:
-            recipient_sid = socket_session.get(recipient.id)
-            member_except_now = s.query(Chat).filter(Chat.id == chat_id).first().users.filter(User.id != recipient.id).all()
-            if len(member_except_now) == 1:
-                chat_name = member_except_now[0]
-            print([single.username for single in member_except_now])
-            if recipient_sid:
-                join_room(chat.id, sid=recipient_sid)
-                socket.emit(
-                    "ADD_CHAT",
-                    {
-                        "id": chat.id,
-                        "chat_name":chat_name,
-                        "recipient": [single.username for single in member_except_now],
-                        "recipientId": [single.id for single in member_except_now],
-                        "avatar": recipient_chat_avatar,
-                        "last_message": "",
-                        "last_message_timestamp": "",
-                    },
-                    room=recipient_sid,
-                )
+            recipient_sid = online.get(recipient.id)
+            if not recipient_sid:
+                continue
+            member_except_now = [member for member in members if member[0] != recipient.id]
+            emitter.join(chat_id, sid=recipient_sid)
+            emitter.emit(
+                "ADD_CHAT",
+                {
+                    "id": chat_id,
+                    # a direct chat is named after the other member
+                    "chat_name": member_except_now[0][2] if len(member_except_now) == 1 else chat_name,
+                    "recipient": [member[1] for member in member_except_now],
+                    "recipientId": [member[0] for member in member_except_now],
+                    "avatar": recipient_chat_avatar,
+                    "last_message": "",
+                    "last_message_timestamp": "",
+                },
+                room=recipient_sid,
+            )
     except (ValueError, TypeError) as err:
         print(err)
         genError(request.sid, err)
@@ -736,6 +1119,7 @@ the Notice will be displayed when the user next logs in.
 
 @socket.on("FRIEND_REQUEST")
 @disconnect_unauthorised
+@rate_limits.limit("FRIEND_REQUEST", 1, 10)
 def handleFriendRequest(id=None):
     print("--- FRIEND REQUEST FROM: ", current_user.user)
     print("AVATAR: ", current_user.avatar)
@@ -775,7 +1159,7 @@ def handleFriendRequest(id=None):
 
         recipient_sid = socket_session.get(id)
         if recipient_sid:
-            socket.emit(
+            emitter.emit(
                 "ADD_NOTIFICATION",
                 {
                     "id": n.id,
@@ -802,6 +1186,7 @@ Adds the friend to both users, There is a better way of doing this and I will li
 
 @socket.on("FRIEND_REQUEST_ACCEPTED")
 @disconnect_unauthorised
+@rate_limits.limit("FRIEND_REQUEST_ACCEPTED", 2, 10)
 def handle_friend_request_accepted(data=None):
     try:
         if None or "" in {data.get("username"), data.get("id")}:
@@ -828,7 +1213,8 @@ def handle_friend_request_accepted(data=None):
         # Delete request Notice and emit change to client
         singleNotice = s.query(Notice).get(data["id"])
         s.delete(singleNotice)
-        socket.emit("DELETE_NOTIFICATION", data["id"], room=request.sid)
+        record_change(s, recipient.id, "notice", data["id"])
+        emitter.emit("DELETE_NOTIFICATION", data["id"], room=request.sid)
 
         # Create Notice for request acceptance.
         n = Notice(
@@ -840,9 +1226,13 @@ def handle_friend_request_accepted(data=None):
         )
         sender.Notices.append(n)
         s.commit()
+        # both timelines now include the other user's circles
+        hot_timelines.invalidate(sender.id, recipient.id)
+        # suggestions of both users and their friends, after the commit (see friend_suggestions.py)
+        record_friendship(Session, sender.id, recipient.id)
 
         # Send friend details to recipient (request.sid),. the user that accepted the request.
-        socket.emit(
+        emitter.emit(
             "ADD_FRIEND",
             {
                 "id": sender.id,
@@ -857,7 +1247,7 @@ def handle_friend_request_accepted(data=None):
         # Check if user that sent friend request is currently online
         senderSession = socket_session.get(sender.id)
         if senderSession:
-            socket.emit(
+            emitter.emit(
                 "ADD_NOTIFICATION",
                 {
                     "id":n.id,
@@ -870,7 +1260,7 @@ def handle_friend_request_accepted(data=None):
                 },
                 room=senderSession,
             )
-            socket.emit(
+            emitter.emit(
                 "ADD_FRIEND",
                 {"id": recipient.id, "username": recipient.username,"userNickname": recipient.userNickname, "active": True},
                 room=senderSession,
@@ -891,20 +1281,24 @@ Removes the Notice, Does not notify the sender.
 
 @socket.on("DELETE_NOTIFICATION")
 @disconnect_unauthorised
+@rate_limits.limit("DELETE_NOTIFICATION", 5, 20)
 def handle_friend_request_rejected(id=None):
     try:
         if id in {None, ""}:
             raise TypeError("Notice ID not provided.")
 
         s = Session()
-        n = s.query(Notice).get(id)
+        n = s.query(Notice).filter(
+            Notice.id == id, Notice.recipient == current_user.user_id
+        ).first()
 
         if n:
             s.delete(n)
+            record_change(s, current_user.user_id, "notice", id)
             s.commit()
 
         # Covers situations where the DB is out of sync with the client
-        socket.emit("DELETE_NOTIFICATION", id, room=request.sid)
+        emitter.emit("DELETE_NOTIFICATION", id, room=request.sid)
 
     except (ValueError, TypeError) as err:
         print(err)
@@ -915,25 +1309,33 @@ def handle_friend_request_rejected(id=None):
 
 
 """
-Sets the Notice to dismissed.
+Sets the Notice to dismissed, the new number of unread Notices is sent as a second argument.
 """
 
 
 @socket.on("DISMISS_NOTIFICATION")
 @disconnect_unauthorised
+@rate_limits.limit("DISMISS_NOTIFICATION", 5, 20)
 def handleNoticeDismiss(id=None):
     try:
         if id in {None, ""}:
             raise TypeError("Notice ID not provided.")
 
         s = Session()
-        n = s.query(Notice).get(id)
+        n = s.query(Notice).filter(
+            Notice.id == id, Notice.recipient == current_user.user_id
+        ).first()
         if n:
             n.dismissed = True
+            record_change(s, current_user.user_id, "notice", id)
             s.commit()
 
         # Covers situations where the DB is out of sync with the client
-        socket.emit("DISMISS_NOTIFICATION", id, room=request.sid)
+        emitter.emit(
+            "DISMISS_NOTIFICATION",
+            (id, unread_notices(s, current_user.user_id)),
+            room=request.sid,
+        )
     except (ValueError, TypeError) as err:
         print(err)
         genError(request.sid, err)
@@ -944,12 +1346,13 @@ def handleNoticeDismiss(id=None):
 
 """
 Handles account updates, options avatar etc.
-Need to add removal of existing avatar image when new image is uploaded.
+Replaced avatars are released from the media store.
 """
 
 
 @socket.on("ACCOUNT_UPDATE")
 @disconnect_unauthorised
+@rate_limits.limit("ACCOUNT_UPDATE", 0.2, 3, expensive=True)
 def handleUserSettings(data=None):
     try:
         if None or "" in {data.get("update"), data.get("value")}:
@@ -961,18 +1364,24 @@ def handleUserSettings(data=None):
         if data["update"] == "visible_in_searches":
             user.visible_in_searches = data["value"]
             s.commit()
-            socket.emit(
+            emitter.emit(
                 "ACCOUNT_UPDATE", {data["update"]: data["value"]}, room=request.sid
             )
 
         if data["update"] == "avatar":
-            fileName = image_handler(data["value"], data["extension"])
+            fileName = image_handler(data["value"], data.get("extension"))
             if fileName:
+                old_avatar = user.avatar
                 user.avatar = fileName
+                # friends and chat members pick the new avatar up on their next sync
+                user.updated_at = datetime.datetime.utcnow()
                 s.commit()
-                socket.emit(
+                emitter.emit(
                     "ACCOUNT_UPDATE", {data["update"]: user.avatar}, room=request.sid
                 )
+                # drop the replaced avatar if no message or user still uses it
+                if old_avatar != fileName:
+                    release_media(s, old_avatar)
             else:
                 raise ValueError("Filename not generated")
 
@@ -992,4 +1401,17 @@ def handleUserSettings(data=None):
 #     print(request.sid)
 #     socket.emit("OVER",room=request.sid,callback=ack)
 if __name__ == "__main__":
-    socket.run(app, debug=True)
+    # workers started by cluster.py skip the schema check, it ran once before them (see migrate.py)
+    if os.environ.get("MIGRATE_ON_START", "1") == "1":
+        migrate(engine)
+    eventlet.spawn(listen_for_session_invalidation)
+    eventlet.spawn(listen_for_chat_invalidation)
+    eventlet.spawn(heartbeat)
+    eventlet.spawn(notice_retention, Session)
+    eventlet.spawn(sync_retention, Session)
+    socket.run(
+        app,
+        host=os.environ.get("HOST", "127.0.0.1"),
+        port=int(os.environ.get("PORT", 5000)),
+        debug=os.environ.get("SERVER_DEBUG", "1") == "1",
+    )
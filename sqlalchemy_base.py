@@ -1,14 +1,27 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import sqlalchemy_classes
 import os
 
 # 设置数据库
-SQL_URL = 'sqlite:///foo.sqlite3'
+SQL_URL = os.environ.get("SQL_URL", 'sqlite:///foo.sqlite3')
 # all class base
 Base = declarative_base()
 # init the connection with database
 engine = create_engine(SQL_URL)
 # 创建DBSession类型
 Session = sessionmaker(bind=engine)
+
+
+# SQLite: WAL lets readers carry on while the message writer commits,
+# synchronous=FULL keeps every commit durable (one fsync per group commit)
+@event.listens_for(engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=FULL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
@@ -6,6 +6,7 @@ from sqlalchemy import (
     ForeignKey,
     Boolean,
     UniqueConstraint,
+    Index,
 )
 from sqlalchemy.orm import relationship, synonym
 from sqlalchemy_base import Base, Session, engine
@@ -18,6 +19,8 @@ class UsersChats(Base):
     __tablename__ = "users_chats"
     user_id = Column(String(150), ForeignKey("users.id"), primary_key=True)
     chat_id = Column(String(150), ForeignKey("chats.id"), primary_key=True)
+    # 主键以user_id开头，按chat查成员（见chat_cache.py）需要另一个索引
+    __table_args__ = (Index("ix_users_chats_chat", "chat_id", "user_id"),)
 # 中间表 —— 实现user和circle的多对多（一个用户可以有多条朋友圈，一条朋友圈可以包含多个可见用户）
 class UsersCircles(Base):
     __tablename__ = "users_circles"
@@ -32,9 +35,22 @@ class Friendships(Base):
     user_b_id = Column(
         "user_b_id", String(100), ForeignKey("users.id"), primary_key=True
     )
-    created_at = Column("created_at", TIMESTAMP(), default=datetime.utcnow())
+    created_at = Column("created_at", TIMESTAMP(), default=datetime.utcnow)
     UniqueConstraint("user_a_id", "user_b_id", name="unique_friendships")
 
+# 已读水位 —— 每个用户在每个chat中读到的最后一条信息（一次写入，而不是逐条更新Message.read_at）
+class ChatReads(Base):
+    __tablename__ = "chat_reads"
+    user_id = Column(String(150), ForeignKey("users.id"), primary_key=True)
+    chat_id = Column(String(150), ForeignKey("chats.id"), primary_key=True)
+    # 读到的最后一条信息
+    message_id = Column(String, nullable=False)
+    # 该信息的创建时间，用于比较水位先后
+    message_created_at = Column(TIMESTAMP(), nullable=False)
+    # 阅读时间
+    read_at = Column(TIMESTAMP(), nullable=False)
+    __table_args__ = (Index("ix_chat_reads_chat", "chat_id"),)
+
 # 单条信息
 class Message(Base):
     __tablename__ = "messages"
@@ -54,6 +70,8 @@ class Message(Base):
     userNickname = Column("userNickname", String(50), nullable=False)
     # 是否包含图片
     image = Column("image", String(150), nullable=True)
+    # 按chat分页读取历史信息用的索引 (chat_id, created_at, id)
+    __table_args__ = (Index("ix_messages_chat_created", "chat_id", "created_at", "id"),)
 
     def __init__(self, username, userNickname):
         self.created_at = datetime.utcnow()
@@ -147,9 +165,9 @@ class Chat(Base):
         "last_message_timestamp", TIMESTAMP(), nullable=True
     )
 
-    def __init__(self,name,createrID,id = str(uuid4())):
+    def __init__(self,name,createrID,id=None):
         self.name = name
-        self.id = id
+        self.id = id or str(uuid4())
         self.createrID = createrID
         self.created_at = datetime.utcnow()
 
@@ -170,6 +188,8 @@ class Circle(Base):
     visiable = relationship(User, secondary="users_circles", back_populates="circles", lazy="dynamic")
     # 包含的图片
     image = Column("image", String(150), nullable=True)
+    # 读取时合并好友朋友圈用的索引 (user_id, created_at, id)
+    __table_args__ = (Index("ix_circles_user_created", "user_id", "created_at", "id"),)
 
     def __init__(self, userNickname, userid):
         self.created_at = datetime.utcnow()
@@ -177,6 +197,22 @@ class Circle(Base):
         self.userNickname = userNickname
         self.user_id = userid
 
+# 用户搜索索引 —— username和userNickname的每个后缀（小写），子串搜索变成对term的前缀范围查询
+class UserSearchTerm(Base):
+    __tablename__ = "user_search_terms"
+    # 后缀内容，最多32个字符
+    term = Column(String(32), primary_key=True)
+    # 对应的用户
+    user_id = Column(String(150), ForeignKey("users.id"), primary_key=True)
+    # 来自哪个字段："u" username, "n" userNickname
+    field = Column(String(1), primary_key=True)
+    # 后缀在原字符串中的位置，0表示前缀匹配
+    pos = Column(Integer, primary_key=True, autoincrement=False)
+    __table_args__ = (
+        Index("ix_user_search_prefix", "pos", "term", "user_id", "field"),
+        Index("ix_user_search_user", "user_id"),
+    )
+
 # 提示
 class Notice(Base):
     __tablename__ = "notices"
@@ -198,6 +234,10 @@ class Notice(Base):
     dismissed = Column("dismissed", Boolean, nullable=False)
     # 信息本身
     message = Column("message", String, nullable=False)
+    # 收件箱分页和未读计数都走这个索引
+    __table_args__ = (
+        Index("ix_notices_recipient_dismissed_time", "recipient", "dismissed", "timestamp", "id"),
+    )
 
     def __init__(self, type, sender,senderNickname, message, avatar=None):
         self.id = str(uuid4())
@@ -209,5 +249,60 @@ class Notice(Base):
         self.dismissed = False
         self.avatar = avatar
 
-# Serialize all classes that inherit from Base into tables
-Base.metadata.create_all(engine)
+# 归档段 —— 一个chat中一段连续的旧信息，压缩后存放在归档目录中（见archive.py）
+class MessageSegment(Base):
+    __tablename__ = "message_segments"
+    id = Column(Integer, primary_key=True)
+    # 属于哪个chat
+    chat_id = Column(String, ForeignKey("chats.id"), nullable=False)
+    # 归档文件相对于归档目录的路径
+    path = Column(String, nullable=False)
+    # 段内最早一条信息
+    first_created_at = Column(TIMESTAMP(), nullable=False)
+    first_id = Column(String, nullable=False)
+    # 段内最新一条信息
+    last_created_at = Column(TIMESTAMP(), nullable=False)
+    last_id = Column(String, nullable=False)
+    # 段内信息条数
+    count = Column(Integer, nullable=False)
+    # 从新到旧翻页时按chat查找段
+    __table_args__ = (
+        Index("ix_message_segments_chat_last", "chat_id", "last_created_at", "last_id"),
+    )
+
+# 归档段引用的图片，媒体回收时仍然算作引用
+class SegmentMedia(Base):
+    __tablename__ = "segment_media"
+    segment_id = Column(Integer, ForeignKey("message_segments.id"), primary_key=True)
+    url = Column(String(150), primary_key=True)
+    __table_args__ = (Index("ix_segment_media_url", "url"),)
+
+# 变更记录 —— 没有时间戳可查的变更（Notice的删除和已阅），重连时的增量同步用（见sync.py）
+class SyncChange(Base):
+    __tablename__ = "sync_changes"
+    id = Column(Integer, primary_key=True)
+    # 哪个用户的数据发生了变更
+    user_id = Column(String(150), ForeignKey("users.id"), nullable=False)
+    # 变更的类型，目前只有"notice"
+    kind = Column(String(20), nullable=False)
+    # 变更对象的id
+    item_id = Column(String(150), nullable=False)
+    # 变更时间
+    changed_at = Column(TIMESTAMP(), nullable=False)
+    __table_args__ = (Index("ix_sync_changes_user_changed", "user_id", "changed_at"),)
+
+# 单聊索引 —— 成员集合的哈希 -> 已有的单聊，ADD_CHAT不再重复创建（见chat_create.py）
+class DirectChat(Base):
+    __tablename__ = "direct_chats"
+    # 排序后成员id的sha256
+    member_key = Column(String(64), primary_key=True)
+    chat_id = Column(String(150), ForeignKey("chats.id"), nullable=False)
+
+# 可能认识的人 —— 每个用户共同好友最多的前k个非好友，批量计算，接受好友请求时增量更新（见friend_suggestions.py）
+class FriendSuggestion(Base):
+    __tablename__ = "friend_suggestions"
+    user_id = Column(String(150), ForeignKey("users.id"), primary_key=True)
+    # 被推荐的用户
+    suggested_id = Column(String(150), ForeignKey("users.id"), primary_key=True)
+    # 共同好友数
+    mutual = Column(Integer, nullable=False)
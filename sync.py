@@ -0,0 +1,259 @@
+import os, sys
+from datetime import datetime, timedelta
+import eventlet
+from sqlalchemy import or_, select, union
+from sqlalchemy_classes import Chat, Friendships, Notice, SyncChange, User, UsersChats
+from chat_list import load_chat_list
+from presence import online_sids
+from unread_counters import load_unread
+from notifications import serialize_notice, unread_notices, PAGE_SIZE as NOTICE_PAGE_SIZE
+from timeline import newer_circles, PAGE_SIZE as CIRCLE_PAGE_SIZE
+
+"""
+Delta sync for reconnecting clients.
+
+Every connect ends with a SYNC event carrying a cursor (the server time the sync
+started). A client that connects again with auth {"since": cursor} only gets what
+changed after it: the chats with new messages, new members or members with a new
+profile, new or changed friends, new and changed notices, new circles, plus the
+unread counters and the online users, which change without a trace in the database.
+
+Most changes are found by the timestamps already stored (Chat.last_message_timestamp,
+User.updated_at, Friendships.created_at, Notice.timestamp, Circle.created_at).
+Notice dismissals and deletions leave none, so they are recorded in sync_changes.
+Timestamps are taken before the transaction commits, so the delta starts SYNC_OVERLAP
+seconds before the cursor and may repeat a few items; clients apply it as upserts.
+
+A cursor older than SYNC_MAX_AGE_HOURS (sync_changes are kept that long), from the
+future or unreadable falls back to the full reload (LOAD_CHATS, LOAD_FRIENDS,
+LOAD_NOTIFICATIONS, LOAD_CIRCLES), as does a connect without a cursor, so older
+clients keep working. Old sync_changes are pruned every SYNC_RETENTION_INTERVAL
+seconds in the server or by hand:
+
+    python sync.py prune
+"""
+
+MAX_AGE_HOURS = float(os.environ.get("SYNC_MAX_AGE_HOURS", 72))
+OVERLAP = float(os.environ.get("SYNC_OVERLAP", 5))
+RETENTION_INTERVAL = int(os.environ.get("SYNC_RETENTION_INTERVAL", 3600))
+
+
+def encode_sync_cursor(now):
+    return now.isoformat()
+
+
+"""
+Returns the time to sync from, or None when the client needs the full reload.
+"""
+
+
+def decode_sync_cursor(cursor, now):
+    try:
+        since = datetime.fromisoformat(cursor)
+    except (TypeError, ValueError):
+        return None
+    if since > now or now - since > timedelta(hours=MAX_AGE_HOURS):
+        return None
+    return since - timedelta(seconds=OVERLAP)
+
+
+"""
+Records a change of one of the user's items that leaves no timestamp behind, in the caller's
+transaction.
+"""
+
+
+def record_change(s, user_id, kind, item_id):
+    s.add(SyncChange(user_id=user_id, kind=kind, item_id=item_id, changed_at=datetime.utcnow()))
+
+
+def my_chats(user_id):
+    return select(UsersChats.chat_id).where(UsersChats.user_id == user_id).scalar_subquery()
+
+
+"""
+Ids of the user's chats that have new messages, are new, or have a member whose profile changed.
+"""
+
+
+def changed_chat_ids(s, user_id, since):
+    active = select(Chat.id).where(
+        Chat.id.in_(my_chats(user_id)),
+        or_(Chat.last_message_timestamp > since, Chat.created_at > since),
+    )
+    profiles = (
+        select(UsersChats.chat_id)
+        .join(User, User.id == UsersChats.user_id)
+        .where(
+            UsersChats.chat_id.in_(my_chats(user_id)),
+            User.id != user_id,
+            User.updated_at > since,
+        )
+    )
+    return [row[0] for row in s.execute(union(active, profiles))]
+
+
+"""
+Ids of the users whose online state the client shows: the user's friends and chat members.
+"""
+
+
+def contact_ids(s, user_id):
+    members = select(UsersChats.user_id).where(
+        UsersChats.chat_id.in_(my_chats(user_id)), UsersChats.user_id != user_id
+    )
+    friends = select(Friendships.user_b_id).where(Friendships.user_a_id == user_id)
+    return [row[0] for row in s.execute(union(members, friends))]
+
+
+"""
+Returns (friends, new_friendship): the friends added or with a new profile since, in the
+LOAD_FRIENDS shape.
+"""
+
+
+def changed_friends(s, user_id, since, online):
+    rows = (
+        s.query(
+            User.id,
+            User.username,
+            User.userNickname,
+            User.avatar,
+            Friendships.created_at,
+        )
+        .join(Friendships, Friendships.user_b_id == User.id)
+        .filter(
+            Friendships.user_a_id == user_id,
+            or_(Friendships.created_at > since, User.updated_at > since),
+        )
+        .all()
+    )
+    friends = [
+        {
+            "id": i.id,
+            "username": i.username,
+            "userNickname": i.userNickname,
+            "avatar": i.avatar,
+            "active": i.id in online,
+        }
+        for i in rows
+    ]
+    return friends, any(i.created_at and i.created_at > since for i in rows)
+
+
+"""
+Returns (notices, removed ids), notices is None when more than a page is new.
+"""
+
+
+def changed_notices(s, user_id, since):
+    new = (
+        s.query(Notice)
+        .filter(
+            Notice.recipient == user_id,
+            Notice.dismissed.in_([False, True]),
+            Notice.timestamp > since,
+        )
+        .order_by(Notice.timestamp.desc(), Notice.id.desc())
+        .limit(NOTICE_PAGE_SIZE + 1)
+        .all()
+    )
+    if len(new) > NOTICE_PAGE_SIZE:
+        return None, []
+
+    changed = {
+        i.item_id
+        for i in s.query(SyncChange.item_id).filter(
+            SyncChange.user_id == user_id,
+            SyncChange.kind == "notice",
+            SyncChange.changed_at > since,
+        )
+    } - {i.id for i in new}
+    if changed:
+        new += s.query(Notice).filter(Notice.id.in_(changed), Notice.recipient == user_id).all()
+    removed = changed - {i.id for i in new}
+    return [serialize_notice(x) for x in new], sorted(removed)
+
+
+"""
+Builds the SYNC payload for a reconnect from `since` (see decode_sync_cursor). Returns
+(chat_ids, delta, reload): the ids of all the user's chats (their rooms have to be joined
+again), the changes, and the parts ("notices", "circles") that changed too much for a delta
+and need their full LOAD_ event instead.
+"""
+
+
+def load_delta(s, user_id, since):
+    chat_ids = [i.chat_id for i in s.query(UsersChats.chat_id).filter(UsersChats.user_id == user_id)]
+    unread = load_unread(user_id)
+    online = set(online_sids(contact_ids(s, user_id)))
+    reload = []
+
+    friends, new_friendship = changed_friends(s, user_id, since, online)
+    notices, removed_notices = changed_notices(s, user_id, since)
+    if notices is None:
+        reload.append("notices")
+    # a new friend brings older circles into the feed too
+    circles = [] if new_friendship else newer_circles(s, user_id, since)
+    if new_friendship or len(circles) > CIRCLE_PAGE_SIZE:
+        reload.append("circles")
+        circles = []
+
+    delta = {
+        "chats": load_chat_list(s, user_id, changed_chat_ids(s, user_id, since), unread),
+        "unread": unread,
+        "friends": friends,
+        "online": sorted(online),
+        "notices": notices or [],
+        "removedNotices": removed_notices,
+        "circles": circles,
+    }
+    if "notices" not in reload:
+        delta["unreadNotices"] = unread_notices(s, user_id)
+    return chat_ids, delta, reload
+
+
+"""
+Deletes sync_changes older than any cursor still accepted, returns the number removed.
+"""
+
+
+def prune_changes(s, now=None):
+    cutoff = (now or datetime.utcnow()) - timedelta(hours=MAX_AGE_HOURS)
+    removed = (
+        s.query(SyncChange).filter(SyncChange.changed_at < cutoff).delete(synchronize_session=False)
+    )
+    s.commit()
+    return removed
+
+
+"""
+Runs the retention job forever in a greenthread.
+"""
+
+
+def sync_retention(Session):
+    while True:
+        s = Session()
+        try:
+            removed = prune_changes(s)
+            if removed:
+                print("--- pruned %d sync changes" % removed)
+        except Exception as err:
+            print(err)
+        finally:
+            s.close()
+        eventlet.sleep(RETENTION_INTERVAL)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["prune"]:
+        print("usage: python sync.py prune")
+        sys.exit(1)
+    from sqlalchemy_base import Session
+
+    s = Session()
+    try:
+        print("removed %d sync changes" % prune_changes(s))
+    finally:
+        s.close()
@@ -0,0 +1,180 @@
+import os
+from collections import OrderedDict
+from sqlalchemy import or_, select, union
+from sqlalchemy_classes import Circle, User, Friendships
+from server_helpers import encode_cursor, decode_cursor
+
+"""
+Fan-out-on-read timeline for circles.
+
+A post is stored once (one circles row), feeds are built when they are read by
+merging the recent posts of the reader and the reader's friends through the
+(user_id, created_at, id) index on circles. Posting costs the same no matter how
+many friends the author has.
+
+Users that read their feed often can be kept in a small in-process cache of
+precomputed first pages (TIMELINE_CACHE_SIZE users, 0 disables it). New posts are
+pushed into the cached pages of the author's friends.
+"""
+
+PAGE_SIZE = 10
+TIMELINE_CACHE_SIZE = int(os.environ.get("TIMELINE_CACHE_SIZE", 0))
+
+
+class TimelineCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timelines = OrderedDict()
+
+    def get(self, user_id):
+        page = self.timelines.get(user_id)
+        if page is not None:
+            self.timelines.move_to_end(user_id)
+        return page
+
+    def put(self, user_id, page):
+        if self.capacity <= 0:
+            return
+        self.timelines[user_id] = page
+        self.timelines.move_to_end(user_id)
+        while len(self.timelines) > self.capacity:
+            self.timelines.popitem(last=False)
+
+    # prepend a new post to the cached first page of every reader in user_ids
+    def push(self, user_ids, post):
+        for user_id in user_ids:
+            page = self.timelines.get(user_id)
+            if page is not None:
+                page[0].insert(0, post)
+                if len(page[0]) > PAGE_SIZE:
+                    page[0].pop()
+                    page[1] = encode_cursor_dict(page[0][-1])
+
+    def invalidate(self, *user_ids):
+        for user_id in user_ids:
+            self.timelines.pop(user_id, None)
+
+
+hot_timelines = TimelineCache(TIMELINE_CACHE_SIZE)
+
+
+def serialize_circle(i):
+    return {
+        "id": i.id,
+        "userNickname": i.userNickname,
+        "avatar": i.avatar,
+        "circle": i.content,
+        "create_at": str(i.created_at.strftime("%Y-%m-%d %H:%M:%S")),
+        # full precision timestamp, only used to rebuild the cursor of cached pages
+        "_created_at": i.created_at,
+    }
+
+
+def encode_cursor_dict(post):
+    return "%s|%s" % (post["_created_at"].isoformat(), post["id"])
+
+
+def public(page):
+    return [{k: v for k, v in post.items() if not k.startswith("_")} for post in page]
+
+
+"""
+Ids of the users whose posts appear in user_id's feed (the user and the user's friends).
+"""
+
+
+def feed_authors(user_id):
+    return union(
+        select(Friendships.user_b_id).where(Friendships.user_a_id == user_id),
+        select(User.id).where(User.id == user_id),
+    ).scalar_subquery()
+
+
+def friend_ids(s, user_id):
+    return [
+        i.user_b_id
+        for i in s.query(Friendships.user_b_id).filter(Friendships.user_a_id == user_id)
+    ]
+
+
+def feed_query(s, user_id):
+    return (
+        s.query(
+            Circle.id,
+            Circle.content,
+            Circle.created_at,
+            Circle.userNickname,
+            User.avatar,
+        )
+        .join(User, User.id == Circle.user_id)
+        .filter(Circle.user_id.in_(feed_authors(user_id)))
+    )
+
+
+"""
+Returns (posts, cursor) for the feed page before `cursor` (the latest page when cursor is None),
+newest first. cursor is None once there are no older posts.
+"""
+
+
+def load_timeline(s, user_id, cursor=None, limit=PAGE_SIZE):
+    if cursor is None and limit == PAGE_SIZE:
+        cached = hot_timelines.get(user_id)
+        if cached is not None:
+            return public(cached[0]), cached[1]
+
+    query = feed_query(s, user_id)
+    if cursor:
+        created_at, circle_id = decode_cursor(cursor)
+        query = query.filter(
+            Circle.created_at <= created_at,
+            or_(Circle.created_at < created_at, Circle.id < circle_id),
+        )
+    rows = query.order_by(Circle.created_at.desc(), Circle.id.desc()).limit(limit + 1).all()
+
+    page = [serialize_circle(i) for i in rows[:limit]]
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    if cursor is None and limit == PAGE_SIZE:
+        hot_timelines.put(user_id, [page, next_cursor])
+    return public(page), next_cursor
+
+
+"""
+Returns up to `limit` + 1 posts of the feed created after `since`, newest first, so the caller
+can tell whether more than `limit` are new.
+"""
+
+
+def newer_circles(s, user_id, since, limit=PAGE_SIZE):
+    rows = (
+        feed_query(s, user_id)
+        .filter(Circle.created_at > since)
+        .order_by(Circle.created_at.desc(), Circle.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+    return public([serialize_circle(i) for i in rows])
+
+
+"""
+Stores a new post once and pushes it into the cached feeds of the author's friends.
+Returns the serialized post.
+"""
+
+
+def publish_circle(s, user, content, friend_ids):
+    circle = Circle(user.userNickname, user.id)
+    circle.content = content
+    s.add(circle)
+    s.commit()
+
+    post = {
+        "id": circle.id,
+        "userNickname": circle.userNickname,
+        "avatar": user.avatar,
+        "circle": circle.content,
+        "create_at": str(circle.created_at.strftime("%Y-%m-%d %H:%M:%S")),
+        "_created_at": circle.created_at,
+    }
+    hot_timelines.push([user.id, *friend_ids], post)
+    return public([post])[0]
@@ -0,0 +1,110 @@
+import os, time
+import eventlet
+
+"""
+Typing indicators for TYPING, kept in this process' memory only.
+
+A client sends TYPING {"chat": id, "typing": true} while its user types (every few
+seconds is enough) and {"typing": false} when they stop or send. Nothing is stored and
+nothing is read from the database or Redis: the sender's identity is taken from the
+Socket.IO session saved on connect and membership from the rooms the sid has joined.
+
+Every sid typing in a chat holds an entry that expires TYPING_TTL (ms) after its last
+TYPING, so a client that disconnects without a stop, or a process that never sees its
+disconnect, stops typing on its own. Repeated starts only push the expiry. Changes are
+merged: at most every TYPING_INTERVAL (ms) each chat room gets one TYPING holding the
+users that started and stopped since the last one, a start and stop within the same
+interval sends nothing. Deltas keep working when a chat's members are spread over
+several processes (see cluster.py), each one only reports its own sids.
+"""
+
+INTERVAL = float(os.environ.get("TYPING_INTERVAL", 500)) / 1000
+TTL = float(os.environ.get("TYPING_TTL", 6000)) / 1000
+
+
+class TypingIndicators:
+    def __init__(self, emit, interval=INTERVAL, ttl=TTL):
+        # emit(chat_id, payload) delivers a TYPING to the chat room
+        self.emit = emit
+        self.interval = interval
+        self.ttl = ttl
+        # {chat_id: {sid: (expires, user)}}, user is {"id", "username", "userNickname"}
+        self.typing = {}
+        # {sid: {chat_id}} of the sids typing somewhere, for disconnects
+        self.sids = {}
+        # {chat_id: {user id: user}} as last broadcast to the room
+        self.sent = {}
+        # chats whose typing users may have changed since the last broadcast
+        self.changed = set()
+        self.thread = None
+        self.broadcasts = 0
+
+    def update(self, sid, user, chat_id, typing):
+        chat = self.typing.get(chat_id)
+        if typing:
+            if chat is None:
+                chat = self.typing[chat_id] = {}
+            if sid not in chat:
+                self.sids.setdefault(sid, set()).add(chat_id)
+                self.changed.add(chat_id)
+            chat[sid] = (time.monotonic() + self.ttl, user)
+        elif chat is not None and chat.pop(sid, None) is not None:
+            self.forget(sid, chat_id)
+            self.changed.add(chat_id)
+        self.schedule()
+
+    def disconnect(self, sid):
+        for chat_id in self.sids.pop(sid, ()):
+            chat = self.typing.get(chat_id)
+            if chat is not None and chat.pop(sid, None) is not None:
+                self.changed.add(chat_id)
+                if not chat:
+                    del self.typing[chat_id]
+        self.schedule()
+
+    def forget(self, sid, chat_id):
+        chats = self.sids.get(sid)
+        if chats is not None:
+            chats.discard(chat_id)
+            if not chats:
+                del self.sids[sid]
+        if not self.typing.get(chat_id, True):
+            del self.typing[chat_id]
+
+    # keeps a flush scheduled while anyone is typing, their entries have to expire
+    def schedule(self):
+        if (self.thread is None or self.thread.dead) and (self.changed or self.typing):
+            self.thread = eventlet.spawn_after(self.interval, self.run)
+
+    def expire(self, now):
+        for chat_id, chat in list(self.typing.items()):
+            expired = [sid for sid, (expires, _) in chat.items() if expires <= now]
+            for sid in expired:
+                del chat[sid]
+                self.forget(sid, chat_id)
+            if expired:
+                self.changed.add(chat_id)
+
+    def flush(self):
+        changed, self.changed = self.changed, set()
+        for chat_id in changed:
+            users = {user["id"]: user for _, user in self.typing.get(chat_id, {}).values()}
+            sent = self.sent.get(chat_id, {})
+            started = [user for user_id, user in users.items() if user_id not in sent]
+            stopped = [user_id for user_id in sent if user_id not in users]
+            if users:
+                self.sent[chat_id] = users
+            else:
+                self.sent.pop(chat_id, None)
+            if started or stopped:
+                self.emit(chat_id, {"chatId": chat_id, "typing": started, "stopped": stopped})
+                self.broadcasts += 1
+
+    def run(self):
+        self.thread = None
+        try:
+            self.expire(time.monotonic())
+            self.flush()
+        except Exception as err:
+            print(err)
+        self.schedule()
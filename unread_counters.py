@@ -0,0 +1,178 @@
+import sys
+from sqlalchemy import and_, or_, func, select
+from sqlalchemy_classes import ChatReads, Message, User, UsersChats
+from server_helpers import unread_store
+
+"""
+Unread counters per user and chat, kept in the "unread:<user id>" Redis hash
+(chat id -> number of unread messages).
+
+The message writer increments the counters of every other member once a batch of
+messages is committed, a read flush (see read_receipts.py) sets the readers'
+counters to what is left after their new watermark. LOAD_CHATS reads all counters
+of a user with a single HGETALL, so it never counts messages.
+
+Counters are derived data: the message log and chat_reads are the truth, and the
+checker rebuilds counters that drifted (e.g. a Redis write lost after a commit).
+
+    python unread_counters.py check [--fix]
+"""
+
+
+def unread_key(user_id):
+    return "unread:%s" % user_id
+
+
+"""
+Counts, from the message log, the messages of other members after each member's
+read watermark. Returns rows of (user_id, chat_id, count), members without
+unread messages are left out.
+"""
+
+
+def count_unread(chat_id=None, user_ids=None):
+    query = (
+        select(UsersChats.user_id, UsersChats.chat_id, func.count(Message.id))
+        .select_from(UsersChats)
+        .join(User, User.id == UsersChats.user_id)
+        .outerjoin(
+            ChatReads,
+            and_(
+                ChatReads.user_id == UsersChats.user_id,
+                ChatReads.chat_id == UsersChats.chat_id,
+            ),
+        )
+        .join(
+            Message,
+            and_(
+                Message.chat_id == UsersChats.chat_id,
+                Message.username != User.username,
+                or_(
+                    ChatReads.message_id == None,
+                    Message.created_at > ChatReads.message_created_at,
+                    and_(
+                        Message.created_at == ChatReads.message_created_at,
+                        Message.id > ChatReads.message_id,
+                    ),
+                ),
+            ),
+        )
+        .group_by(UsersChats.user_id, UsersChats.chat_id)
+    )
+    if chat_id is not None:
+        query = query.where(UsersChats.chat_id == chat_id)
+    if user_ids is not None:
+        query = query.where(UsersChats.user_id.in_(list(user_ids)))
+    return query
+
+
+"""
+Called by the message writer after a batch of message rows is committed, adds one
+unread message for every member of the chat except the sender.
+"""
+
+
+def count_new_messages(connection, rows):
+    chat_ids = {row["chat_id"] for row in rows}
+    members = {}
+    for chat_id, user_id, username in connection.execute(
+        select(UsersChats.chat_id, User.id, User.username)
+        .join(User, User.id == UsersChats.user_id)
+        .where(UsersChats.chat_id.in_(list(chat_ids)))
+    ):
+        members.setdefault(chat_id, []).append((user_id, username))
+
+    increments = {}
+    for row in rows:
+        for user_id, username in members.get(row["chat_id"], []):
+            if username != row["username"]:
+                key = (user_id, row["chat_id"])
+                increments[key] = increments.get(key, 0) + 1
+
+    pipe = unread_store.pipeline(transaction=False)
+    for (user_id, chat_id), count in increments.items():
+        pipe.hincrby(unread_key(user_id), chat_id, count)
+    pipe.execute()
+
+
+"""
+Called after read watermarks are stored, {chat_id: [user ids]} of the readers.
+Sets their counters to the messages left after the new watermark (usually none).
+"""
+
+
+def reset_unread(connection, readers):
+    pipe = unread_store.pipeline(transaction=False)
+    for chat_id, user_ids in readers.items():
+        left = {
+            user_id: count
+            for user_id, _, count in connection.execute(count_unread(chat_id, user_ids))
+        }
+        for user_id in user_ids:
+            if left.get(user_id):
+                pipe.hset(unread_key(user_id), chat_id, left[user_id])
+            else:
+                pipe.hdel(unread_key(user_id), chat_id)
+    pipe.execute()
+
+
+"""
+Returns {chat_id: unread count} for a user.
+"""
+
+
+def load_unread(user_id):
+    return {
+        chat_id: int(count)
+        for chat_id, count in unread_store.hgetall(unread_key(user_id)).items()
+    }
+
+
+"""
+Compares every counter with the message log. Returns the number of users whose
+counters were wrong, and rewrites them when fix is set.
+"""
+
+
+def check(s, fix=False):
+    expected = {}
+    for user_id, chat_id, count in s.execute(count_unread()):
+        expected.setdefault(user_id, {})[chat_id] = count
+
+    actual = {}
+    for key in unread_store.scan_iter(unread_key("*")):
+        counts = {
+            chat_id: int(count)
+            for chat_id, count in unread_store.hgetall(key).items()
+            if int(count)
+        }
+        actual[key[len(unread_key("")) :]] = counts
+
+    wrong = [
+        user_id
+        for user_id in set(expected) | set(actual)
+        if expected.get(user_id, {}) != actual.get(user_id, {})
+    ]
+    if fix:
+        pipe = unread_store.pipeline()
+        for user_id in wrong:
+            pipe.delete(unread_key(user_id))
+            if expected.get(user_id):
+                pipe.hset(unread_key(user_id), mapping=expected[user_id])
+        pipe.execute()
+    return len(wrong)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["check"] or sys.argv[2:] not in ([], ["--fix"]):
+        print("usage: python unread_counters.py check [--fix]")
+        sys.exit(1)
+    from sqlalchemy_base import Session
+
+    s = Session()
+    try:
+        fix = sys.argv[2:] == ["--fix"]
+        wrong = check(s, fix)
+        print("%d users with wrong unread counters%s" % (wrong, ", rebuilt" if fix and wrong else ""))
+    finally:
+        s.close()
@@ -0,0 +1,194 @@
+import json, sys, unicodedata
+from sqlalchemy import tuple_
+from sqlalchemy_classes import User, UserSearchTerm
+
+"""
+Indexed user search for SEARCH_USERS.
+
+Every suffix of a user's (case folded) username and nickname is stored in
+user_search_terms, so a substring search, CJK nicknames included, is a range scan
+over the term index: term >= q and term < q + U+10FFFF. Prefix matches (pos = 0)
+are returned first, then the other substring matches, each in term order, and the
+cursor is the position of the last returned row in that order. Only one row per
+user is returned for a given query, see is_canonical.
+
+Existing databases are backfilled with:
+
+    python user_search.py rebuild
+"""
+
+MAX_TERM = 32
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+LAST_CHAR = "\U0010ffff"
+
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text or "").casefold()
+
+
+def search_terms(user_id, username, userNickname):
+    rows = []
+    for field, value in (("u", username), ("n", userNickname)):
+        text = normalize(value)
+        for pos in range(len(text)):
+            rows.append(
+                {
+                    "term": text[pos : pos + MAX_TERM],
+                    "user_id": user_id,
+                    "field": field,
+                    "pos": pos,
+                }
+            )
+    return rows
+
+
+"""
+(Re)writes the search terms of a user, call it whenever username or userNickname changes.
+The caller commits.
+"""
+
+
+def index_user(s, user):
+    s.query(UserSearchTerm).filter(UserSearchTerm.user_id == user.id).delete()
+    rows = search_terms(user.id, user.username, user.userNickname)
+    if rows:
+        s.execute(UserSearchTerm.__table__.insert(), rows)
+
+
+"""
+A user can match through both fields and through several suffixes of the same field,
+exactly one of those rows is kept: prefix matches on username before nickname,
+otherwise the first occurrence in username before the first occurrence in nickname.
+"""
+
+
+def is_canonical(row, q, phase):
+    username, nickname = normalize(row.username), normalize(row.userNickname)
+    if phase == 0:
+        if not (username if row.field == "u" else nickname).startswith(q):
+            return False
+        return row.field == "u" or not username.startswith(q)
+    if username.startswith(q) or nickname.startswith(q):
+        return False
+    if q in username:
+        return row.field == "u" and row.pos == username.find(q)
+    return row.field == "n" and row.pos == nickname.find(q)
+
+
+def fetch_terms(s, phase, key, after, user_id, batch):
+    query = (
+        s.query(
+            UserSearchTerm.term,
+            UserSearchTerm.user_id,
+            UserSearchTerm.field,
+            UserSearchTerm.pos,
+            User.username,
+            User.userNickname,
+            User.avatar,
+        )
+        .join(User, User.id == UserSearchTerm.user_id)
+        .filter(
+            UserSearchTerm.term >= key,
+            UserSearchTerm.term < key + LAST_CHAR,
+            UserSearchTerm.pos == 0 if phase == 0 else UserSearchTerm.pos > 0,
+            User.visible_in_searches == True,
+            User.id != user_id,
+        )
+    )
+    if after:
+        query = query.filter(
+            tuple_(
+                UserSearchTerm.term,
+                UserSearchTerm.user_id,
+                UserSearchTerm.field,
+                UserSearchTerm.pos,
+            )
+            > tuple(after)
+        )
+    return (
+        query.order_by(
+            UserSearchTerm.term,
+            UserSearchTerm.user_id,
+            UserSearchTerm.field,
+            UserSearchTerm.pos,
+        )
+        .limit(batch)
+        .all()
+    )
+
+
+def decode_search_cursor(cursor):
+    if not cursor:
+        return 0, None
+    try:
+        phase, after = json.loads(cursor)
+        return int(phase), after
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor provided!")
+
+
+"""
+Returns (users, cursor) for the users matching query, excluding user_id and users
+that opted out of searches. cursor is None when there are no more matches.
+"""
+
+
+def search_users(s, query, user_id, cursor=None, limit=PAGE_SIZE):
+    q = normalize(query).strip()
+    if not q:
+        raise ValueError("Search query not provided!")
+    key = q[:MAX_TERM]
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    batch = limit * 2
+
+    phase, after = decode_search_cursor(cursor)
+    found = []
+    while phase < 2 and len(found) < limit:
+        rows = fetch_terms(s, phase, key, after, user_id, batch)
+        for row in rows:
+            after = [row.term, row.user_id, row.field, row.pos]
+            if is_canonical(row, q, phase):
+                found.append(row)
+                if len(found) == limit:
+                    break
+        if len(found) < limit and len(rows) < batch:
+            phase, after = phase + 1, None
+
+    users = [
+        {"id": i.user_id, "username": i.username, "userNickname": i.userNickname, "avatar": i.avatar}
+        for i in found
+    ]
+    next_cursor = json.dumps([phase, after]) if len(found) == limit and phase < 2 else None
+    return users, next_cursor
+
+
+"""
+Rebuilds user_search_terms from the users table.
+"""
+
+
+def rebuild(s, batch=5000):
+    s.query(UserSearchTerm).delete()
+    rows = []
+    for i in s.query(User.id, User.username, User.userNickname).yield_per(batch):
+        rows += search_terms(i.id, i.username, i.userNickname)
+        if len(rows) >= batch * 10:
+            s.execute(UserSearchTerm.__table__.insert(), rows)
+            rows = []
+    if rows:
+        s.execute(UserSearchTerm.__table__.insert(), rows)
+    s.commit()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python user_search.py rebuild")
+        sys.exit(1)
+    from sqlalchemy_base import Session
+
+    s = Session()
+    try:
+        rebuild(s)
+    finally:
+        s.close()
@@ -0,0 +1,58 @@
+import inspect, os
+import eventlet
+from eventlet.websocket import RFC6455WebSocket
+
+"""
+Faster unmasking of incoming websocket frames.
+
+eventlet unmasks every frame a client sends with a Python loop over its bytes, about
+a microsecond per byte: a 200 KB image upload blocks the hub for 0.2 s before any
+handler (or rate limit, see rate_limits.py) sees it. apply_mask XORs the frame as one
+big integer instead, same result.
+
+RFC6455WebSocket._apply_mask is private, so the patch is opt-in, WEBSOCKET_MASK_PATCH=1
+turns it on (compare with benchmarks/bench_websocket_masking.py first). Even then
+patch_websocket_masking only replaces it when it still has the signature it was written
+against (eventlet 0.41) and gives the same result as apply_mask on a sample frame,
+otherwise eventlet's own is kept.
+"""
+
+ENABLED = os.environ.get("WEBSOCKET_MASK_PATCH", "0") == "1"
+SIGNATURE = ["data", "mask", "length", "offset"]
+
+
+def apply_mask(data, mask, length=None, offset=0):
+    if length is None:
+        length = len(data)
+    key = bytes(mask[(offset + i) % 4] for i in range(4)) * (length // 4 + 1)
+    masked = int.from_bytes(data[:length], "big") ^ int.from_bytes(key[:length], "big")
+    return masked.to_bytes(length, "big")
+
+
+def compatible(original):
+    try:
+        if list(inspect.signature(original).parameters) != SIGNATURE:
+            return False
+        sample, mask = bytes(range(256)) * 3, b"\x12\x34\x56\x78"
+        return all(
+            original(sample, mask, length, offset) == apply_mask(sample, mask, length, offset)
+            for length, offset in ((len(sample), 0), (257, 3), (0, 1))
+        )
+    except Exception:
+        return False
+
+
+"""
+Replaces eventlet's unmasking with apply_mask, returns whether it did.
+"""
+
+
+def patch_websocket_masking():
+    original = getattr(RFC6455WebSocket, "_apply_mask", None)
+    if not ENABLED or original is None or original is apply_mask:
+        return original is apply_mask
+    if not compatible(original):
+        print("websocket masking not patched, eventlet %s is not supported" % eventlet.__version__)
+        return False
+    RFC6455WebSocket._apply_mask = staticmethod(apply_mask)
+    return True